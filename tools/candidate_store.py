@@ -0,0 +1,150 @@
+"""
+画像候補URLのデータベース（SQLite）
+
+APIから集めた候補URL（harvest）と、実際のダウンロード（fetch）を分けるための保存先。
+- harvest: 各APIに問い合わせて候補を追加する（status = pending）
+- fetch:   pending の候補をランク順に取り出してダウンロードし、結果を記録する
+
+補填や再実行、目標枚数の変更は、まずここに残っている pending の候補を使うので、
+APIに問い合わせ直す必要がない。
+
+status:
+  pending    未ダウンロード
+  downloaded 保存済み（file に保存先のファイル名）
+  duplicate  既存の画像と同じ内容だった
+  failed     ダウンロードできなかった / 画像ではなかった
+  rejected   品質スコアが低く、他の候補が選ばれた（quality_scorer.py）
+"""
+
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS candidates (
+    genre_id    TEXT NOT NULL,
+    item_id     TEXT NOT NULL,
+    url         TEXT NOT NULL,
+    source      TEXT NOT NULL,
+    rank        INTEGER NOT NULL,
+    width       INTEGER,
+    height      INTEGER,
+    license_url TEXT,
+    fallback_url TEXT,         -- url（縮小版）が取れなかったときに使う元のURL
+    status      TEXT NOT NULL DEFAULT 'pending',
+    file        TEXT,
+    updated_at  REAL NOT NULL,
+    PRIMARY KEY (genre_id, item_id, url)
+);
+CREATE INDEX IF NOT EXISTS idx_candidates_pending
+    ON candidates (genre_id, item_id, status, rank);
+"""
+
+
+class CandidateStore:
+    """候補URLの保存先（スレッド間で共有可能）
+
+    wal=False にすると通常のロールバックジャーナルを使う（複数のマシンから
+    共有ストレージ上のDBを使う場合。WAL はネットワークファイルシステムでは使えない）。
+    """
+
+    def __init__(self, db_path: Path, wal: bool = True):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), timeout=60, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL" if wal else "PRAGMA journal_mode=DELETE")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+
+    def _migrate(self):
+        """古いDBに fallback_url の列を足す"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(candidates)")}
+        if "fallback_url" in columns:
+            return
+        try:
+            with self._conn:
+                self._conn.execute("ALTER TABLE candidates ADD COLUMN fallback_url TEXT")
+        except sqlite3.OperationalError:
+            pass  # 他のプロセスが先に足した
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, genre_id: str, item_id: str, candidates: list) -> int:
+        """候補を追加（登録済みのURLは無視）。戻り値は新しく追加した件数"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT COALESCE(MAX(rank), 0) FROM candidates WHERE genre_id = ? AND item_id = ?",
+                (genre_id, item_id),
+            ).fetchone()
+            rank = row[0]
+            added = 0
+            for c in candidates:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO candidates "
+                    "(genre_id, item_id, url, source, rank, width, height, license_url, fallback_url, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (genre_id, item_id, c.url, c.source, rank + 1,
+                     c.width, c.height, c.license_url, c.fallback_url, now),
+                )
+                if cursor.rowcount:
+                    rank += 1
+                    added += 1
+            return added
+
+    def pending(self, genre_id: str, item_id: str, limit: Optional[int] = None) -> List[sqlite3.Row]:
+        """未ダウンロードの候補（ランク順）"""
+        sql = ("SELECT * FROM candidates WHERE genre_id = ? AND item_id = ? AND status = 'pending' "
+               "ORDER BY rank")
+        params: tuple = (genre_id, item_id)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params += (limit,)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def count_pending(self, genre_id: str, item_id: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM candidates WHERE genre_id = ? AND item_id = ? AND status = 'pending'",
+                (genre_id, item_id),
+            ).fetchone()[0]
+
+    def mark(self, genre_id: str, item_id: str, url: str, status: str, file: Optional[str] = None):
+        """候補の状態を更新"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE candidates SET status = ?, file = ?, updated_at = ? "
+                "WHERE genre_id = ? AND item_id = ? AND url = ?",
+                (status, file, time.time(), genre_id, item_id, url),
+            )
+
+    def reset_failed(self, genre_id: Optional[str] = None) -> int:
+        """failed の候補を pending に戻す（一時的な障害の後の再試行用）"""
+        sql = "UPDATE candidates SET status = 'pending', updated_at = ? WHERE status = 'failed'"
+        params: tuple = (time.time(),)
+        if genre_id:
+            sql += " AND genre_id = ?"
+            params += (genre_id,)
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    def summary(self, genre_id: str) -> Dict[str, Dict[str, int]]:
+        """アイテムごとの状態別件数 {item_id: {status: 件数}}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT item_id, status, COUNT(*) FROM candidates WHERE genre_id = ? "
+                "GROUP BY item_id, status",
+                (genre_id,),
+            ).fetchall()
+        result: Dict[str, Dict[str, int]] = {}
+        for item_id, status, count in rows:
+            result.setdefault(item_id, {})[status] = count
+        return result
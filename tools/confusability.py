@@ -0,0 +1,263 @@
+"""
+ジャンル内のアイテム同士の紛らわしさ（confusability）と similar_pairs の自動生成
+
+GenreInfo.similar_pairs が空のジャンルでは、クライアントがランダムにペアを作るため、
+このクイズの目的である「似ていて難しい」問題がほとんど出ない。
+feature_store.py の特徴量から、画像の見た目が近いアイテムの組を求めて similar_pairs を補う。
+
+紛らわしさの求め方:
+- 画像ごとの記述子  埋め込み（全画像にあれば）、無ければ色ヒストグラム（Hellinger）・
+                    色相ヒストグラム・16x16 のグレースケール（平均0・ノルム1）を連結
+- 各画像の近傍 k 枚（自分を除く）が、どのアイテムの画像かを数える（混同行列）
+- アイテム A, B の紛らわしさ = (A の近傍に B が入った数 + B の近傍に A が入った数) / (k × (A と B の枚数))
+  近傍がランダムでもおよそ 1/アイテム数 になるので、その MIN_LIFT 倍に届かない組は使わない
+- 根拠が少ない組も使わない。画像が少ないと数回の偶然の一致でも MIN_LIFT を超えてしまうので、
+  近傍に入った数が MIN_HITS 以上、両方のアイテムの画像が MIN_TYPE_IMAGES 枚以上で、さらに
+  偶然との差（z = (近傍に入った数 - 偶然の期待値) / √期待値）が、ラベルをシャッフルして
+  PERMUTATIONS 回数え直したときの z の最大値を超える組だけを使う。
+  近傍はそのままでラベルだけを入れ替えるので、特定の画像が多くの近傍に入る偏り（hubness）も
+  シャッフルの側に同じように現れる。見た目とアイテムが無関係なジャンルでは組は出ない
+
+距離は DISTANCE_BLOCK 行ずつ行列積（|q|² + |x|² - 2 q·x）でまとめて計算するので、
+メモリは DISTANCE_BLOCK × 画像数に収まり、数千枚のジャンルでも数秒で終わる。
+
+結果は紛らわしさの高い順に最大 MAX_AUTO_PAIRS 組を、ジャンルフォルダの .similar_pairs.json に保存する。
+manifest.json には、GenreInfo の similar_pairs の後ろに（重複しないものを）
+{"id1", "id2", "score", "source": "auto"} として入る。
+
+使い方:
+  python tools/confusability.py dogs birds --matrix
+"""
+
+import sys
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from feature_store import EMBEDDING, FeatureStore
+from manifest_writer import AUTO_PAIRS_FILENAME, load_auto_pairs, write_json_atomic
+
+
+NEIGHBORS = 5              # 近傍の枚数（k）
+DISTANCE_BLOCK = 1024      # 距離を一度に計算する行数
+MIN_LIFT = 1.5             # 偶然（近傍がランダムなとき）の何倍以上紛らわしい組を similar_pairs に入れるか
+MIN_HITS = 6               # 組の画像が互いの近傍に入った回数がこれ未満なら使わない
+MIN_TYPE_IMAGES = 5        # 画像がこれ未満のアイテムを含む組は使わない
+PERMUTATIONS = 20          # 偶然の z の上限を求めるためにラベルをシャッフルする回数
+MAX_AUTO_PAIRS = 10        # ジャンルごとの similar_pairs の自動生成の上限
+GRAY_DESCRIPTOR_SIZE = 16  # 記述子に使うグレースケールの大きさ
+
+# 記述子の各部分の重み
+DESCRIPTOR_WEIGHTS = {"color_hist": 1.0, "hue_hist": 1.0, "gray": 1.0}
+
+
+# =============================================================================
+# 記述子と距離
+# =============================================================================
+
+def _unit_rows(x: np.ndarray) -> np.ndarray:
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def build_descriptors(store: FeatureStore, rows: np.ndarray) -> Tuple[np.ndarray, str]:
+    """画像ごとの記述子（各行のノルムは1）。戻り値は（記述子, 種類）"""
+    embedding = store.array(EMBEDDING)
+    if len(embedding) and len(rows):
+        selected = np.asarray(embedding[rows], dtype=np.float32)
+        if not np.isnan(selected).any():
+            return _unit_rows(selected), "embedding"
+
+    parts = []
+    for name, weight in DESCRIPTOR_WEIGHTS.items():
+        values = np.asarray(store.array(name)[rows], dtype=np.float32)
+        if name == "gray":
+            n, size = len(values), values.shape[1]
+            f = size // GRAY_DESCRIPTOR_SIZE
+            values = values.reshape(n, GRAY_DESCRIPTOR_SIZE, f, GRAY_DESCRIPTOR_SIZE, f).mean(axis=(2, 4))
+            values = values.reshape(n, -1)
+            values = values - values.mean(axis=1, keepdims=True)
+        else:
+            values = np.sqrt(values)  # Hellinger 距離（ヒストグラムの平方根のユークリッド距離）
+        parts.append(_unit_rows(values) * np.sqrt(weight))
+    total = sum(DESCRIPTOR_WEIGHTS.values())
+    return np.concatenate(parts, axis=1) / np.sqrt(total), "histogram+gray"
+
+
+def knn_neighbors(x: np.ndarray, k: int = NEIGHBORS, block: int = DISTANCE_BLOCK) -> np.ndarray:
+    """各画像の近傍 k 枚のインデックス（画像数, k）。自分自身は除く"""
+    n = len(x)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.zeros((n, 0), dtype=np.int64)
+    x = x.astype(np.float32)
+    squared = np.einsum("ij,ij->i", x, x)
+    neighbors = np.empty((n, k), dtype=np.int64)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        dist = squared[start:stop, None] + squared[None, :] - 2 * (x[start:stop] @ x.T)
+        dist[np.arange(stop - start), np.arange(start, stop)] = np.inf  # 自分自身は除く
+        neighbors[start:stop] = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    return neighbors
+
+
+def count_confusion(neighbors: np.ndarray, labels: np.ndarray, n_labels: int) -> np.ndarray:
+    """近傍のアイテムを数えた混同行列（行: 画像のアイテム、列: 近傍のアイテム）"""
+    pairs = labels[:, None] * n_labels + labels[neighbors]
+    return np.bincount(pairs.ravel(), minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+
+
+def knn_confusion(x: np.ndarray, labels: np.ndarray, n_labels: int, k: int = NEIGHBORS,
+                  block: int = DISTANCE_BLOCK) -> np.ndarray:
+    """近傍 k 枚のアイテムを数えた混同行列"""
+    return count_confusion(knn_neighbors(x, k, block), labels, n_labels)
+
+
+def confusability_matrix(confusion: np.ndarray, counts: np.ndarray, k: int) -> np.ndarray:
+    """混同行列 → 対称な紛らわしさ（0〜1、対角は0）"""
+    pair_total = k * (counts[:, None] + counts[None, :])
+    matrix = (confusion + confusion.T) / np.maximum(pair_total, 1)
+    np.fill_diagonal(matrix, 0.0)
+    return matrix
+
+
+def chance_matrix(counts: np.ndarray) -> np.ndarray:
+    """近傍がランダムに選ばれたときの紛らわしさ"""
+    others = max(int(counts.sum()) - 1, 1)
+    return 2 * counts[:, None] * counts[None, :] / (others * np.maximum(counts[:, None] + counts[None, :], 1))
+
+
+def pair_zscores(hits: np.ndarray, counts: np.ndarray, k: int) -> np.ndarray:
+    """組ごとの偶然との差 (近傍に入った数 - 期待値) / √期待値（対角は -inf）"""
+    expected = chance_matrix(counts) * k * (counts[:, None] + counts[None, :])
+    z = (hits - expected) / np.sqrt(np.maximum(expected, 1e-9))
+    np.fill_diagonal(z, -np.inf)
+    return z
+
+
+def null_max_zscore(neighbors: np.ndarray, labels: np.ndarray, counts: np.ndarray,
+                    permutations: int = PERMUTATIONS, seed: int = 0) -> float:
+    """ラベルをシャッフルして数え直したときの z の最大値（偶然でも届く z の上限）"""
+    rng = np.random.default_rng(seed)
+    k = neighbors.shape[1]
+    best = -np.inf
+    for _ in range(permutations):
+        shuffled = rng.permutation(labels)
+        confusion = count_confusion(neighbors, shuffled, len(counts))
+        best = max(best, float(pair_zscores(confusion + confusion.T, counts, k).max()))
+    return best
+
+
+@dataclass
+class GenreConfusability:
+    type_ids: List[str]
+    matrix: np.ndarray        # 紛らわしさ（0〜1、対称）
+    hits: np.ndarray          # 組の画像が互いの近傍に入った数
+    zscores: np.ndarray       # 偶然との差
+    counts: np.ndarray        # アイテムごとの画像数
+    null_z: float             # ラベルをシャッフルしたときの z の最大値
+    kind: str                 # 記述子の種類
+
+
+def rank_pairs(result: GenreConfusability, max_pairs: int = MAX_AUTO_PAIRS, min_lift: float = MIN_LIFT,
+               min_hits: int = MIN_HITS, min_type_images: int = MIN_TYPE_IMAGES) -> List[dict]:
+    """紛らわしさの高い順の組（偶然の min_lift 倍未満と、根拠の少ない組は除く。無ければ空）"""
+    counts = result.counts
+    i, j = np.triu_indices(len(result.type_ids), k=1)
+    scores = result.matrix[i, j]
+    keep = ((scores >= min_lift * chance_matrix(counts)[i, j])
+            & (result.hits[i, j] >= min_hits)
+            & (counts[i] >= min_type_images) & (counts[j] >= min_type_images)
+            & (result.zscores[i, j] > result.null_z))
+    order = np.argsort(-scores, kind="stable")
+    order = order[keep[order]][:max_pairs]
+    return [{"id1": result.type_ids[i[o]], "id2": result.type_ids[j[o]], "score": round(float(scores[o]), 3)}
+            for o in order]
+
+
+# =============================================================================
+# ジャンル単位
+# =============================================================================
+
+def genre_confusability(store: FeatureStore, genre_id: str, k: int = NEIGHBORS) -> Optional[GenreConfusability]:
+    """ジャンルのアイテム同士の紛らわしさ。画像が足りなければNone"""
+    ids, rows = store.genre_rows(genre_id)
+    type_names = [image_id.split("/")[1] for image_id in ids]
+    type_ids = sorted(set(type_names))
+    if len(type_ids) < 2 or len(ids) <= k:
+        return None
+    lookup = {t: i for i, t in enumerate(type_ids)}
+    labels = np.array([lookup[t] for t in type_names], dtype=np.int64)
+    descriptors, kind = build_descriptors(store, rows)
+    neighbors = knn_neighbors(descriptors, k)
+    confusion = count_confusion(neighbors, labels, len(type_ids))
+    counts = np.bincount(labels, minlength=len(type_ids))
+    hits = confusion + confusion.T
+    return GenreConfusability(
+        type_ids, confusability_matrix(confusion, counts, k), hits,
+        pair_zscores(hits, counts, neighbors.shape[1]), counts,
+        null_max_zscore(neighbors, labels, counts), kind)
+
+
+def compute_similar_pairs(root: Path, genre_id: str, store: Optional[FeatureStore] = None) -> List[dict]:
+    """ジャンルの similar_pairs を特徴量から求める"""
+    result = genre_confusability(store or FeatureStore(root), genre_id)
+    if result is None:
+        return []
+    return rank_pairs(result)
+
+
+def update_auto_pairs(root: Path, genre_id: str, store: Optional[FeatureStore] = None) -> bool:
+    """.similar_pairs.json を更新する。変わったら True（manifest.json を作り直す必要がある）"""
+    genre_dir = Path(root) / genre_id
+    pairs = compute_similar_pairs(root, genre_id, store)
+    if pairs == load_auto_pairs(genre_dir):
+        return False
+    write_json_atomic(genre_dir / AUTO_PAIRS_FILENAME, pairs)
+    return True
+
+
+def print_matrix(type_ids: List[str], matrix: np.ndarray, counts: np.ndarray, limit: int = 12):
+    """紛らわしさの行列（上位のアイテムだけ）"""
+    shown = np.argsort(-matrix.max(axis=1))[:limit]
+    width = max(len(type_ids[i]) for i in shown)
+    print(" " * (width + 8) + " ".join(f"{type_ids[i][:6]:>6}" for i in shown))
+    for a in shown:
+        cells = " ".join("     -" if a == b else f"{matrix[a, b]:6.2f}" for b in shown)
+        print(f"  {type_ids[a]:<{width}} {counts[a]:4} {cells}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="特徴量からアイテムの紛らわしさを求め、similar_pairs を作る")
+    parser.add_argument("genres", nargs="+", help="ジャンルID")
+    parser.add_argument("--root", default="test_sets", help="テストセットのフォルダ")
+    parser.add_argument("--k", type=int, default=NEIGHBORS, help="近傍の枚数")
+    parser.add_argument("--matrix", action="store_true", help="紛らわしさの行列を表示")
+    parser.add_argument("--write", action="store_true",
+                        help=f"{AUTO_PAIRS_FILENAME} に保存（manifest.json は次の更新で反映）")
+    args = parser.parse_args(argv)
+
+    store = FeatureStore(Path(args.root))
+    for genre_id in args.genres:
+        result = genre_confusability(store, genre_id, args.k)
+        if result is None:
+            print(f"{genre_id}: 特徴量が足りません（reliable_image_downloader.py features {genre_id}）")
+            continue
+        print(f"\n{genre_id}: {len(result.type_ids)}アイテム / {int(result.counts.sum())}枚"
+              f"（記述子: {result.kind}、k={args.k}、偶然の z の上限 {result.null_z:.2f}）")
+        if args.matrix:
+            print_matrix(result.type_ids, result.matrix, result.counts)
+        pairs = rank_pairs(result)
+        if not pairs:
+            print("  紛らわしい組はありません（根拠が足りない組は使いません）")
+        for pair in pairs:
+            print(f"  {pair['score']:.3f}  {pair['id1']} × {pair['id2']}")
+        if args.write:
+            write_json_atomic(Path(args.root) / genre_id / AUTO_PAIRS_FILENAME, pairs)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
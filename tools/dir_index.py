@@ -0,0 +1,146 @@
+"""
+画像フォルダのインデックス（枚数・ファイル一覧のキャッシュ）
+
+フォルダごとに mtime・画像ファイル一覧・サブフォルダ一覧を記録し、
+mtime が変わったフォルダだけを os.scandir で読み直す。
+mtime の分解能が粗いファイルシステム（FAT は2秒、一部の NFS は1秒）では、スキャンと同じ刻みの中で
+追加されたファイルが mtime を変えないことがあるので、スキャン開始時刻と mtime の差が
+MTIME_GRANULARITY_NS 未満のエントリは信用せずに読み直す。
+ネットワークストレージ上の大きなテストセットでも、統計表示やZIP作成の
+たびに全フォルダを glob し直さずに済む。
+
+インデックスはルートフォルダ直下の .dir_index.json に保存される。
+
+使い方:
+  index = get_index(OUTPUT_DIR)
+  count = index.count_images(OUTPUT_DIR / "dogs" / "shiba")
+  index.save()
+"""
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+
+INDEX_FILENAME = ".dir_index.json"
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+MTIME_GRANULARITY_NS = 2_000_000_000  # mtime の分解能とみなす時間（FAT の2秒）
+
+
+class DirIndex:
+    """ルートフォルダ以下のフォルダ内容をキャッシュするインデックス"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.index_path = self.root / INDEX_FILENAME
+        self._entries: Dict[str, dict] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == 1:
+                self._entries = data.get("dirs", {})
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _key(self, directory: Path) -> str:
+        try:
+            return Path(directory).relative_to(self.root).as_posix()
+        except ValueError:
+            return Path(directory).resolve().as_posix()
+
+    def _entry(self, directory: Path) -> Optional[dict]:
+        """フォルダのエントリを返す（mtimeが変わっていればスキャンし直す）"""
+        key = self._key(directory)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            with self._lock:
+                if self._entries.pop(key, None) is not None:
+                    self._dirty = True
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry["mtime_ns"] == mtime_ns
+                    and entry.get("scanned_ns", 0) - mtime_ns >= MTIME_GRANULARITY_NS):
+                return entry
+
+        scanned_ns = time.time_ns()
+        images = []
+        subdirs = []
+        with os.scandir(directory) as it:
+            for e in it:
+                if e.is_dir():
+                    subdirs.append(e.name)
+                elif os.path.splitext(e.name)[1].lower() in IMAGE_EXTENSIONS:
+                    images.append(e.name)
+
+        entry = {
+            "mtime_ns": mtime_ns,
+            "scanned_ns": scanned_ns,
+            "images": sorted(images),
+            "subdirs": sorted(subdirs),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._dirty = True
+        return entry
+
+    def list_images(self, directory: Path) -> List[Path]:
+        """フォルダ内の画像ファイル（名前順）"""
+        entry = self._entry(directory)
+        if entry is None:
+            return []
+        return [Path(directory) / name for name in entry["images"]]
+
+    def count_images(self, directory: Path) -> int:
+        """フォルダ内の画像枚数"""
+        entry = self._entry(directory)
+        return len(entry["images"]) if entry else 0
+
+    def list_subdirs(self, directory: Path) -> List[Path]:
+        """フォルダ内のサブフォルダ（名前順）"""
+        entry = self._entry(directory)
+        if entry is None:
+            return []
+        return [Path(directory) / name for name in entry["subdirs"]]
+
+    def save(self):
+        """変更があればインデックスを保存（一時ファイル→リネーム）"""
+        with self._lock:
+            if not self._dirty or not self.root.exists():
+                return
+            data = {"version": 1, "dirs": self._entries}
+            # 同じルートを複数のプロセスが保存することがあるので、一時ファイルは書き手ごとに分ける
+            # （インデックスはキャッシュなので、最後に保存したものが残れば十分）
+            tmp_path = self.index_path.with_name(
+                f"{self.index_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.index_path)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+            self._dirty = False
+
+
+_indexes: Dict[str, DirIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(root: Union[str, Path]) -> DirIndex:
+    """ルートフォルダのインデックスを取得（プロセス内で共有）"""
+    key = str(Path(root).resolve())
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = DirIndex(Path(root))
+        return _indexes[key]
@@ -0,0 +1,462 @@
+"""
+テストセットの推論ランナー（engine-test の Python 版、バッチ推論）
+
+create_genre_zip で作った ZIP、またはジャンルフォルダの画像を、展開せずにそのまま読み込み、
+CPU の推論エンジンにバッチでまとめて渡す。結果は engine-test の ResultRecord と同じ形式の
+JSON（runs/{runId}/{imageId} に書き込むもの）で出力するので、Dart 版の結果と並べて比較できる。
+
+- 読み込み・デコード   スレッドプールで並列に行う（ZIP はスレッドごとに開き、
+                       Pillow はデコード・リサイズ中に GIL を解放するのでスレッドで十分）。
+                       先読みは batch_size × PREFETCH_BATCHES 枚までに抑える
+- 推論                 batch_size 枚ずつまとめて engine.infer_batch に渡す
+- エンジン             mock（Dart 版の MockEngine 相当）/ onnx（ONNX Runtime、CPU）
+- 集計                 処理枚数・枚/秒、バッチ・1枚あたりの推論時間とデコード時間のパーセンタイル
+
+ラベルは Dart 版と同じく ZIP 内のディレクトリ名（例: shiba/001.jpg → shiba）を使う。
+
+使い方:
+  python tools/engine_runner.py test_sets/dogs_20250101_120000.zip --engine mock --batch 16
+  python tools/engine_runner.py test_sets/dogs test_sets/birds --engine onnx --model model.onnx \\
+      --labels labels.txt --run-id onnx-run-001 --output results.json
+"""
+
+import io
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from dir_index import IMAGE_EXTENSIONS
+from host_health import percentile
+
+
+DECODE_WORKERS = 8
+BATCH_SIZE = 16
+PREFETCH_BATCHES = 4          # デコード済みで推論待ちにしておくバッチ数の上限
+DEFAULT_PREPROCESS = "none (match human test)"
+TOP_K = 5
+
+# ONNX のモデル（ImageNet 系）の入力の正規化
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+# =============================================================================
+# 結果の形式（engine-test/lib/engine/engine.dart, lib/models/result_record.dart と同じ）
+# =============================================================================
+
+@dataclass
+class Prediction:
+    label: str
+    score: float
+    extra: Optional[dict] = None
+
+    def to_json(self) -> dict:
+        data = {"label": self.label, "score": self.score}
+        if self.extra is not None:
+            data["extra"] = self.extra
+        return data
+
+
+@dataclass
+class InferenceResult:
+    predictions: List[Prediction]
+    latency_ms: int
+    provider: Optional[str] = None
+    input_size: Optional[List[int]] = None
+    note: Optional[str] = None
+
+
+@dataclass
+class TestItem:
+    """推論する画像1枚（ZIP のエントリ、またはファイル）"""
+    id: str                        # ZIP 内のパス（例: shiba/001.jpg）
+    image_path: str
+    label: Optional[str]
+    meta: Optional[dict] = None
+    zip_path: Optional[str] = None
+    file_path: Optional[str] = None
+
+
+@dataclass
+class ResultRecord:
+    run_id: str
+    image_id: str
+    engine: str
+    latency_ms: int
+    predictions: List[Prediction]
+    provider: Optional[str] = None
+    input_size: Optional[List[int]] = None
+    preprocess: str = DEFAULT_PREPROCESS
+    label: Optional[str] = None
+    meta: Optional[dict] = None
+    image_path: Optional[str] = None
+    timestamp: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+    @classmethod
+    def from_result(cls, run_id: str, item: TestItem, result: InferenceResult, engine: str) -> "ResultRecord":
+        return cls(
+            run_id=run_id,
+            image_id=item.id,
+            engine=engine,
+            provider=result.provider,
+            latency_ms=result.latency_ms,
+            predictions=result.predictions,
+            input_size=result.input_size,
+            preprocess=result.note or DEFAULT_PREPROCESS,
+            label=item.label,
+            meta=item.meta,
+            image_path=item.image_path,
+        )
+
+    def to_json(self) -> dict:
+        """Dart の ResultRecord.toJson と同じキー（null の provider / label / meta / imagePath は省略）"""
+        data = {"runId": self.run_id, "imageId": self.image_id, "engine": self.engine}
+        if self.provider is not None:
+            data["provider"] = self.provider
+        data["latencyMs"] = self.latency_ms
+        data["predictions"] = [p.to_json() for p in self.predictions]
+        data["inputSize"] = self.input_size
+        data["preprocess"] = self.preprocess
+        if self.label is not None:
+            data["label"] = self.label
+        if self.meta is not None:
+            data["meta"] = self.meta
+        if self.image_path is not None:
+            data["imagePath"] = self.image_path
+        ts = self.timestamp.astimezone(timezone.utc)
+        data["timestamp"] = ts.strftime("%Y-%m-%dT%H:%M:%S.") + f"{ts.microsecond // 1000:03d}Z"
+        return data
+
+
+# =============================================================================
+# 推論エンジン
+# =============================================================================
+
+class InferenceEngine:
+    """推論エンジンの共通部分
+
+    preprocess はデコード用のスレッドで画像1枚ずつ、infer_batch は推論用のスレッドで
+    バッチごとに呼ばれる。
+    """
+    name = "base"
+    provider: Optional[str] = None
+    input_size: Optional[Tuple[int, int]] = None  # (幅, 高さ)。None なら縮小しない
+
+    def preprocess(self, img: Image.Image):
+        return None
+
+    def infer_batch(self, inputs: List[object]) -> List[InferenceResult]:
+        raise NotImplementedError
+
+
+class MockEngine(InferenceEngine):
+    """Dart 版の MockEngine 相当（バッチごとに 5〜25ms 待ち、1枚あたり少し加算）"""
+    name = "mock"
+
+    def __init__(self, provider: str = "cpu", per_image_ms: float = 0.5, seed: Optional[int] = None):
+        self.provider = provider
+        self.per_image_ms = per_image_ms
+        self._random = random.Random(seed)
+
+    def infer_batch(self, inputs: List[object]) -> List[InferenceResult]:
+        delay_ms = 5 + self._random.randrange(20) + self.per_image_ms * len(inputs)
+        time.sleep(delay_ms / 1000)
+        per_image = int(round(delay_ms / len(inputs)))
+        return [InferenceResult(predictions=[Prediction("mock", 1.0)], latency_ms=per_image,
+                                provider=self.provider, note="placeholder result; replace with real engine")
+                for _ in inputs]
+
+
+class OnnxEngine(InferenceEngine):
+    """ONNX Runtime（CPU）で画像分類モデルを動かす
+
+    入力は NCHW の float32（ImageNet の平均・標準偏差で正規化）を想定する。
+    入力サイズはモデルから読み取り、動的な場合は input_size（省略時 224x224）を使う。
+    labels はクラス名を1行に1つ書いたテキストファイル（省略時はクラス番号）。
+    """
+    name = "onnx"
+
+    def __init__(self, model_path: str, labels_path: Optional[str] = None,
+                 input_size: Optional[Tuple[int, int]] = None, threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("onnxruntime がインストールされていません（pip install onnxruntime）")
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, sess_options=options,
+                                            providers=["CPUExecutionProvider"])
+        self.provider = "cpu"
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        shape = model_input.shape  # [N, C, H, W]（動的な次元は文字列か None）
+        if len(shape) == 4 and isinstance(shape[2], int) and isinstance(shape[3], int):
+            self.input_size = (shape[3], shape[2])
+        else:
+            self.input_size = input_size or (224, 224)
+        self.labels: Optional[List[str]] = None
+        if labels_path:
+            self.labels = [line.strip() for line in Path(labels_path).read_text(encoding="utf-8").splitlines()]
+        self.note = f"resize {self.input_size[0]}x{self.input_size[1]}, imagenet normalize"
+
+    def preprocess(self, img: Image.Image) -> np.ndarray:
+        img = img.convert("RGB").resize(self.input_size, Image.BILINEAR)
+        pixels = np.asarray(img, dtype=np.float32) / 255.0
+        pixels = (pixels - IMAGENET_MEAN) / IMAGENET_STD
+        return pixels.transpose(2, 0, 1)
+
+    def infer_batch(self, inputs: List[np.ndarray]) -> List[InferenceResult]:
+        batch = np.stack(inputs)
+        started = time.perf_counter()
+        logits = self.session.run(None, {self.input_name: batch})[0]
+        per_image = int(round((time.perf_counter() - started) * 1000 / len(inputs)))
+
+        logits = logits.reshape(len(inputs), -1).astype(np.float64)
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        top = np.argsort(-probs, axis=1)[:, :TOP_K]
+        results = []
+        for row, indices in zip(probs, top):
+            predictions = [Prediction(self.labels[i] if self.labels and i < len(self.labels) else str(i),
+                                      float(row[i])) for i in indices]
+            results.append(InferenceResult(predictions=predictions, latency_ms=per_image,
+                                           provider=self.provider, input_size=list(self.input_size),
+                                           note=self.note))
+        return results
+
+
+def resolve_engine(name: str, model: Optional[str] = None, labels: Optional[str] = None,
+                   input_size: Optional[Tuple[int, int]] = None, threads: int = 0,
+                   seed: Optional[int] = None) -> InferenceEngine:
+    if name == "mock":
+        return MockEngine(seed=seed)
+    if name == "onnx":
+        if not model:
+            raise ValueError("--engine onnx には --model が必要です")
+        return OnnxEngine(model, labels, input_size, threads)
+    raise ValueError(f"Unknown engine: {name}")
+
+
+# =============================================================================
+# 画像の列挙と読み込み
+# =============================================================================
+
+def _is_image(name: str) -> bool:
+    return Path(name).suffix.lower() in IMAGE_EXTENSIONS
+
+
+def list_items(source: Path) -> List[TestItem]:
+    """ZIP またはジャンルフォルダの画像（ID 順）"""
+    source = Path(source)
+    items = []
+    if source.is_file():
+        with zipfile.ZipFile(source) as zf:
+            for info in zf.infolist():
+                name = info.filename.replace("\\", "/")
+                if info.is_dir() or not _is_image(name):
+                    continue
+                label = name.split("/")[0] if "/" in name else None
+                items.append(TestItem(id=name, image_path=name, label=label,
+                                      meta={"source": str(source)}, zip_path=str(source)))
+    else:
+        for path in source.rglob("*"):
+            if not path.is_file() or not _is_image(path.name) or path.name.startswith("."):
+                continue
+            name = path.relative_to(source).as_posix()
+            label = name.split("/")[0] if "/" in name else None
+            items.append(TestItem(id=name, image_path=name, label=label,
+                                  meta={"source": str(source)}, file_path=str(path)))
+    items.sort(key=lambda item: item.id)
+    return items
+
+
+_local = threading.local()
+
+
+def read_item(item: TestItem) -> bytes:
+    """画像のバイト列（ZIP はスレッドごとに開いたものを使い回す）"""
+    if item.zip_path is None:
+        return Path(item.file_path).read_bytes()
+    zips: Dict[str, zipfile.ZipFile] = getattr(_local, "zips", None)
+    if zips is None:
+        zips = _local.zips = {}
+    if item.zip_path not in zips:
+        zips[item.zip_path] = zipfile.ZipFile(item.zip_path)
+    return zips[item.zip_path].read(item.image_path)
+
+
+@dataclass
+class Decoded:
+    item: TestItem
+    input: object = None
+    decode_ms: float = 0.0
+    error: Optional[str] = None
+
+
+def decode_item(item: TestItem, engine: InferenceEngine) -> Decoded:
+    started = time.perf_counter()
+    try:
+        data = read_item(item)
+        with Image.open(io.BytesIO(data)) as img:
+            if engine.input_size:
+                img.draft("RGB", engine.input_size)  # JPEG は縮小しながらデコードする
+            img.load()
+            pixels = engine.preprocess(img)
+    except Exception as e:
+        return Decoded(item, error=f"{type(e).__name__}: {e}")
+    return Decoded(item, pixels, (time.perf_counter() - started) * 1000)
+
+
+def _prefetch(pool: ThreadPoolExecutor, func, items: Iterable, window: int) -> Iterator:
+    """pool.map と同じ順で結果を返す（同時に抱える結果は window 件まで）"""
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# =============================================================================
+# 実行
+# =============================================================================
+
+@dataclass
+class RunStats:
+    images: int = 0
+    errors: int = 0
+    wall_sec: float = 0.0
+    batch_ms: List[float] = field(default_factory=list)
+    per_image_ms: List[float] = field(default_factory=list)
+    decode_ms: List[float] = field(default_factory=list)
+
+    @property
+    def images_per_sec(self) -> float:
+        return self.images / self.wall_sec if self.wall_sec > 0 else 0.0
+
+
+def run_inference(items: List[TestItem], engine: InferenceEngine, run_id: str,
+                  batch_size: int = BATCH_SIZE, decode_workers: int = DECODE_WORKERS,
+                  verbose: bool = False) -> Tuple[List[ResultRecord], RunStats]:
+    """画像をデコードしながらバッチで推論する"""
+    stats = RunStats()
+    records: List[ResultRecord] = []
+    started = time.perf_counter()
+
+    def infer(batch: List[Decoded]):
+        t0 = time.perf_counter()
+        results = engine.infer_batch([d.input for d in batch])
+        batch_ms = (time.perf_counter() - t0) * 1000
+        stats.batch_ms.append(batch_ms)
+        for decoded, result in zip(batch, results):
+            stats.per_image_ms.append(batch_ms / len(batch))
+            record = ResultRecord.from_result(run_id, decoded.item, result, engine.name)
+            record.meta = {**(record.meta or {}), "batchSize": len(batch)}
+            records.append(record)
+            if verbose:
+                preds = ", ".join(f"{p.label}:{p.score:.2f}" for p in record.predictions)
+                print(f"- {record.image_id}: {preds} ({record.latency_ms}ms)")
+        stats.images += len(batch)
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+        batch: List[Decoded] = []
+        decoded_items = _prefetch(pool, lambda item: decode_item(item, engine), items,
+                                  window=batch_size * PREFETCH_BATCHES)
+        for decoded in decoded_items:
+            if decoded.error is not None:
+                stats.errors += 1
+                print(f"  デコードに失敗: {decoded.item.id}: {decoded.error}", file=sys.stderr)
+                continue
+            stats.decode_ms.append(decoded.decode_ms)
+            batch.append(decoded)
+            if len(batch) >= batch_size:
+                infer(batch)
+                batch = []
+        if batch:
+            infer(batch)
+
+    stats.wall_sec = time.perf_counter() - started
+    return records, stats
+
+
+def print_run_stats(stats: RunStats, batch_size: int):
+    print(f"処理枚数: {stats.images}（失敗 {stats.errors}）/ 経過 {stats.wall_sec:.1f}s / "
+          f"{stats.images_per_sec:.1f} 枚/秒")
+    for name, values in (("batch", stats.batch_ms), ("per image", stats.per_image_ms),
+                         ("decode", stats.decode_ms)):
+        if values:
+            p50, p95, p99 = (percentile(values, q) for q in (50, 95, 99))
+            print(f"  {name:<10} p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms")
+    print(f"  （バッチサイズ {batch_size}、バッチ数 {len(stats.batch_ms)}）")
+
+
+def _default_run_id() -> str:
+    """Dart 版と同じ形式（UTC の ISO 8601、: を - に置き換え）"""
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z").replace(":", "-")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="テストセットのZIP・フォルダをバッチで推論（engine-test の Python 版）")
+    parser.add_argument("sources", nargs="+", help="create_genre_zip で作った ZIP、またはジャンルフォルダ")
+    parser.add_argument("--engine", default="mock", choices=["mock", "onnx"], help="推論エンジン")
+    parser.add_argument("--model", help="ONNX モデル（--engine onnx）")
+    parser.add_argument("--labels", help="クラス名のテキストファイル（1行に1つ）")
+    parser.add_argument("--input-size", type=int, nargs=2, metavar=("W", "H"),
+                        help="モデルの入力サイズが動的な場合の大きさ（省略時 224 224）")
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime のスレッド数（0 は自動）")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="バッチサイズ")
+    parser.add_argument("--workers", type=int, default=DECODE_WORKERS, help="デコードのスレッド数")
+    parser.add_argument("--run-id", default=None, help="実行ID（省略時は現在時刻）")
+    parser.add_argument("--limit", type=int, help="先頭から何枚だけ推論するか")
+    parser.add_argument("--seed", type=int, help="mock の乱数のシード")
+    parser.add_argument("--output", "-o", help="結果JSONの保存先（ResultRecord のリスト）")
+    parser.add_argument("--verbose", action="store_true", help="1枚ずつ結果を表示")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    try:
+        engine = resolve_engine(args.engine, args.model, args.labels,
+                                tuple(args.input_size) if args.input_size else None, args.threads, args.seed)
+    except (ValueError, RuntimeError) as e:
+        print(f"[error] {e}", file=sys.stderr)
+        return 64
+
+    items = [item for source in args.sources for item in list_items(Path(source))]
+    if args.limit:
+        items = items[:args.limit]
+    if not items:
+        print("[error] 画像が見つかりません", file=sys.stderr)
+        return 64
+
+    run_id = args.run_id or _default_run_id()
+    print(f"Running {len(items)} item(s) with engine \"{engine.name}\" (runId={run_id}) ...")
+    records, stats = run_inference(items, engine, run_id, max(1, args.batch), max(1, args.workers), args.verbose)
+    print_run_stats(stats, args.batch)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump([record.to_json() for record in records], f, ensure_ascii=False)
+        print(f"Saved results to {args.output}")
+    return 1 if stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,437 @@
+"""
+テストセットの画像の特徴量（メモリマップの .npy）
+
+解析のたびに全画像をデコードし直さなくて済むよう、画像ごとの小さな特徴量を
+まとめて保存しておく。
+
+- color_hist  RGB 各4段階の色ヒストグラム（64次元、合計1）
+- hue_hist    色相のヒストグラム（16次元、彩度で重み付け、合計1）
+- gray        32x32 のグレースケール（uint8）
+- phash       知覚ハッシュ（32x32 の DCT の低周波 8x8 を中央値で2値化した 64 ビット）
+- embedding   --embed-model の ONNX モデルの出力（L2 正規化、任意。無い行は NaN）
+
+特徴量はバッチ（FEATURE_BATCH 枚）ごとに NumPy でまとめて計算し、バッチをプロセスプールで並列に処理する。
+
+保存形式（test_sets/.features/）:
+  {特徴量}.npy  行を追記していく .npy（np.load(mmap_mode="r") でそのまま読める）
+  index.json    画像ID（ジャンル/タイプ/ファイル名）→ 行番号と SHA-256、確定した行数
+
+画像は manifest.json のエントリ（SHA-256）で管理し、新しい画像・内容が変わった画像だけを計算して
+行を追記する（古い行は使われなくなるだけ。compact で詰める）。追記は .npy を書いてから
+index.json を置き換えることで確定するので、途中で落ちても確定前の行は次回に切り捨てられる。
+
+使い方:
+  store = FeatureStore(OUTPUT_DIR)
+  ids, rows = store.genre_rows("dogs")
+  hists = store.array("color_hist")[rows]
+"""
+
+import os
+import sys
+import json
+import struct
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from manifest_writer import load_manifest, write_json_atomic
+
+
+FEATURES_DIRNAME = ".features"
+INDEX_FILENAME = "index.json"
+FEATURE_WORKERS = os.cpu_count() or 1  # プロセス数
+FEATURE_BATCH = 32           # 1タスクでまとめて計算する枚数
+THUMB_SIZE = 64              # 色ヒストグラムを計算するときの大きさ
+GRAY_SIZE = 32               # gray と phash の大きさ
+HIST_LEVELS = 4              # color_hist の RGB それぞれの段階数
+HUE_BINS = 16
+PHASH_SIZE = 8               # DCT の低周波の何x何を使うか
+HEADER_BYTES = 128           # .npy のヘッダの長さ（追記で行数が増えても書き直せるよう固定）
+
+# 特徴量の名前 → （dtype, 1行の形）
+FEATURES = {
+    "color_hist": (np.float32, (HIST_LEVELS ** 3,)),
+    "hue_hist": (np.float32, (HUE_BINS,)),
+    "gray": (np.uint8, (GRAY_SIZE, GRAY_SIZE)),
+    "phash": (np.uint64, ()),
+}
+EMBEDDING = "embedding"
+
+_embedder = None
+
+
+# =============================================================================
+# 特徴量の計算（プロセスプールで実行される）
+# =============================================================================
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """DCT-II の行列（直交）"""
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(GRAY_SIZE)
+
+
+def color_histograms(rgb: np.ndarray) -> np.ndarray:
+    """(B, H, W, 3) の uint8 → (B, 64) の色ヒストグラム"""
+    batch = rgb.shape[0]
+    q = (rgb.astype(np.int64) * HIST_LEVELS) >> 8
+    bins = (q[..., 0] * HIST_LEVELS + q[..., 1]) * HIST_LEVELS + q[..., 2]
+    offsets = (np.arange(batch) * HIST_LEVELS ** 3)[:, None, None]
+    hist = np.bincount((bins + offsets).ravel(), minlength=batch * HIST_LEVELS ** 3)
+    hist = hist.reshape(batch, HIST_LEVELS ** 3).astype(np.float32)  # batch=0 でも形を保つ
+    return hist / np.maximum(hist.sum(axis=1, keepdims=True), 1)
+
+
+def hue_histograms(rgb: np.ndarray) -> np.ndarray:
+    """(B, H, W, 3) の uint8 → (B, 16) の色相ヒストグラム（彩度で重み付け。無彩色の画像は0）"""
+    batch = rgb.shape[0]
+    c = rgb.astype(np.float32) / 255
+    r, g, b = c[..., 0], c[..., 1], c[..., 2]
+    mx, mn = c.max(axis=-1), c.min(axis=-1)
+    delta = mx - mn
+    safe = np.where(delta > 0, delta, 1)
+    hue = np.where(mx == r, ((g - b) / safe) % 6,
+                   np.where(mx == g, (b - r) / safe + 2, (r - g) / safe + 4)) / 6
+    saturation = np.where(mx > 0, delta / np.where(mx > 0, mx, 1), 0)
+    bins = np.minimum((hue * HUE_BINS).astype(np.int64), HUE_BINS - 1)
+    offsets = (np.arange(batch) * HUE_BINS)[:, None, None]
+    hist = np.bincount((bins + offsets).ravel(), weights=saturation.ravel(), minlength=batch * HUE_BINS)
+    hist = hist.reshape(batch, HUE_BINS).astype(np.float32)
+    return hist / np.maximum(hist.sum(axis=1, keepdims=True), 1e-6)
+
+
+def grayscale(rgb: np.ndarray) -> np.ndarray:
+    """(B, 64, 64, 3) → (B, 32, 32) の輝度（2x2 の平均で縮小）"""
+    luma = rgb.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    batch, h, w = luma.shape
+    f = h // GRAY_SIZE
+    small = luma.reshape(batch, GRAY_SIZE, f, GRAY_SIZE, f).mean(axis=(2, 4))
+    return np.clip(small + 0.5, 0, 255).astype(np.uint8)
+
+
+def perceptual_hash(gray: np.ndarray) -> np.ndarray:
+    """(B, 32, 32) → (B,) の 64 ビットの pHash"""
+    if len(gray) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    coeffs = np.einsum("ij,bjk,lk->bil", _DCT, gray.astype(np.float32), _DCT, optimize=True)
+    low = coeffs[:, :PHASH_SIZE, :PHASH_SIZE].reshape(len(gray), -1)
+    median = np.median(low[:, 1:], axis=1, keepdims=True)  # 直流成分は除く
+    bits = np.packbits(low > median, axis=1)
+    return bits.view(">u8").astype(np.uint64).ravel()
+
+
+def hamming_distance(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """pHash のハミング距離（ブロードキャスト可）"""
+    x = np.bitwise_xor(a, b)
+    return np.unpackbits(x.view(np.uint8).reshape(*x.shape, 8), axis=-1).sum(axis=-1)
+
+
+def _get_embedder(model_path: str):
+    """ワーカーごとに ONNX のセッションを1回だけ作る"""
+    global _embedder
+    if _embedder is None or _embedder[0] != model_path:
+        from engine_runner import OnnxEngine
+        _embedder = (model_path, OnnxEngine(model_path))
+    return _embedder[1]
+
+
+def check_embed_model(model_path: str):
+    """埋め込みのモデルが使えるか（ワーカーで失敗する前に確認する）"""
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        raise RuntimeError("onnxruntime がインストールされていません（pip install onnxruntime）")
+    if not Path(model_path).is_file():
+        raise RuntimeError(f"モデルがありません: {model_path}")
+
+
+def _embed(images: List[Image.Image], model_path: str) -> np.ndarray:
+    engine = _get_embedder(model_path)
+    batch = np.stack([engine.preprocess(img) for img in images])
+    output = engine.session.run(None, {engine.input_name: batch})[0]
+    output = output.reshape(len(images), -1).astype(np.float32)
+    return output / np.maximum(np.linalg.norm(output, axis=1, keepdims=True), 1e-12)
+
+
+def _decode(path: str, size: int) -> Image.Image:
+    with Image.open(path) as img:
+        img.draft("RGB", (size * 2, size * 2))
+        img = ImageOps.exif_transpose(img)
+        return img.convert("RGB")
+
+
+def extract_batch(paths: List[str], embed_model: Optional[str] = None) -> dict:
+    """画像のバッチの特徴量（プロセスプールのワーカーで実行）
+
+    戻り値: {"ok": 読めた画像の bool 配列, "errors": {パス: メッセージ}, 特徴量名: 配列}
+    """
+    ok = np.zeros(len(paths), dtype=bool)
+    thumbs = np.zeros((len(paths), THUMB_SIZE, THUMB_SIZE, 3), dtype=np.uint8)
+    images: List[Image.Image] = []
+    errors = {}
+    for i, path in enumerate(paths):
+        try:
+            img = _decode(path, THUMB_SIZE if embed_model is None else 256)
+            thumbs[i] = np.asarray(img.resize((THUMB_SIZE, THUMB_SIZE), Image.BILINEAR))
+            ok[i] = True
+            if embed_model is not None:
+                images.append(img)
+        except Exception as e:
+            errors[path] = f"{type(e).__name__}: {e}"
+
+    thumbs = thumbs[ok]
+    gray = grayscale(thumbs)
+    result = {
+        "ok": ok,
+        "errors": errors,
+        "color_hist": color_histograms(thumbs),
+        "hue_hist": hue_histograms(thumbs),
+        "gray": gray,
+        "phash": perceptual_hash(gray),
+    }
+    if embed_model is not None and images:
+        result[EMBEDDING] = _embed(images, embed_model)
+    return result
+
+
+# =============================================================================
+# 追記できる .npy
+# =============================================================================
+
+def _header(dtype: np.dtype, shape: Tuple[int, ...]) -> bytes:
+    """長さが HEADER_BYTES に固定された .npy（version 1.0）のヘッダ"""
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                   "fortran_order": False, "shape": tuple(shape)})
+    header += " " * (HEADER_BYTES - 10 - len(header) - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def _read_shape(path: Path) -> Tuple[np.dtype, Tuple[int, ...]]:
+    with open(path, "rb") as f:
+        np.lib.format.read_magic(f)
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    return dtype, shape
+
+
+def append_rows(path: Path, rows: np.ndarray, committed: int) -> None:
+    """.npy に行を追記する（committed 行より後ろの、確定していない行は切り捨てる）"""
+    row_shape = rows.shape[1:]
+    if not path.exists():
+        with open(path, "wb") as f:
+            f.write(_header(rows.dtype, (0,) + row_shape))
+    dtype, shape = _read_shape(path)
+    if dtype != rows.dtype or tuple(shape[1:]) != row_shape:
+        raise ValueError(f"{path.name}: 形が違います（{dtype}{shape[1:]} と {rows.dtype}{row_shape}）")
+    row_bytes = dtype.itemsize * int(np.prod(row_shape, dtype=np.int64))
+    with open(path, "r+b") as f:
+        f.truncate(HEADER_BYTES + committed * row_bytes)
+        f.seek(0, os.SEEK_END)
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.seek(0)
+        f.write(_header(dtype, (committed + len(rows),) + row_shape))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# =============================================================================
+# 保存先
+# =============================================================================
+
+class FeatureStore:
+    """画像ID → 行番号の索引と、行を追記していく特徴量の .npy"""
+
+    def __init__(self, root: Path):
+        self.dir = Path(root) / FEATURES_DIRNAME
+        self.dir.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(self.dir / INDEX_FILENAME, encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        self.rows: int = index.get("rows", 0)
+        self.items: Dict[str, dict] = index.get("items", {})
+        self.embed_model: Optional[str] = index.get("embed_model")
+
+    def _path(self, name: str) -> Path:
+        return self.dir / f"{name}.npy"
+
+    def array(self, name: str) -> np.ndarray:
+        """特徴量の配列（メモリマップ、確定した行まで）"""
+        path = self._path(name)
+        if not path.exists():
+            dtype, row_shape = FEATURES.get(name, (np.float32, (0,)))
+            return np.zeros((0,) + row_shape, dtype=dtype)
+        return np.load(path, mmap_mode="r")[:self.rows]
+
+    def append(self, ids: List[str], shas: List[str], features: Dict[str, np.ndarray],
+               embed_model: Optional[str] = None):
+        """行を追記して索引を更新する（index.json を置き換えた時点で確定）"""
+        if not ids:
+            return
+        count = len(ids)
+        for name in FEATURES:
+            append_rows(self._path(name), features[name], self.rows)
+        embedding = features.get(EMBEDDING)
+        if embedding is not None and not self._path(EMBEDDING).exists():
+            # 埋め込みを初めて計算するときは、既存の行を NaN で埋めておく
+            append_rows(self._path(EMBEDDING), np.full((self.rows, embedding.shape[1]), np.nan, np.float32), 0)
+        if self._path(EMBEDDING).exists():
+            if embedding is None:
+                _, shape = _read_shape(self._path(EMBEDDING))
+                embedding = np.full((count,) + tuple(shape[1:]), np.nan, np.float32)
+            append_rows(self._path(EMBEDDING), embedding, self.rows)
+        for i, (image_id, sha256) in enumerate(zip(ids, shas)):
+            self.items[image_id] = {"row": self.rows + i, "sha256": sha256,
+                                    "embedding": features.get(EMBEDDING) is not None}
+        self.rows += count
+        if embed_model is not None:
+            self.embed_model = embed_model
+        self.save()
+
+    def remove(self, ids: List[str]):
+        """索引から外す（行は compact まで残る）"""
+        for image_id in ids:
+            self.items.pop(image_id, None)
+
+    def save(self):
+        write_json_atomic(self.dir / INDEX_FILENAME,
+                          {"rows": self.rows, "embed_model": self.embed_model, "items": self.items})
+
+    def genre_rows(self, genre_id: str) -> Tuple[List[str], np.ndarray]:
+        """ジャンルの画像ID（ID 順）と行番号"""
+        prefix = genre_id + "/"
+        ids = sorted(i for i in self.items if i.startswith(prefix))
+        return ids, np.array([self.items[i]["row"] for i in ids], dtype=np.int64)
+
+    def is_current(self, image_id: str, sha256: str, embedding: bool = False) -> bool:
+        entry = self.items.get(image_id)
+        return bool(entry and entry["sha256"] == sha256 and (entry.get("embedding") or not embedding))
+
+    def compact(self) -> int:
+        """使われていない行を詰める。戻り値は減った行数"""
+        live = sorted(self.items.items(), key=lambda kv: kv[1]["row"])
+        keep = np.array([entry["row"] for _, entry in live], dtype=np.int64)
+        removed = self.rows - len(keep)
+        if removed <= 0:
+            return 0
+        names = list(FEATURES) + ([EMBEDDING] if self._path(EMBEDDING).exists() else [])
+        for name in names:
+            data = np.array(self.array(name)[keep])
+            tmp = self._path(name).with_suffix(".tmp")
+            tmp.unlink(missing_ok=True)
+            append_rows(tmp, data, 0)
+            os.replace(tmp, self._path(name))
+        for new_row, (_, entry) in enumerate(live):
+            entry["row"] = new_row
+        self.rows = len(keep)
+        self.save()
+        return removed
+
+
+# =============================================================================
+# 特徴量の更新
+# =============================================================================
+
+class FeatureExtractor:
+    """manifest.json の画像のうち、新しい・変わったものの特徴量を計算して追記する"""
+
+    def __init__(self, root: Path, workers: int = FEATURE_WORKERS, embed_model: Optional[str] = None):
+        if embed_model is not None:
+            check_embed_model(embed_model)
+        self.root = Path(root)
+        self.workers = max(1, workers)
+        self.embed_model = embed_model
+        self.store = FeatureStore(self.root)
+        self.computed = 0
+        self.errors = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # 呼び出し側ではダウンロードのスレッドが動いているので fork ではなく spawn を使う
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    def update_genre(self, genre_id: str, manifest: Optional[dict] = None) -> int:
+        """ジャンル1つ分を更新する。戻り値は計算した枚数"""
+        genre_dir = self.root / genre_id
+        manifest = manifest or load_manifest(genre_dir)
+        if not manifest:
+            return 0
+        entries = [(f"{genre_id}/{type_id}/{image['file']}", image["sha256"],
+                    str(genre_dir / type_id / image["file"]))
+                   for type_id, info in manifest.get("types", {}).items()
+                   for image in info.get("images", [])]
+
+        with self._lock:  # 索引と .npy の追記は1つずつ
+            current = {image_id for image_id, _, _ in entries}
+            prefix = genre_id + "/"
+            self.store.remove([i for i in self.store.items if i.startswith(prefix) and i not in current])
+            stale = [e for e in entries if not self.store.is_current(e[0], e[1], self.embed_model is not None)]
+            if not stale:
+                self.store.save()
+                return 0
+
+            batches = [stale[i:i + FEATURE_BATCH] for i in range(0, len(stale), FEATURE_BATCH)]
+            results = self._get_pool().map(extract_batch, [[path for _, _, path in b] for b in batches],
+                                           [self.embed_model] * len(batches))
+            computed = 0
+            for batch, result in zip(batches, results):
+                ok = result["ok"]
+                for path, message in result["errors"].items():
+                    print(f"    特徴量の計算に失敗: {path}: {message}")
+                done = [entry for entry, good in zip(batch, ok) if good]
+                if not done:  # バッチの画像がどれも読めなかった（エラーは上で表示済み）
+                    self.errors += len(batch)
+                    continue
+                self.store.append([e[0] for e in done], [e[1] for e in done],
+                                  {k: v for k, v in result.items() if k not in ("ok", "errors")},
+                                  self.embed_model)
+                computed += len(done)
+                self.errors += int((~ok).sum())
+            self.store.save()
+            self.computed += computed
+            return computed
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="特徴量の保存先の確認・整理"
+                                                 "（計算は reliable_image_downloader.py features）")
+    parser.add_argument("root", nargs="?", default="test_sets", help="テストセットのフォルダ")
+    parser.add_argument("--compact", action="store_true", help="使われていない行を詰める")
+    args = parser.parse_args(argv)
+
+    store = FeatureStore(Path(args.root))
+    if args.compact:
+        print(f"{store.compact()}行を削除しました")
+    genres: Dict[str, int] = {}
+    for image_id in store.items:
+        genre_id = image_id.split("/")[0]
+        genres[genre_id] = genres.get(genre_id, 0) + 1
+    size = sum(p.stat().st_size for p in store.dir.glob("*.npy"))
+    print(f"{store.dir}: {len(store.items)}枚（{store.rows}行、{size / 2**20:.1f} MB）"
+          f"{'  埋め込み: ' + store.embed_model if store.embed_model else ''}")
+    for genre_id, count in sorted(genres.items()):
+        print(f"  {genre_id:<15} {count}枚")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
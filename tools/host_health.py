@@ -0,0 +1,314 @@
+"""
+画像ホストの障害対策（サーキットブレーカーとネガティブキャッシュ）
+
+上流のAPIやCDNが落ちていると、リクエストのたびにタイムアウト（10〜15秒）まで待たされ、
+次のアイテムもまた同じホストに問い合わせてしまう。これを防ぐために:
+
+- サーキットブレーカー（ホストごと）
+    closed    通常どおりリクエストする
+    open      連続 failure_threshold 回失敗したら cooldown 秒間リクエストしない
+    half_open cooldown 後に1件だけ試しにリクエストし（プローブ）、
+              成功したら closed に戻し、失敗したら再び open にする
+- ネガティブキャッシュ
+    404 や画像でない内容を返したURLを有効期限付きで記録し、次回以降は問い合わせない。
+    ファイルに保存されるので、実行をまたいで効く。
+    保存はロックを取ってファイルを読み直し、自分が追加した分だけを足す（複数ワーカーが同じファイルを使う）。
+- 応答時間の記録（ホストごと）
+    直近の応答時間からパーセンタイル（p95など）を求め、遅いリクエストの判定に使う。
+- 同時リクエスト数の自動調整（ホストごと、AIMD）
+    正常な応答が続き、上限まで使い切っている間は上限を少しずつ（加算で）上げ、
+    429/503・タイムアウト・応答時間の急増があったら半分（乗算）に下げる。
+    上限はファイルに保存し、次回の実行の初期値にする（保存するのはこのプロセスが使ったホストの分だけ）。
+"""
+
+import json
+import math
+import time
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional
+from urllib.parse import urlparse
+
+from manifest_writer import update_json_locked
+
+
+FAILURE_THRESHOLD = 5       # open にする連続失敗回数
+COOLDOWN_SEC = 60.0         # open にしておく秒数
+NEGATIVE_TTL_SEC = 7 * 24 * 60 * 60  # ネガティブキャッシュの有効期限
+LATENCY_WINDOW = 200        # ホストごとに保持する応答時間の件数
+LATENCY_MIN_SAMPLES = 20    # パーセンタイルを返すのに必要な件数
+
+AIMD_INITIAL_LIMIT = 2.0    # 同時リクエスト数の初期値（保存された値が無い場合）
+AIMD_MIN_LIMIT = 1.0
+AIMD_MAX_LIMIT = 16.0
+AIMD_DECREASE_FACTOR = 0.5  # 混雑時に上限に掛ける値
+LATENCY_SPIKE_FACTOR = 3.0  # 平均応答時間の何倍を「急増」とみなすか
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class HostBusyError(Exception):
+    """ホストが混雑・障害中で取得できなかった（URL自体の失敗ではない）"""
+
+
+class CircuitOpenError(HostBusyError):
+    """ホストのサーキットが open のため、リクエストしなかった"""
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+
+class CircuitBreaker:
+    """ホスト1つ分のサーキットブレーカー"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN_SEC):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """リクエストできる状態か（状態は変えない）"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            return not self._probing and time.monotonic() - self.opened_at >= self.cooldown
+
+    def before_request(self):
+        """リクエスト前に呼ぶ（open なら CircuitOpenError）"""
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError(f"circuit {self.state}")
+            # cooldown が過ぎたので1件だけプローブを通す
+            self.state = "half_open"
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class CircuitBreakers:
+    """ホストごとのサーキットブレーカー"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN_SEC):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> CircuitBreaker:
+        host = host_of(url)
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.cooldown)
+            return self._breakers[host]
+
+    def available(self, url: str) -> bool:
+        return self.get(url).available()
+
+    def open_hosts(self) -> Dict[str, int]:
+        """open / half_open のホストと連続失敗回数"""
+        with self._lock:
+            return {host: b.failures for host, b in self._breakers.items() if b.state != "closed"}
+
+
+class NegativeCache:
+    """失敗したURLの記録（有効期限付き、ファイルに保存）"""
+
+    def __init__(self, path: Path, ttl: float = NEGATIVE_TTL_SEC):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._entries: Dict[str, dict] = {}
+        self._added: Dict[str, dict] = {}  # 読み込み後に追加した分（保存時にファイルの内容に足す）
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        self._entries = {url: e for url, e in entries.items() if e.get("expires", 0) > now}
+        self._dirty = len(self._entries) != len(entries)
+
+    def __contains__(self, url: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return False
+            if entry["expires"] <= time.time():
+                del self._entries[url]
+                self._dirty = True
+                return False
+            return True
+
+    def reason(self, url: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(url)
+            return entry["reason"] if entry else None
+
+    def add(self, url: str, reason: str):
+        with self._lock:
+            entry = {"reason": reason, "expires": time.time() + self.ttl}
+            self._entries[url] = self._added[url] = entry
+            self._dirty = True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def save(self):
+        """変更があれば保存（ファイルを読み直し、期限切れを除いて追加分を足す）"""
+        with self._lock:
+            if not self._dirty:
+                return
+            added = dict(self._added)
+
+            def merge(current: dict) -> dict:
+                now = time.time()
+                entries = {url: e for url, e in current.items()
+                           if isinstance(e, dict) and e.get("expires", 0) > now}
+                entries.update(added)
+                return entries
+
+            entries = update_json_locked(self.path, merge)
+            self._entries = dict(entries)  # 他のワーカーが追加した分も使う
+            self._added.clear()
+            self._dirty = False
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """パーセンタイル（最近傍法、q は 0〜100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class LatencyTracker:
+    """ホストごとの直近の応答時間"""
+
+    def __init__(self, window: int = LATENCY_WINDOW, min_samples: int = LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, url: str, seconds: float):
+        host = host_of(url)
+        with self._lock:
+            if host not in self._samples:
+                self._samples[host] = deque(maxlen=self.window)
+            self._samples[host].append(seconds)
+
+    def percentile(self, url: str, q: float) -> Optional[float]:
+        """ホストの応答時間のパーセンタイル（件数が少なければNone）"""
+        with self._lock:
+            samples = list(self._samples.get(host_of(url), ()))
+        if len(samples) < self.min_samples:
+            return None
+        return percentile(samples, q)
+
+
+class AimdLimiter:
+    """ホスト1つ分の同時リクエスト数の上限（AIMD）"""
+
+    def __init__(self, limit: float = AIMD_INITIAL_LIMIT):
+        self.limit = min(AIMD_MAX_LIMIT, max(AIMD_MIN_LIMIT, limit))
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.samples = 0
+        self.last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """空きができるまで待つ"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency: Optional[float], overloaded: bool):
+        """リクエストの結果を反映する
+
+        latency: 応答時間（エラーの場合はNone）
+        overloaded: 429/503・タイムアウトなど、ホストが混雑している兆候があった
+        """
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+
+            spike = (latency is not None and self.latency_ewma is not None
+                     and self.samples >= 10 and latency > LATENCY_SPIKE_FACTOR * self.latency_ewma)
+            now = time.monotonic()
+            if overloaded or spike:
+                # 同じ混雑で何度も下げないよう、前回から平均応答時間1回分は空ける
+                if now - self.last_decrease >= (self.latency_ewma or 1.0):
+                    self.limit = max(AIMD_MIN_LIMIT, self.limit * AIMD_DECREASE_FACTOR)
+                    self.last_decrease = now
+            elif latency is not None and saturated:
+                # 上限まで使っているときだけ上げる（上限の分だけ成功すると +1）
+                self.limit = min(AIMD_MAX_LIMIT, self.limit + 1.0 / self.limit)
+
+            if latency is not None and not spike:
+                self.samples += 1
+                if self.latency_ewma is None:
+                    self.latency_ewma = latency
+                else:
+                    self.latency_ewma += LATENCY_EWMA_ALPHA * (latency - self.latency_ewma)
+            self._cond.notify_all()
+
+
+class HostConcurrency:
+    """ホストごとの同時リクエスト数の上限（ファイルに保存）"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._saved: Dict[str, float] = {}
+        self._limiters: Dict[str, AimdLimiter] = {}
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._saved = {host: float(limit) for host, limit in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            self._saved = {}
+
+    def get(self, url: str) -> AimdLimiter:
+        host = host_of(url)
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AimdLimiter(self._saved.get(host, AIMD_INITIAL_LIMIT))
+            return self._limiters[host]
+
+    def limits(self) -> Dict[str, float]:
+        with self._lock:
+            return {host: round(l.limit, 2) for host, l in self._limiters.items()}
+
+    def save(self):
+        """使ったホストの上限を保存（ファイルを読み直して、そのホストの分だけ書き換える）"""
+        with self._lock:
+            limits = {host: round(l.limit, 2) for host, l in self._limiters.items()}
+        if not limits:
+            return
+        update_json_locked(self.path, lambda current: {**current, **limits})
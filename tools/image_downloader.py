@@ -7,15 +7,45 @@
   ├── same/          # 同じもの（チーター×チーター など）
   ├── different/     # 違うもの（チーター×ヒョウ など）
   ├── twins/         # 双子（一緒に写っている）
-  └── similar_people/# 似ている人（一緒に写っている）
+  ├── similar_people/# 似ている人（一緒に写っている）（.boxes.json に顔・被写体のボックス）
+  └── cache/         # 動物ごとのクロール結果（合成の素材）
 """
 
-import tempfile
+import os
+import json
+import time
 import shutil
 import random
+import hashlib
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
 
+from dir_index import get_index
+from subject_boxes import SubjectBoxer
+
+
+BASE_DIR = Path("downloaded_images")
+CACHE_DIR = BASE_DIR / "cache"
+CRAWL_WORKERS = 4     # 同時にクロールする動物の数
+COMPOSE_WORKERS = 4   # 同時に合成するジョブの数
+
+# icrawlerのスレッド数（download_with_icrawlerの引数で上書き可能）
+CRAWLER_THREADS = {
+    "feeder_threads": 1,
+    "parser_threads": 1,
+    "downloader_threads": 4,
+}
+
+# 検索クエリごとのクロール結果キャッシュ
+QUERY_CACHE_DIR = CACHE_DIR / "_queries"
+QUERY_CACHE_MAX_ENTRIES = 200              # これを超えたら古い順に削除
+QUERY_CACHE_MAX_AGE = 30 * 24 * 60 * 60    # 秒（30日より古いものは再クロール）
+
+_query_locks = {}
+_query_locks_guard = threading.Lock()
+
 
 def create_folders():
     """画像を保存するフォルダを作成"""
@@ -24,18 +54,16 @@ def create_folders():
         "different",
         "twins",
         "similar_people",
-        "temp_a",
-        "temp_b",
+        "cache",
     ]
     
-    base_path = Path("downloaded_images")
-    base_path.mkdir(exist_ok=True)
+    BASE_DIR.mkdir(exist_ok=True)
     
     for category in categories:
-        (base_path / category).mkdir(exist_ok=True)
+        (BASE_DIR / category).mkdir(exist_ok=True)
     
     print("✓ フォルダを作成しました")
-    return base_path
+    return BASE_DIR
 
 
 def combine_images_side_by_side(img1_path, img2_path, output_path):
@@ -70,23 +98,131 @@ def combine_images_side_by_side(img1_path, img2_path, output_path):
         return False
 
 
-def download_with_icrawler(query, save_dir, num_images=10):
-    """icrawlerを使って画像を検索・ダウンロード"""
+def _query_lock(cache_path):
+    """同じクエリを複数スレッドが同時にクロールしないためのロック
+
+    meta.json の無いクロール中のフォルダも削除時にロックできるよう、フォルダ名で引く
+    """
+    with _query_locks_guard:
+        return _query_locks.setdefault(cache_path.name, threading.Lock())
+
+
+def _query_cache_path(query):
+    """クエリに対応するキャッシュフォルダ"""
+    digest = hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+    return QUERY_CACHE_DIR / digest
+
+
+def _load_query_meta(cache_path):
+    """キャッシュのメタ情報を読み込む（無い・壊れている場合はNone）"""
     try:
-        from icrawler.builtin import BingImageCrawler
-        
-        temp_dir = Path(tempfile.mkdtemp())
-        
-        print(f"  '{query}' を検索中...")
+        with open(cache_path / "meta.json", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _cached_files(cache_path):
+    """キャッシュ内の画像ファイル（メタ情報を除く）"""
+    return sorted(f for f in cache_path.glob("*") if not f.name.startswith("meta.json"))
+
+
+def _save_query_meta(cache_path, meta):
+    """キャッシュのメタ情報を保存"""
+    tmp_path = cache_path / "meta.json.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, cache_path / "meta.json")
+
+
+def crawl_query_cached(query, num_images, threads=None):
+    """クエリのクロール結果をキャッシュから返す（足りなければクロール）
+
+    戻り値: キャッシュ内の画像パスのリスト
+    """
+    from icrawler.builtin import BingImageCrawler
+    
+    cache_path = _query_cache_path(query)
+    
+    with _query_lock(cache_path):
+        meta = _load_query_meta(cache_path)
+        files = _cached_files(cache_path) if meta else []
+        expired = meta is not None and time.time() - meta.get("crawled_at", 0) > QUERY_CACHE_MAX_AGE
         
-        crawler = BingImageCrawler(
-            storage={'root_dir': str(temp_dir)},
-            feeder_threads=1,
-            parser_threads=1,
-            downloader_threads=2
-        )
+        # 前回より多く要求された場合も、取得できる分はすでに取得済み
+        if meta and not expired and (len(files) >= num_images or meta.get("requested", 0) >= num_images):
+            print(f"  '{query}' キャッシュを使用 ({len(files)}枚)")
+        else:
+            print(f"  '{query}' を検索中...")
+            if cache_path.exists():
+                shutil.rmtree(cache_path)
+            cache_path.mkdir(parents=True)
+            # クロール中も最近使ったキャッシュとして扱われるよう、先に仮のメタ情報を置く
+            # （crawled_at=0 なので、途中で落ちた場合は次回クロールし直す）
+            _save_query_meta(cache_path, {"query": query, "requested": 0, "crawled_at": 0,
+                                          "last_used": time.time()})
+            
+            crawler = BingImageCrawler(
+                storage={'root_dir': str(cache_path)},
+                **{**CRAWLER_THREADS, **(threads or {})}
+            )
+            crawler.crawl(keyword=query, max_num=num_images)
+            
+            files = _cached_files(cache_path)
+            meta = {"query": query, "requested": num_images, "crawled_at": time.time()}
         
-        crawler.crawl(keyword=query, max_num=num_images)
+        meta["last_used"] = time.time()
+        _save_query_meta(cache_path, meta)
+    
+    evict_query_cache()
+    return files
+
+
+def evict_query_cache(max_entries=None):
+    """最後に使われた時刻が古いクエリキャッシュから削除"""
+    if max_entries is None:
+        max_entries = QUERY_CACHE_MAX_ENTRIES
+    if not QUERY_CACHE_DIR.exists():
+        return 0
+    
+    entries = []
+    for cache_path in QUERY_CACHE_DIR.iterdir():
+        meta = _load_query_meta(cache_path) if cache_path.is_dir() else None
+        last_used = meta.get("last_used", 0) if meta else 0
+        entries.append((last_used, cache_path))
+    
+    entries.sort(key=lambda e: e[0], reverse=True)
+    removed = 0
+    for _, cache_path in entries[max_entries:]:
+        lock = _query_lock(cache_path)
+        # 使用中（クロール中を含む）のキャッシュは消さない
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            shutil.rmtree(cache_path, ignore_errors=True)
+            removed += 1
+        finally:
+            lock.release()
+    return removed
+
+
+def link_or_copy(src, dest):
+    """ハードリンクを作成（別デバイス等で失敗したらコピー）"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy(src, dest)
+
+
+def download_with_icrawler(query, save_dir, num_images=10, threads=None):
+    """icrawlerを使って画像を検索・ダウンロード
+
+    クロール結果はクエリごとにキャッシュされ、同じクエリの再実行はディスクから返す。
+    保存先にはキャッシュ内のファイルをハードリンクする。
+    threads: {"feeder_threads": ..., "parser_threads": ..., "downloader_threads": ...}
+    """
+    try:
+        files = crawl_query_cached(query, num_images, threads)
         
         save_path = Path(save_dir)
         save_path.mkdir(parents=True, exist_ok=True)
@@ -95,16 +231,15 @@ def download_with_icrawler(query, save_dir, num_images=10):
         existing_files = list(save_path.glob("*.jpg")) + list(save_path.glob("*.png"))
         start_index = len(existing_files) + 1
         
-        for img_file in sorted(temp_dir.glob("*")):
+        for img_file in files:
             if saved_count >= num_images:
                 break
             
             new_name = f"{start_index + saved_count:03d}.jpg"
             dest_path = save_path / new_name
-            shutil.copy(img_file, dest_path)
+            link_or_copy(img_file, dest_path)
             saved_count += 1
         
-        shutil.rmtree(temp_dir)
         print(f"  ✓ {saved_count}枚を保存しました")
         return saved_count
     except ImportError:
@@ -115,34 +250,50 @@ def download_with_icrawler(query, save_dir, num_images=10):
         return 0
 
 
-def clear_temp_folders():
-    """一時フォルダをクリア"""
-    base_path = Path("downloaded_images")
-    for folder in ["temp_a", "temp_b"]:
-        temp_path = base_path / folder
-        if temp_path.exists():
-            for f in temp_path.glob("*"):
-                f.unlink()
-
+def crawl_animal(key, queries, num_images):
+    """動物1種類分の画像をキャッシュフォルダにクロール
 
-def create_same_images(subject_name, queries, output_name, num_pairs=5):
-    """同じもの同士の比較画像を作成"""
-    base_path = Path("downloaded_images")
-    temp_a = base_path / "temp_a"
-    output_path = base_path / "same"
-    
-    clear_temp_folders()
+    キャッシュに十分な枚数があればクロールしない。
+    キャッシュは動物ごとに分かれているので、別スレッドから同時に呼んでも安全。
+    """
+    cache_dir = CACHE_DIR / key
+    cache_dir.mkdir(parents=True, exist_ok=True)
     
-    print(f"\n[同じもの] {subject_name} × {subject_name}")
-    print("-" * 40)
+    if len(list(cache_dir.glob("*.jpg"))) < num_images:
+        for query in queries:
+            download_with_icrawler(query, cache_dir, num_images=num_images + 5)
     
-    print(f"画像をダウンロード中...")
-    for query in queries:
-        download_with_icrawler(query, temp_a, num_images=num_pairs * 2 + 5)
+    return sorted(cache_dir.glob("*.jpg"))
+
+
+def crawl_animals(animals, num_images, max_workers=CRAWL_WORKERS):
+    """複数の動物を並列でクロール（各動物1回だけ）
+
+    animals: {key: {"name_ja": ..., "queries": [...]}}
+    戻り値: {key: [画像パス, ...]}
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(crawl_animal, key, data["queries"], num_images): key
+            for key, data in animals.items()
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                print(f"  ✗ クロール失敗 ({key}): {e}")
+                results[key] = []
+            print(f"  ✓ {animals[key]['name_ja']}: {len(results[key])}枚")
+    return results
+
+
+def create_same_images(subject_name, images, output_name, num_pairs=5):
+    """同じもの同士の比較画像を作成"""
+    output_path = BASE_DIR / "same"
     
-    print(f"画像を合成中...")
-    images = list(temp_a.glob("*.jpg"))
-    random.shuffle(images)
+    images = random.sample(images, len(images))
     
     existing = list(output_path.glob(f"{output_name}_*.jpg"))
     start_index = len(existing) + 1
@@ -160,34 +311,16 @@ def create_same_images(subject_name, queries, output_name, num_pairs=5):
             created += 1
             print(f"  ✓ 作成: {output_file.name}")
     
-    print(f"\n✓ {created}枚の「同じもの」画像を作成: {output_path}")
+    print(f"✓ {created}枚の「同じもの」画像を作成: {subject_name} × {subject_name}")
     return created
 
 
-def create_different_images(name_a, queries_a, name_b, queries_b, output_name, num_pairs=5):
+def create_different_images(name_a, images_a, name_b, images_b, output_name, num_pairs=5):
     """違うもの同士の比較画像を作成"""
-    base_path = Path("downloaded_images")
-    temp_a = base_path / "temp_a"
-    temp_b = base_path / "temp_b"
-    output_path = base_path / "different"
-    
-    clear_temp_folders()
+    output_path = BASE_DIR / "different"
     
-    print(f"\n[違うもの] {name_a} × {name_b}")
-    print("-" * 40)
-    
-    print(f"1つ目（{name_a}）をダウンロード中...")
-    for query in queries_a:
-        download_with_icrawler(query, temp_a, num_images=num_pairs + 3)
-    
-    print(f"2つ目（{name_b}）をダウンロード中...")
-    for query in queries_b:
-        download_with_icrawler(query, temp_b, num_images=num_pairs + 3)
-    
-    print(f"画像を合成中...")
-    
-    images_a = sorted(temp_a.glob("*.jpg"))[:num_pairs]
-    images_b = sorted(temp_b.glob("*.jpg"))[:num_pairs]
+    images_a = random.sample(images_a, min(num_pairs, len(images_a)))
+    images_b = random.sample(images_b, min(num_pairs, len(images_b)))
     
     existing = list(output_path.glob(f"{output_name}_*.jpg"))
     start_index = len(existing) + 1
@@ -200,7 +333,40 @@ def create_different_images(name_a, queries_a, name_b, queries_b, output_name, n
             created += 1
             print(f"  ✓ 作成: {output_file.name}")
     
-    print(f"\n✓ {created}枚の「違うもの」画像を作成: {output_path}")
+    print(f"✓ {created}枚の「違うもの」画像を作成: {name_a} × {name_b}")
+    return created
+
+
+def create_pair_images(pairs, animals, num_pairs=5, max_workers=COMPOSE_WORKERS):
+    """ペアの比較画像をまとめて作成
+
+    1. ペアに登場する動物をそれぞれ1回だけ並列クロール
+    2. キャッシュから「同じもの」（動物ごと）と「違うもの」（ペアごと）を並列合成
+    出力ファイル名はジョブごとに異なるので、合成を並列にしても衝突しない。
+    """
+    keys = list(dict.fromkeys(key for pair in pairs for key in pair))
+    
+    print(f"\n画像をダウンロード中... ({len(keys)}種類)")
+    images = crawl_animals({key: animals[key] for key in keys}, num_pairs * 2)
+    
+    print("\n画像を合成中...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for key in keys:
+            futures.append(executor.submit(
+                create_same_images,
+                animals[key]["name_ja"], images[key], f"{key}_same", num_pairs
+            ))
+        for a, b in pairs:
+            futures.append(executor.submit(
+                create_different_images,
+                animals[a]["name_ja"], images[a],
+                animals[b]["name_ja"], images[b],
+                f"{a}_{b}_diff", num_pairs
+            ))
+        created = sum(future.result() for future in futures)
+    
+    print(f"\n✓ 合計 {created}枚の比較画像を作成しました")
     return created
 
 
@@ -262,50 +428,23 @@ def download_animal_test_set():
     if choice == "1":
         pair_num = int(input("ペア番号 (1-10): ")) - 1
         if 0 <= pair_num < len(SIMILAR_PAIRS):
-            a, b = SIMILAR_PAIRS[pair_num]
             num = int(input("各カテゴリの枚数 (推奨: 3-5): ") or "3")
-            
-            data_a = ANIMAL_DATA[a]
-            data_b = ANIMAL_DATA[b]
-            
-            create_same_images(data_a["name_ja"], data_a["queries"], f"{a}_same", num)
-            create_same_images(data_b["name_ja"], data_b["queries"], f"{b}_same", num)
-            create_different_images(
-                data_a["name_ja"], data_a["queries"],
-                data_b["name_ja"], data_b["queries"],
-                f"{a}_{b}_diff", num
-            )
+            create_pair_images([SIMILAR_PAIRS[pair_num]], ANIMAL_DATA, num)
     
     elif choice == "2":
         num = int(input("各カテゴリの枚数 (推奨: 2-3): ") or "2")
-        
-        for a, b in SIMILAR_PAIRS:
-            data_a = ANIMAL_DATA[a]
-            data_b = ANIMAL_DATA[b]
-            
-            print(f"\n{'='*50}")
-            print(f"処理中: {data_a['name_ja']} vs {data_b['name_ja']}")
-            print('='*50)
-            
-            create_same_images(data_a["name_ja"], data_a["queries"], f"{a}_same", num)
-            create_same_images(data_b["name_ja"], data_b["queries"], f"{b}_same", num)
-            create_different_images(
-                data_a["name_ja"], data_a["queries"],
-                data_b["name_ja"], data_b["queries"],
-                f"{a}_{b}_diff", num
-            )
+        create_pair_images(SIMILAR_PAIRS, ANIMAL_DATA, num)
     
     elif choice == "3":
         name_a = input("1つ目の動物（英語、例: cat）: ").strip()
         name_b = input("2つ目の動物（英語、例: dog）: ").strip()
         num = int(input("各カテゴリの枚数: ") or "3")
         
-        queries_a = [f"{name_a} face close up", f"{name_a} portrait"]
-        queries_b = [f"{name_b} face close up", f"{name_b} portrait"]
-        
-        create_same_images(name_a, queries_a, f"{name_a}_same", num)
-        create_same_images(name_b, queries_b, f"{name_b}_same", num)
-        create_different_images(name_a, queries_a, name_b, queries_b, f"{name_a}_{name_b}_diff", num)
+        animals = {
+            name: {"name_ja": name, "queries": [f"{name} face close up", f"{name} portrait"]}
+            for name in (name_a, name_b)
+        }
+        create_pair_images([(name_a, name_b)], animals, num)
 
 
 def download_people_images():
@@ -320,7 +459,8 @@ def download_people_images():
     print("3. 両方ダウンロード")
     
     choice = input("\n番号: ").strip()
-    base_path = Path("downloaded_images")
+    base_path = BASE_DIR
+    output_dirs = []
     
     if choice in ["1", "3"]:
         print("\n[双子の画像]")
@@ -333,6 +473,7 @@ def download_people_images():
         output_dir = base_path / "twins"
         for query in queries:
             download_with_icrawler(query, output_dir, num_images=num // 2 + 2)
+        output_dirs.append(output_dir)
     
     if choice in ["2", "3"]:
         print("\n[似ている人の画像]")
@@ -345,11 +486,23 @@ def download_people_images():
         output_dir = base_path / "similar_people"
         for query in queries:
             download_with_icrawler(query, output_dir, num_images=num // 2 + 2)
+        output_dirs.append(output_dir)
+    
+    # 顔と被写体のボックス（切り抜き用）を .boxes.json に保存
+    if output_dirs:
+        boxer = SubjectBoxer()
+        try:
+            for output_dir in output_dirs:
+                if output_dir.exists():
+                    count = boxer.update_dir(output_dir, faces=True)
+                    print(f"  {output_dir.name}: {count}枚の顔・被写体のボックスを保存しました")
+        finally:
+            boxer.close()
 
 
 def show_statistics():
     """ダウンロードした画像の統計を表示"""
-    base_path = Path("downloaded_images")
+    base_path = BASE_DIR
     
     if not base_path.exists():
         print("画像フォルダがありません")
@@ -359,12 +512,14 @@ def show_statistics():
     print("ダウンロード済み画像の統計")
     print("="*50)
     
+    index = get_index(base_path)
     total = 0
-    for folder in sorted(base_path.iterdir()):
-        if folder.is_dir() and not folder.name.startswith("temp"):
-            count = len(list(folder.glob("*.jpg"))) + len(list(folder.glob("*.png")))
+    for folder in index.list_subdirs(base_path):
+        if folder.name != "cache":
+            count = index.count_images(folder)
             total += count
             print(f"  {folder.name}: {count}枚")
+    index.save()
     
     print("-"*30)
     print(f"  合計: {total}枚")
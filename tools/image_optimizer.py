@@ -0,0 +1,317 @@
+"""
+保存した JPEG の最適化（メタデータの削除・ハフマンテーブルの最適化・sRGB への変換）
+
+ダウンロードした画像は、取得元が配信したままの EXIF・GPS・ICC プロファイル・サムネイル・
+標準ハフマンテーブルを含んでいる。ZIP に入れる前に、見た目を変えずに小さくする。
+
+画素を変えない場合（向きが正しく、sRGB の画像）は可逆に処理する:
+- jpegtran があれば -copy none -optimize で再圧縮し、プログレッシブの方が小さければそちらを使う
+  （係数はそのままなので画質は変わらない）
+- jpegtran が無ければ、JPEG のマーカーを読んで不要なセグメント（APP1〜APP15、COM）だけを取り除く
+
+画素を変える必要がある場合は Pillow で読み直して保存する（元の量子化テーブルと
+サブサンプリングを引き継ぐので、見た目はほぼ変わらない）:
+- EXIF の Orientation が 1 以外 → 回転・反転してから保存（jpegtran があり、
+  MCU 境界で割り切れるサイズなら jpegtran で可逆に回転する）
+- sRGB 以外の ICC プロファイル・CMYK → sRGB に変換
+
+処理済みの画像は .sources.json に optimized と元のハッシュ（original_md5）を記録し、
+二度は処理しない（重複チェックでは元のハッシュも使う）。
+
+画像ごとの処理はプロセスプールで並列に行う。
+
+使い方:
+  optimizer = ImageOptimizer(OUTPUT_DIR)
+  optimizer.optimize_item("dogs", OUTPUT_DIR / "dogs" / "shiba")
+  optimizer.close()
+  print_optimize_report(optimizer.stats)
+"""
+
+import io
+import os
+import shutil
+import hashlib
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageOps, JpegImagePlugin
+
+try:
+    from PIL import ImageCms
+    SRGB_PROFILE = ImageCms.createProfile("sRGB")
+except ImportError:  # LittleCMS なしでビルドされた Pillow
+    ImageCms = None
+    SRGB_PROFILE = None
+
+from dir_index import get_index
+from manifest_writer import load_sources, update_image_sources, write_bytes_atomic
+
+
+OPTIMIZE_WORKERS = os.cpu_count() or 1  # プロセス数
+JPEGTRAN = shutil.which("jpegtran")
+JPEGTRAN_TIMEOUT = 30
+EXIF_ORIENTATION = 0x0112
+
+# Orientation → jpegtran の変換オプション
+JPEGTRAN_TRANSFORMS = {
+    2: ["-flip", "horizontal"],
+    3: ["-rotate", "180"],
+    4: ["-flip", "vertical"],
+    5: ["-transpose"],
+    6: ["-rotate", "90"],
+    7: ["-transverse"],
+    8: ["-rotate", "270"],
+}
+
+
+@dataclass
+class OptimizeResult:
+    """画像1枚分の結果"""
+    path: str
+    before: int
+    after: int
+    method: str                     # jpegtran / strip / reencode / unchanged / error
+    original_md5: Optional[str] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class OptimizeStats:
+    """ジャンル1つ分の集計"""
+    files: int = 0
+    changed: int = 0
+    errors: int = 0
+    before_bytes: int = 0
+    after_bytes: int = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.before_bytes - self.after_bytes
+
+    def add(self, result: OptimizeResult):
+        if result.method == "error":
+            self.errors += 1
+            return
+        self.files += 1
+        self.changed += int(result.method != "unchanged")
+        self.before_bytes += result.before
+        self.after_bytes += result.after
+
+
+# =============================================================================
+# 1枚の最適化（プロセスプールで実行される）
+# =============================================================================
+
+def strip_metadata(data: bytes) -> bytes:
+    """JPEG から APP1〜APP15（Adobe の APP14 を除く）と COM を取り除く（可逆）
+
+    APP0 は JFIF のみ残す（JFXX のサムネイルは削除）。
+    """
+    if data[:2] != b"\xff\xd8":
+        raise ValueError("not a JPEG")
+    out = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError(f"invalid marker at {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # 埋め草
+            pos += 1
+            continue
+        if marker == 0xDA:  # SOS 以降は画像データ
+            out.append(data[pos:])
+            return b"".join(out)
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # 長さを持たないマーカー
+            out.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        segment = data[pos:pos + 2 + length]
+        if marker == 0xE0:
+            keep = segment[4:9] == b"JFIF\0"
+        else:
+            keep = not (0xE1 <= marker <= 0xEF or marker == 0xFE) or marker == 0xEE
+        if keep:
+            out.append(segment)
+        pos += 2 + length
+    raise ValueError("no SOS marker")
+
+
+def _is_srgb(icc: bytes) -> bool:
+    """ICC プロファイルが sRGB か（読めない場合は sRGB とみなす）"""
+    if ImageCms is None:
+        return True
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc))
+        return "srgb" in ImageCms.getProfileDescription(profile).lower()
+    except Exception:
+        return True
+
+
+def _jpegtran(data: bytes, orientation: int) -> Optional[bytes]:
+    """jpegtran で可逆に再圧縮（ベースライン・プログレッシブの小さい方）。失敗したらNone"""
+    transform = JPEGTRAN_TRANSFORMS.get(orientation, [])
+    if transform:
+        transform = transform + ["-perfect"]  # 割り切れないサイズは失敗させて Pillow に任せる
+    best = None
+    for mode in (["-optimize"], ["-optimize", "-progressive"]):
+        try:
+            proc = subprocess.run([JPEGTRAN, "-copy", "none", *mode, *transform],
+                                  input=data, capture_output=True, timeout=JPEGTRAN_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        if proc.returncode != 0 or not proc.stdout:
+            return None
+        if best is None or len(proc.stdout) < len(best):
+            best = proc.stdout
+    return best
+
+
+def _reencode(img: Image.Image, orientation: int, icc: Optional[bytes], convert_color: bool) -> bytes:
+    """向きと色を直して保存（元の量子化テーブル・サブサンプリングを引き継ぐ）"""
+    qtables = getattr(img, "quantization", None) or None
+    subsampling = JpegImagePlugin.get_sampling(img)
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+    if convert_color:
+        if icc and ImageCms is not None:
+            img = ImageCms.profileToProfile(img, ImageCms.ImageCmsProfile(io.BytesIO(icc)),
+                                            SRGB_PROFILE, outputMode="RGB")
+        else:
+            img = img.convert("RGB")
+
+    options = {"optimize": True, "comment": b""}  # Pillow は元の COM を引き継ぐので空にする
+    if qtables:
+        options["qtables"] = qtables
+    if subsampling != -1:
+        options["subsampling"] = subsampling
+    best = None
+    for progressive in (False, True):
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", progressive=progressive, **options)
+        if best is None or buf.tell() < len(best):
+            best = buf.getvalue()
+    return best
+
+
+def optimize_jpeg_bytes(data: bytes) -> Tuple[Optional[bytes], str]:
+    """JPEG を最適化する。戻り値は（新しい内容、方法）。変える必要が無ければ（None, "unchanged"）"""
+    with Image.open(io.BytesIO(data)) as img:
+        if img.format != "JPEG":
+            return None, "unchanged"
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        if orientation not in JPEGTRAN_TRANSFORMS:
+            orientation = 1
+        icc = img.info.get("icc_profile")
+        convert_color = img.mode not in ("RGB", "L") or (icc is not None and not _is_srgb(icc))
+
+        if not convert_color:
+            optimized = _jpegtran(data, orientation) if JPEGTRAN else None
+            if optimized is not None:
+                if orientation != 1 or len(optimized) < len(data):
+                    return optimized, "jpegtran"
+                return None, "unchanged"
+            if orientation == 1:
+                stripped = strip_metadata(data)
+                return (stripped, "strip") if len(stripped) < len(data) else (None, "unchanged")
+
+        # 向きか色を直す必要がある（画素が変わるので、大きくなっても置き換える）
+        img.load()
+        return _reencode(img, orientation, icc, convert_color), "reencode"
+
+
+def optimize_file(path: str) -> OptimizeResult:
+    """画像ファイル1つを最適化して置き換える（プロセスプールのワーカーで実行）"""
+    try:
+        data = Path(path).read_bytes()
+    except OSError as e:
+        return OptimizeResult(path, 0, 0, "error", error=str(e))
+    result = OptimizeResult(path, len(data), len(data), "unchanged",
+                            original_md5=hashlib.md5(data).hexdigest()[:16])
+    try:
+        optimized, method = optimize_jpeg_bytes(data)
+        if optimized is not None:
+            write_bytes_atomic(Path(path), optimized)
+            result.after = len(optimized)
+            result.method = method
+    except Exception as e:
+        result.method = "error"
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+# =============================================================================
+# アイテム単位の最適化
+# =============================================================================
+
+class ImageOptimizer:
+    """アイテムフォルダ内の未処理の JPEG をプロセスプールで最適化する"""
+
+    def __init__(self, root: Path, workers: int = OPTIMIZE_WORKERS):
+        self.root = Path(root)
+        self.workers = max(1, workers)
+        self.stats: Dict[str, OptimizeStats] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 呼び出し側ではダウンロードのスレッドが動いているので fork ではなく spawn を使う
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def pending_files(self, item_dir: Path) -> List[Path]:
+        """まだ最適化していない JPEG"""
+        sources = load_sources(item_dir)
+        return [path for path in get_index(self.root).list_images(item_dir)
+                if path.suffix.lower() in (".jpg", ".jpeg")
+                and not sources.get(path.name, {}).get("optimized")]
+
+    def optimize_item(self, genre_id: str, item_dir: Path) -> OptimizeStats:
+        """アイテム1つ分を最適化し、.sources.json に記録する"""
+        item_stats = OptimizeStats()
+        files = self.pending_files(item_dir)
+        if not files:
+            return item_stats
+
+        results = list(self._get_pool().map(optimize_file, [str(p) for p in files], chunksize=4))
+        updates = {}
+        for result in results:
+            item_stats.add(result)
+            if result.method == "error":
+                print(f"    最適化に失敗: {result.path}: {result.error}")
+                continue
+            updates[Path(result.path).name] = {"optimized": True, "original_md5": result.original_md5,
+                                               "original_bytes": result.before}
+        update_image_sources(item_dir, updates)
+
+        with self._lock:
+            stats = self.stats.setdefault(genre_id, OptimizeStats())
+            for name in ("files", "changed", "errors", "before_bytes", "after_bytes"):
+                setattr(stats, name, getattr(stats, name) + getattr(item_stats, name))
+        return item_stats
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def print_optimize_report(stats: Dict[str, OptimizeStats]):
+    """ジャンルごとの削減量を表示"""
+    stats = {g: s for g, s in stats.items() if s.files or s.errors}
+    if not stats:
+        return
+    print(f"  画像の最適化（{'jpegtran' if JPEGTRAN else 'jpegtran なし: ハフマンテーブルの最適化は省略'}）:")
+    for genre_id, s in sorted(stats.items()):
+        ratio = s.saved_bytes / s.before_bytes * 100 if s.before_bytes else 0.0
+        errors = f" / 失敗 {s.errors}枚" if s.errors else ""
+        print(f"    {genre_id:<15} {s.changed}/{s.files}枚 {s.before_bytes / 2**20:.1f} MB → "
+              f"{s.after_bytes / 2**20:.1f} MB（-{s.saved_bytes / 1024:.0f} KB, -{ratio:.1f}%）{errors}")
@@ -0,0 +1,160 @@
+"""
+段階ごとに並列数を決められるパイプライン（同期・スレッド版）
+
+各ステージは「タスクを1つ受け取り、次のステージへ渡すタスクを yield するジェネレータ関数」。
+ステージの間は上限付きのキューでつなぐので、
+- 遅いステージ（デコードなどCPU処理）があっても、その前のステージ（ネットワーク）は
+  キューが埋まるまでは止まらない
+- キューが埋まると前のステージが待つ（バックプレッシャー）ため、メモリ使用量は
+  キューの深さで頭打ちになる
+- ステージごとの処理件数・処理時間・スループットを集計できる
+- --profile 指定時は、タスク1件ごとの処理がステージ名のスパンとして記録される
+
+使い方:
+  def fetch(url):
+      data = download(url)
+      if data:
+          yield data
+
+  pipeline = Pipeline([Stage("fetch", fetch, workers=8), Stage("save", save)])
+  stats = pipeline.run(urls)
+  print_stage_stats(stats)
+
+ステージ内で例外が起きた場合はそのタスクだけを捨てて処理を続け、
+最後に最初の例外を送出する（途中でスレッドが止まってキューが詰まることはない）。
+"""
+
+import time
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional
+
+from profiling import span
+
+
+QUEUE_SIZE = 16  # ステージ間のキューの深さ（省略時）
+
+_STOP = object()  # 入力の終わり
+
+
+@dataclass
+class StageStats:
+    """ステージ1つ分の集計"""
+    name: str
+    workers: int
+    tasks_in: int = 0
+    tasks_out: int = 0
+    errors: int = 0
+    busy_sec: float = 0.0      # 全ワーカーの処理時間の合計
+    wall_sec: float = 0.0      # 最初のタスクから最後のタスクまで
+    max_queue_depth: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """1秒あたりの処理件数（ステージ全体）"""
+        return self.tasks_in / self.wall_sec if self.wall_sec > 0 else 0.0
+
+
+class Stage:
+    """パイプラインの1段"""
+
+    def __init__(self, name: str, func: Callable[[object], Optional[Iterable]],
+                 workers: int = 1, queue_size: int = QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self.stats = StageStats(name, self.workers)
+        self._lock = threading.Lock()
+        self._first_started: Optional[float] = None
+        self._last_finished: Optional[float] = None
+
+    def _record(self, started: float, outputs: int, failed: bool):
+        finished = time.perf_counter()
+        with self._lock:
+            stats = self.stats
+            stats.tasks_in += 1
+            stats.tasks_out += outputs
+            stats.errors += int(failed)
+            stats.busy_sec += finished - started
+            if self._first_started is None or started < self._first_started:
+                self._first_started = started
+            self._last_finished = finished
+            stats.wall_sec = self._last_finished - self._first_started
+
+    def put(self, task):
+        self.queue.put(task)
+        depth = self.queue.qsize()
+        with self._lock:
+            if depth > self.stats.max_queue_depth:
+                self.stats.max_queue_depth = depth
+
+
+class Pipeline:
+    """ステージを上限付きキューでつないで実行する"""
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self._errors: List[BaseException] = []
+        self._errors_lock = threading.Lock()
+
+    def _worker(self, index: int):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            task = stage.queue.get()
+            if task is _STOP:
+                return
+            started = time.perf_counter()
+            outputs = 0
+            failed = False
+            try:
+                with span(stage.name, cat="pipeline"):
+                    for out in stage.func(task) or ():
+                        outputs += 1
+                        if next_stage is not None:
+                            next_stage.put(out)
+            except Exception as e:
+                failed = True
+                with self._errors_lock:
+                    self._errors.append(e)
+                print(f"  [{stage.name}] error: {e}")
+            stage._record(started, outputs, failed)
+
+    def run(self, source: Iterable) -> List[StageStats]:
+        """source のタスクを最初のステージに流し、全ステージが終わるまで待つ"""
+        self._errors = []
+        threads: List[List[threading.Thread]] = []
+        for i, stage in enumerate(self.stages):
+            stage_threads = [
+                threading.Thread(target=self._worker, args=(i,), name=f"{stage.name}-{n}", daemon=True)
+                for n in range(stage.workers)
+            ]
+            for t in stage_threads:
+                t.start()
+            threads.append(stage_threads)
+
+        try:
+            for task in source:
+                self.stages[0].put(task)
+        finally:
+            # 前のステージが全部終わってから、次のステージに終わりを伝える
+            for stage, stage_threads in zip(self.stages, threads):
+                for _ in stage_threads:
+                    stage.queue.put(_STOP)
+                for t in stage_threads:
+                    t.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return [stage.stats for stage in self.stages]
+
+
+def print_stage_stats(stats: List[StageStats]):
+    """ステージごとの集計を表示"""
+    print(f"  {'stage':<10} {'workers':>7} {'in':>6} {'out':>6} {'err':>4} "
+          f"{'busy(s)':>8} {'wall(s)':>8} {'tasks/s':>8} {'max q':>6}")
+    for s in stats:
+        print(f"  {s.name:<10} {s.workers:>7} {s.tasks_in:>6} {s.tasks_out:>6} {s.errors:>4} "
+              f"{s.busy_sec:>8.1f} {s.wall_sec:>8.1f} {s.throughput:>8.1f} {s.max_queue_depth:>6}")
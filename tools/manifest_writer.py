@@ -0,0 +1,335 @@
+"""
+テストセットの manifest.json 書き込み
+
+- 一時ファイルに書いてから os.replace するので、途中で落ちても
+  壊れた manifest.json が残らない（クライアントの loadManifest が失敗しない）
+- 前回の manifest.json から変わっていない画像は読み直さない（ハッシュを再計算しない）
+- タイプごとに画像単位のエントリ（ファイル名・SHA-256・バイト数・サイズ・取得元・ライセンス）を持つ
+- オプションでクライアント向けのコンパクトなバイナリ版（manifest.bin）も書き出す
+
+manifest.json（version 2）:
+  {
+    "version": 2,
+    "genre": "dogs",
+    ...
+    "types": {
+      "shiba": {
+        "display_name": "柴犬",
+        "count": 2,
+        "images": [
+          {"file": "001.jpg", "sha256": "...", "bytes": 52311, "width": 500, "height": 375,
+           "source": "https://...", "license_url": "https://creativecommons.org/licenses/by-nc/4.0/",
+           "subject_box": [40, 12, 410, 350], "faces": [[120, 60, 80, 80]]},
+          ...
+        ]
+      }
+    },
+    "similar_pairs": [...]
+  }
+
+画像の取得元とライセンスは、ダウンロード時に record_image_source で
+各タイプフォルダの .sources.json に記録したものを使う。
+subject_box / faces（切り抜き用のボックス、[x, y, w, h]）は subject_boxes.py が
+.boxes.json に記録したもので、画像のハッシュが一致する場合だけ入る。
+"""
+
+import os
+import json
+import time
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from PIL import Image
+
+from dir_index import DirIndex, get_index
+
+
+MANIFEST_VERSION = 2
+MANIFEST_FILENAME = "manifest.json"
+BINARY_MANIFEST_FILENAME = "manifest.bin"
+SOURCES_FILENAME = ".sources.json"
+BOXES_FILENAME = ".boxes.json"
+AUTO_PAIRS_FILENAME = ".similar_pairs.json"   # confusability.py が特徴量から求めた similar_pairs
+
+# manifest.bin の形式（リトルエンディアン）
+#   ヘッダ:   magic "SQMF" / u16 version / u16 タイプ数
+#   タイプ:   str タイプID / u32 画像数
+#   画像:     str ファイル名 / 32バイト SHA-256 / u32 バイト数 / u16 幅 / u16 高さ
+#   str は u16 の長さ + UTF-8
+BINARY_MAGIC = b"SQMF"
+
+_sources_lock = threading.Lock()
+
+
+def write_json_atomic(path: Path, data) -> None:
+    """JSONを一時ファイルに書いてからリネームで置き換える"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_bytes_atomic(path: Path, data: bytes) -> None:
+    """バイト列を一時ファイルに書いてからリネームで置き換える"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def file_lock(path: Path):
+    """path に対するプロセス間の排他ロック（{path}.lock を使う）"""
+    lock_path = path.with_name(path.name + ".lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def update_json_locked(path: Path, update: Callable[[dict], dict]) -> dict:
+    """ロックを取ってから読み直し、update(今の内容) を書き込む
+
+    複数のワーカーが同じファイルを更新しても、他のワーカーが書いた内容を消さないように使う。
+    """
+    with file_lock(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                current = json.load(f)
+        except (OSError, ValueError):
+            current = {}
+        if not isinstance(current, dict):
+            current = {}
+        data = update(current)
+        write_json_atomic(path, data)
+    return data
+
+
+def load_manifest(genre_dir: Path) -> Optional[dict]:
+    """manifest.json を読み込む（無い・壊れている場合はNone）"""
+    try:
+        with open(genre_dir / MANIFEST_FILENAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_sources(item_dir: Path) -> Dict[str, dict]:
+    """タイプフォルダの .sources.json を読み込む"""
+    try:
+        with open(item_dir / SOURCES_FILENAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_boxes(item_dir: Path) -> Dict[str, dict]:
+    """タイプフォルダの .boxes.json を読み込む"""
+    try:
+        with open(item_dir / BOXES_FILENAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_auto_pairs(genre_dir: Path) -> List[dict]:
+    """ジャンルフォルダの .similar_pairs.json を読み込む"""
+    try:
+        with open(genre_dir / AUTO_PAIRS_FILENAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def merge_similar_pairs(curated: List[dict], auto: List[dict], type_ids) -> List[dict]:
+    """GenreInfo の similar_pairs の後ろに、自動生成の組（重複と存在しないタイプを除く）を足す"""
+    merged = list(curated)
+    seen = {frozenset((p["id1"], p["id2"])) for p in curated}
+    for pair in auto:
+        key = frozenset((pair["id1"], pair["id2"]))
+        if key in seen or pair["id1"] not in type_ids or pair["id2"] not in type_ids:
+            continue
+        seen.add(key)
+        merged.append({"id1": pair["id1"], "id2": pair["id2"], "score": pair.get("score"), "source": "auto"})
+    return merged
+
+
+def _with_boxes(entry: dict, boxes: Dict[str, dict]) -> dict:
+    """画像エントリに切り抜き用のボックスを入れる（ハッシュが一致しなければ外す）"""
+    entry = {k: v for k, v in entry.items() if k not in ("subject_box", "faces")}
+    box = boxes.get(entry["file"])
+    if box and box.get("sha256") == entry["sha256"] and "subject" in box:
+        entry["subject_box"] = box["subject"]
+        if "faces" in box:
+            entry["faces"] = box["faces"]
+    return entry
+
+
+def record_image_source(item_dir: Path, filename: str, source: str,
+                        license_url: Optional[str] = None, quality: Optional[float] = None) -> None:
+    """ダウンロードした画像の取得元URLとライセンス（品質で選んだ場合はスコアも）を記録"""
+    with _sources_lock:
+        sources = load_sources(item_dir)
+        sources[filename] = {"source": source, "license_url": license_url}
+        if quality is not None:
+            sources[filename]["quality"] = round(quality, 3)
+        write_json_atomic(item_dir / SOURCES_FILENAME, sources)
+
+
+def update_image_sources(item_dir: Path, updates: Dict[str, dict]) -> None:
+    """画像ごとの記録に項目を追加（最適化済みの印など）"""
+    if not updates:
+        return
+    with _sources_lock:
+        sources = load_sources(item_dir)
+        for filename, fields in updates.items():
+            sources[filename] = {**sources.get(filename, {}), **fields}
+        write_json_atomic(item_dir / SOURCES_FILENAME, sources)
+
+
+def build_image_entry(path: Path, sources: Dict[str, dict]) -> dict:
+    """画像1枚分のエントリを作成（ハッシュとサイズを計算）"""
+    data = path.read_bytes()
+    width = height = None
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+    except Exception:
+        pass
+
+    source = sources.get(path.name, {})
+    return {
+        "file": path.name,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "bytes": len(data),
+        "width": width,
+        "height": height,
+        "source": source.get("source"),
+        "license_url": source.get("license_url"),
+    }
+
+
+def build_type_entry(index: DirIndex, item_dir: Path, display_name: str,
+                     previous: Optional[dict], since_ns: int) -> dict:
+    """タイプ1つ分のエントリを作成
+
+    since_ns（前回の manifest.json を作り始めた時刻）より後に変更されていない画像は
+    前回のエントリをそのまま使う。
+    """
+    files = index.list_images(item_dir)
+    prev_images = {e["file"]: e for e in (previous or {}).get("images", [])}
+
+    sources = load_sources(item_dir)
+    boxes = load_boxes(item_dir)
+    images = []
+    for path in files:
+        prev = prev_images.get(path.name)
+        st = path.stat()
+        if prev and st.st_mtime_ns < since_ns and st.st_size == prev.get("bytes"):
+            source = sources.get(path.name, {})
+            entry = {**prev, "source": source.get("source", prev.get("source")),
+                     "license_url": source.get("license_url", prev.get("license_url"))}
+        else:
+            entry = build_image_entry(path, sources)
+        images.append(_with_boxes(entry, boxes))
+
+    return {
+        **(previous or {}),
+        "display_name": display_name,
+        "count": len(images),
+        "images": images,
+    }
+
+
+def encode_binary_manifest(manifest: dict) -> bytes:
+    """manifest をコンパクトなバイナリ形式に変換"""
+    def pack_str(value: str) -> bytes:
+        raw = value.encode("utf-8")
+        return struct.pack("<H", len(raw)) + raw
+
+    types = manifest.get("types", {})
+    parts = [BINARY_MAGIC, struct.pack("<HH", MANIFEST_VERSION, len(types))]
+    for type_id, info in types.items():
+        images = info.get("images", [])
+        parts.append(pack_str(type_id))
+        parts.append(struct.pack("<I", len(images)))
+        for image in images:
+            parts.append(pack_str(image["file"]))
+            parts.append(bytes.fromhex(image["sha256"]))
+            parts.append(struct.pack(
+                "<IHH",
+                image["bytes"],
+                min(image.get("width") or 0, 0xFFFF),
+                min(image.get("height") or 0, 0xFFFF),
+            ))
+    return b"".join(parts)
+
+
+def write_manifest(genre_dir: Path, header: dict, types: List[tuple],
+                   similar_pairs: List[dict], write_binary: bool = False) -> dict:
+    """manifest.json を差分更新してアトミックに書き込む
+
+    header: genre, display_name, description
+    types: [(タイプID, 表示名), ...]
+    similar_pairs: GenreInfo の組。.similar_pairs.json があれば、その組を後ろに足す
+    write_binary: manifest.bin も書く（既に manifest.bin があれば、False でも書き直して manifest.json とそろえる）
+
+    書き込み後、manifest.json の mtime を作成開始時刻に戻しておき、
+    次回はそれより後に変更された画像だけを読み直す。
+    """
+    started_ns = time.time_ns()
+    index = get_index(genre_dir.parent)
+    manifest_path = genre_dir / MANIFEST_FILENAME
+    previous = load_manifest(genre_dir) or {}
+    if previous.get("version") != MANIFEST_VERSION:
+        previous = {}
+    try:
+        since_ns = manifest_path.stat().st_mtime_ns if previous else 0
+    except OSError:
+        since_ns = 0
+
+    prev_types = previous.get("types", {})
+    manifest = {"version": MANIFEST_VERSION, **header, "types": {}}
+    for type_id, display_name in types:
+        manifest["types"][type_id] = build_type_entry(
+            index, genre_dir / type_id, display_name, prev_types.get(type_id), since_ns
+        )
+    manifest["similar_pairs"] = merge_similar_pairs(
+        similar_pairs, load_auto_pairs(genre_dir), manifest["types"]
+    )
+
+    if manifest != previous:
+        write_json_atomic(manifest_path, manifest)
+    os.utime(manifest_path, ns=(started_ns, started_ns))
+    binary_path = genre_dir / BINARY_MANIFEST_FILENAME
+    if write_binary or binary_path.exists():
+        # 古い manifest.bin が残ると、manifest.json と食い違ったまま ZIP に入ってしまう
+        write_bytes_atomic(binary_path, encode_binary_manifest(manifest))
+
+    index.save()
+    return manifest
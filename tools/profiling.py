@@ -0,0 +1,193 @@
+"""
+処理時間の計測（Chrome trace-event 形式）
+
+--profile を指定したときだけ有効になる。各処理の開始・終了を「スパン」として記録し、
+Chrome の chrome://tracing や Perfetto（https://ui.perfetto.dev）で開ける JSON に書き出す。
+
+- span(name)           with で囲んだ区間を記録（無効時はほぼコストなし）
+- instrument(obj, ...) 関数・メソッドを後から包んで自動で記録する（コードに手を入れずに済む）
+- cProfile             指定した名前のスパンの間だけ cProfile を有効にし、.prof に書き出す
+                       （スレッドごとに計測して最後にまとめる。snakeviz などで開ける）
+- tracemalloc          有効にすると、メモリ使用量をカウンターとしてトレースに記録し、
+                       最後に割り当ての多い箇所の一覧を書き出す
+
+使い方:
+  enable_profiling(Path("trace.json"), cprofile_spans={"decode"}, trace_memory=True)
+  instrument(zipfile.ZipFile, "write", cat="zip")
+  with span("build", cat="stage", genre="dogs"):
+      ...
+  finish_profiling()  # trace.json / trace.prof / trace.allocs.txt を書き出す
+"""
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+
+TOP_ALLOCATIONS = 30  # 割り当ての多い箇所を何件書き出すか
+
+
+class Tracer:
+    """スパンの記録先"""
+
+    def __init__(self, output: Path, cprofile_spans: Optional[Set[str]] = None,
+                 trace_memory: bool = False):
+        self.output = Path(output)
+        self.cprofile_spans = set(cprofile_spans or ())
+        self.trace_memory = trace_memory
+        self.pid = os.getpid()
+        self.started = time.perf_counter()
+        self._events: List[dict] = []
+        self._threads: Dict[int, str] = {}
+        self._profiles: Dict[int, cProfile.Profile] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _ts(self, t: float) -> float:
+        """トレースの時刻（マイクロ秒）"""
+        return (t - self.started) * 1e6
+
+    def add_span(self, name: str, cat: str, start: float, end: float, args: dict):
+        tid = threading.get_ident()
+        event = {"name": name, "cat": cat, "ph": "X", "pid": self.pid, "tid": tid,
+                 "ts": self._ts(start), "dur": (end - start) * 1e6}
+        if args:
+            event["args"] = {k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in args.items()}
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._threads:
+                self._threads[tid] = threading.current_thread().name
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                self._events.append({"name": "memory", "ph": "C", "pid": self.pid, "ts": self._ts(end),
+                                     "args": {"current_mb": current / 2**20, "peak_mb": peak / 2**20}})
+
+    def start_cprofile(self, name: str) -> bool:
+        """このスレッドで cProfile を開始（対象外・計測中なら何もしない）"""
+        if name not in self.cprofile_spans or getattr(self._local, "profiling", False):
+            return False
+        tid = threading.get_ident()
+        with self._lock:
+            profile = self._profiles.setdefault(tid, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:
+            return False  # 別のプロファイラが動いている（Python 3.12以降は同時に1つまで）
+        self._local.profiling = True
+        return True
+
+    def stop_cprofile(self):
+        self._profiles[threading.get_ident()].disable()
+        self._local.profiling = False
+
+    def write(self) -> List[Path]:
+        """トレース（と .prof・割り当て一覧）を書き出す"""
+        written = []
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in threads.items()]
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.output, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+        written.append(self.output)
+
+        profiles = [p for p in self._profiles.values()]
+        if profiles:
+            prof_path = self.output.with_suffix(".prof")
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(str(prof_path))
+            written.append(prof_path)
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            allocs_path = self.output.with_suffix(".allocs.txt")
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ])
+            current, peak = tracemalloc.get_traced_memory()
+            with open(allocs_path, "w", encoding="utf-8") as f:
+                f.write(f"current: {current / 2**20:.1f} MB / peak: {peak / 2**20:.1f} MB\n\n")
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+            written.append(allocs_path)
+        return written
+
+
+_tracer: Optional[Tracer] = None
+
+
+def enable_profiling(output: Path, cprofile_spans: Optional[Set[str]] = None,
+                     trace_memory: bool = False) -> Tracer:
+    """計測を有効にする"""
+    global _tracer
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _tracer = Tracer(output, cprofile_spans, trace_memory)
+    return _tracer
+
+
+def finish_profiling() -> List[Path]:
+    """計測を終了して結果を書き出す（無効なら何もしない）"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return []
+    written = tracer.write()
+    if tracer.trace_memory:
+        tracemalloc.stop()
+    return written
+
+
+def is_enabled() -> bool:
+    return _tracer is not None
+
+
+@contextmanager
+def span(name: str, cat: str = "stage", **args):
+    """with で囲んだ区間を1つのスパンとして記録"""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    profiling = tracer.start_cprofile(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if profiling:
+            tracer.stop_cprofile()
+        tracer.add_span(name, cat, start, end, args)
+
+
+def instrument(owner, attr: str, cat: str = "function", name: Optional[str] = None):
+    """owner（モジュール・クラス）の関数 attr を、呼び出しごとにスパンを記録するよう包む
+
+    計測が無効な間は元の関数をそのまま呼ぶ。同じ関数を二重には包まない。
+    """
+    func = getattr(owner, attr)
+    if getattr(func, "_profiling_wrapped", False):
+        return
+    span_name = name or attr
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+        with span(span_name, cat):
+            return func(*args, **kwargs)
+
+    wrapper._profiling_wrapped = True
+    setattr(owner, attr, wrapper)
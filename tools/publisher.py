@@ -0,0 +1,462 @@
+"""
+ZIP の公開（publish）
+
+create_all_genre_zips で作った各ジャンルの最新の ZIP を、配信先（S3 互換のストレージ、またはフォルダ）に
+アップロードする。毎回すべてのジャンルを上げ直さないよう、配信先の index.json に記録した SHA-256 と
+比べて、内容が変わった ZIP だけをアップロードする（create_genre_zip はエントリの日時を固定して書くので、
+画像と manifest が同じなら ZIP も同じバイト列になる）。
+
+配信先のレイアウト:
+  archives/{ジャンル}-{SHA-256 の先頭16桁}.zip  内容ごとのキー（一度書いたら変えない）
+  {ジャンル}.zip                                アプリが読む固定のキー（archives/ からコピー）
+  index.json                                    ジャンルごとの ZIP（testset_server の /index.json と同じ形）
+
+手順:
+  1. ローカルの ZIP の SHA-256 を並列に計算し、配信先の index.json と比べる
+  2. 変わった ZIP を並列にアップロード（MULTIPART_THRESHOLD 以上はマルチパートで、パートも並列）
+  3. アップロードした内容をサイズ・ETag（MD5）・SHA-256 で確認してから {ジャンル}.zip を差し替える
+  4. 最後に index.json を1回の PUT（フォルダなら rename）で差し替える（失敗したジャンルは前の記録のまま）
+
+S3 互換: 署名は SigV4（requests だけで実装、boto3 は不要）。パス形式の URL（{endpoint}/{bucket}/{key}）なので
+MinIO・Cloudflare R2 などにも使える。認証情報は AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY
+（/ AWS_SESSION_TOKEN）、リージョンは AWS_REGION、エンドポイントは --endpoint か S3_ENDPOINT_URL。
+ローカルで試すときは s3_standin.py を使う。
+"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import shutil
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+import requests
+
+from manifest_writer import write_bytes_atomic
+
+
+PUBLISH_WORKERS = 4        # 同時にアップロードする ZIP の数
+PART_WORKERS = 4           # ZIP 1つあたり同時にアップロードするパートの数
+MULTIPART_THRESHOLD = 16 * 1024 * 1024  # これ以上の ZIP はマルチパートでアップロード
+PART_SIZE = 8 * 1024 * 1024             # パートの大きさ（S3 の下限は 5 MiB）
+HASH_CHUNK = 1024 * 1024
+PUBLISH_RETRIES = 4        # 通信エラー・5xx・429 のときの試行回数
+RETRY_BACKOFF_SEC = 0.5    # 再試行の待ち時間（回ごとに倍）
+REQUEST_TIMEOUT = (5, 120)
+INDEX_KEY = "index.json"
+ARCHIVE_DIR = "archives"
+DEFAULT_REGION = "us-east-1"
+
+
+class PublishError(Exception):
+    pass
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def archive_key(genre_id: str, sha256: str) -> str:
+    return f"{ARCHIVE_DIR}/{genre_id}-{sha256[:16]}.zip"
+
+
+def _b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode("ascii")
+
+
+# =============================================================================
+# 配信先
+# =============================================================================
+
+class PublishTarget:
+    """配信先（キー → 内容）"""
+
+    def describe(self) -> str:
+        raise NotImplementedError
+
+    def read_index(self) -> dict:
+        """配信先の index.json（無ければ空）"""
+        raise NotImplementedError
+
+    def has(self, key: str, sha256: str) -> bool:
+        """key に同じ内容が既にあるか（前回途中で失敗した公開の続きで使う）"""
+        raise NotImplementedError
+
+    def upload(self, key: str, path: Path, sha256: str) -> None:
+        """ファイルをアップロードし、配信先の内容を確認する（合わなければ PublishError）"""
+        raise NotImplementedError
+
+    def alias(self, src_key: str, dst_key: str, sha256: str) -> None:
+        """dst_key を src_key と同じ内容にアトミックに差し替える"""
+        raise NotImplementedError
+
+    def write_index(self, data: bytes) -> None:
+        """index.json をアトミックに差し替える"""
+        raise NotImplementedError
+
+
+class DirectoryTarget(PublishTarget):
+    """フォルダ（GitHub Pages・NFS などに置く場合）。一時ファイルに書いて確認してから rename する"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def describe(self) -> str:
+        return str(self.root)
+
+    def _tmp(self, dest: Path) -> Path:
+        return dest.with_name(f".{dest.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def read_index(self) -> dict:
+        try:
+            with open(self.root / INDEX_KEY, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print(f"  WARNING: {self.root / INDEX_KEY} が読めません（全ジャンルをアップロードします）")
+            return {}
+
+    def has(self, key: str, sha256: str) -> bool:
+        path = self.root / key
+        return path.is_file() and sha256_file(path) == sha256
+
+    def upload(self, key: str, path: Path, sha256: str) -> None:
+        dest = self.root / key
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._tmp(dest)
+        try:
+            shutil.copyfile(path, tmp)
+            with open(tmp, "rb") as f:
+                os.fsync(f.fileno())
+            if sha256_file(tmp) != sha256:
+                raise PublishError(f"{key}: コピー後の SHA-256 が一致しません")
+            os.replace(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def alias(self, src_key: str, dst_key: str, sha256: str) -> None:
+        src, dest = self.root / src_key, self.root / dst_key
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._tmp(dest)
+        try:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copyfile(src, tmp)
+            os.replace(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def write_index(self, data: bytes) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        write_bytes_atomic(self.root / INDEX_KEY, data)
+
+
+def sign_v4(method: str, host: str, path: str, query: str, headers: Dict[str, str], payload_hash: str,
+            access_key: str, secret_key: str, region: str, service: str = "s3") -> str:
+    """AWS Signature Version 4 の Authorization ヘッダ（headers は x-amz-date を含むこと）"""
+    signed = {"host": host}
+    for name, value in headers.items():
+        signed[name.lower()] = " ".join(str(value).split())
+    names = sorted(signed)
+    canonical = "\n".join([
+        method, path, query,
+        "".join(f"{name}:{signed[name]}\n" for name in names),
+        ";".join(names), payload_hash,
+    ])
+    amz_date = signed["x-amz-date"]
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                hashlib.sha256(canonical.encode("utf-8")).hexdigest()])
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in (amz_date[:8], region, service, "aws4_request"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    return (f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+            f"SignedHeaders={';'.join(names)}, Signature={signature}")
+
+
+class S3Target(PublishTarget):
+    """S3 互換のストレージ（パス形式の URL、SigV4）"""
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint: Optional[str] = None,
+                 region: Optional[str] = None):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.region = region or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or DEFAULT_REGION
+        self.endpoint = (endpoint or os.environ.get("S3_ENDPOINT_URL")
+                         or f"https://s3.{self.region}.amazonaws.com").rstrip("/")
+        self.host = urlsplit(self.endpoint).netloc
+        self.access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.session_token = os.environ.get("AWS_SESSION_TOKEN")
+        if not self.access_key or not self.secret_key:
+            raise PublishError("AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY を設定してください")
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def describe(self) -> str:
+        return f"s3://{self.bucket}/{self.prefix}（{self.endpoint}）"
+
+    def _session(self) -> requests.Session:
+        """スレッドごとのセッション（接続を使い回す）"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _path(self, key: str) -> str:
+        full_key = f"{self.prefix}/{key}" if self.prefix else key
+        return f"/{self.bucket}/" + quote(full_key, safe="/-_.~")
+
+    def _request(self, method: str, key: str, params: Optional[Dict[str, object]] = None,
+                 data: bytes = b"", headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        """署名付きのリクエスト（通信エラー・5xx・429 は待ってから再試行）"""
+        path = self._path(key)
+        query = "&".join(f"{quote(str(k), safe='-_.~')}={quote(str(v), safe='-_.~')}"
+                         for k, v in sorted((params or {}).items()))
+        url = f"{self.endpoint}{path}" + (f"?{query}" if query else "")
+        payload_hash = hashlib.sha256(data).hexdigest()
+        error = ""
+        for attempt in range(PUBLISH_RETRIES):
+            if attempt:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(RETRY_BACKOFF_SEC * 2 ** (attempt - 1))
+            request_headers = {**(headers or {}),
+                               "x-amz-date": datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"),
+                               "x-amz-content-sha256": payload_hash}
+            if self.session_token:
+                request_headers["x-amz-security-token"] = self.session_token
+            request_headers["Authorization"] = sign_v4(
+                method, self.host, path, query, request_headers, payload_hash,
+                self.access_key, self.secret_key, self.region)
+            with self._lock:
+                self.requests += 1
+            try:
+                resp = self._session().request(method, url, data=data, headers=request_headers,
+                                               timeout=REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+                continue
+            if resp.status_code < 500 and resp.status_code != 429:
+                return resp
+            error = f"HTTP {resp.status_code}"
+        raise PublishError(f"{method} {key}: {error}")
+
+    @staticmethod
+    def _check(resp: requests.Response, what: str) -> requests.Response:
+        # コピー・マルチパートの完了は 200 でも本文がエラーのことがある
+        if resp.status_code >= 300 or b"<Error>" in resp.content[:200]:
+            code = ""
+            try:
+                code = ET.fromstring(resp.content).findtext("Code") or ""
+            except ET.ParseError:
+                pass
+            raise PublishError(f"{what}: HTTP {resp.status_code} {code}".rstrip())
+        return resp
+
+    def _head(self, key: str) -> Optional[requests.Response]:
+        resp = self._request("HEAD", key)
+        if resp.status_code == 404:
+            return None
+        return self._check(resp, f"HEAD {key}")
+
+    def _verify(self, key: str, size: int, sha256: str, etag: Optional[str]):
+        resp = self._head(key)
+        if resp is None:
+            raise PublishError(f"{key}: アップロード後に見つかりません")
+        actual_etag = resp.headers.get("ETag", "").strip('"')
+        if (int(resp.headers.get("Content-Length", -1)) != size
+                or resp.headers.get("x-amz-meta-sha256") != sha256
+                or (etag is not None and actual_etag != etag)):
+            raise PublishError(f"{key}: アップロード後の内容が一致しません（ETag {actual_etag}）")
+
+    def read_index(self) -> dict:
+        resp = self._request("GET", INDEX_KEY)
+        if resp.status_code == 404:
+            return {}
+        return json.loads(self._check(resp, f"GET {INDEX_KEY}").content)
+
+    def has(self, key: str, sha256: str) -> bool:
+        resp = self._head(key)
+        return resp is not None and resp.headers.get("x-amz-meta-sha256") == sha256
+
+    def upload(self, key: str, path: Path, sha256: str) -> None:
+        size = path.stat().st_size
+        headers = {"Content-Type": "application/zip", "x-amz-meta-sha256": sha256}
+        if size < MULTIPART_THRESHOLD:
+            data = path.read_bytes()
+            md5 = hashlib.md5(data)
+            self._check(self._request("PUT", key, data=data, headers={**headers, "Content-MD5": _b64(md5.digest())}),
+                        f"PUT {key}")
+            etag = md5.hexdigest()
+        else:
+            etag = self._multipart_upload(key, path, size, headers)
+        self._verify(key, size, sha256, etag)
+
+    def _multipart_upload(self, key: str, path: Path, size: int, headers: Dict[str, str]) -> str:
+        """マルチパートでアップロードし、期待する ETag（パートの MD5 を連結した MD5-パート数）を返す"""
+        resp = self._check(self._request("POST", key, {"uploads": ""}, headers=headers), f"{key}: マルチパートの開始")
+        upload_id = ET.fromstring(resp.content).findtext("{*}UploadId")
+        if not upload_id:
+            raise PublishError(f"{key}: UploadId がありません")
+        parts = [(number, offset, min(PART_SIZE, size - offset))
+                 for number, offset in enumerate(range(0, size, PART_SIZE), start=1)]
+
+        def put_part(part: Tuple[int, int, int]) -> bytes:
+            number, offset, length = part
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+            md5 = hashlib.md5(data).digest()
+            resp = self._check(self._request("PUT", key, {"partNumber": number, "uploadId": upload_id}, data,
+                                             {"Content-MD5": _b64(md5)}), f"{key}: パート {number}")
+            if resp.headers.get("ETag", "").strip('"') != md5.hex():
+                raise PublishError(f"{key}: パート {number} の ETag が一致しません")
+            return md5
+
+        try:
+            with ThreadPoolExecutor(PART_WORKERS) as pool:
+                digests = list(pool.map(put_part, parts))
+            body = "<CompleteMultipartUpload>" + "".join(
+                f"<Part><PartNumber>{number}</PartNumber><ETag>\"{digest.hex()}\"</ETag></Part>"
+                for (number, _, _), digest in zip(parts, digests)) + "</CompleteMultipartUpload>"
+            self._check(self._request("POST", key, {"uploadId": upload_id}, body.encode("utf-8"),
+                                      {"Content-Type": "application/xml"}), f"{key}: マルチパートの完了")
+        except BaseException:
+            try:
+                self._request("DELETE", key, {"uploadId": upload_id})
+            except PublishError:
+                pass
+            raise
+        return hashlib.md5(b"".join(digests)).hexdigest() + f"-{len(parts)}"
+
+    def alias(self, src_key: str, dst_key: str, sha256: str) -> None:
+        source = quote(f"{self.bucket}/{self.prefix + '/' if self.prefix else ''}{src_key}", safe="/-_.~")
+        self._check(self._request("PUT", dst_key, headers={
+            "x-amz-copy-source": source, "x-amz-metadata-directive": "COPY"}), f"COPY {src_key} → {dst_key}")
+        resp = self._head(dst_key)
+        if resp is None or resp.headers.get("x-amz-meta-sha256") != sha256:
+            raise PublishError(f"{dst_key}: コピー後の内容が一致しません")
+
+    def write_index(self, data: bytes) -> None:
+        md5 = hashlib.md5(data)
+        self._check(self._request("PUT", INDEX_KEY, data=data, headers={
+            "Content-Type": "application/json; charset=utf-8", "Cache-Control": "no-cache",
+            "Content-MD5": _b64(md5.digest())}), f"PUT {INDEX_KEY}")
+
+
+def open_target(spec: str, endpoint: Optional[str] = None) -> PublishTarget:
+    """s3://バケット/プレフィックス → S3Target、それ以外はフォルダ"""
+    if spec.startswith("s3://"):
+        bucket, _, prefix = spec[len("s3://"):].partition("/")
+        if not bucket:
+            raise PublishError(f"バケット名がありません: {spec}")
+        return S3Target(bucket, prefix, endpoint)
+    return DirectoryTarget(Path(spec))
+
+
+# =============================================================================
+# 公開
+# =============================================================================
+
+@dataclass
+class PublishReport:
+    uploaded: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    bytes_uploaded: int = 0
+    elapsed_sec: float = 0.0
+    index_updated: bool = False
+    dry_run: bool = False
+
+
+def publish(archives: Dict[str, Path], target: PublishTarget, workers: int = PUBLISH_WORKERS,
+            dry_run: bool = False, force: bool = False) -> PublishReport:
+    """archives（ジャンルID → ZIP）のうち、配信先と内容が違うものだけをアップロードして index.json を差し替える"""
+    started = time.monotonic()
+    report = PublishReport(dry_run=dry_run)
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        hashes = dict(zip(archives, pool.map(sha256_file, archives.values())))
+    index = target.read_index()
+    entries = {entry["id"]: entry for entry in index.get("genres", [])}
+    changed = [g for g in archives if force or entries.get(g, {}).get("sha256") != hashes[g]]
+    report.skipped = [g for g in archives if g not in changed]
+    if dry_run or not changed:
+        report.uploaded = changed if dry_run else []
+        report.elapsed_sec = time.monotonic() - started
+        return report
+
+    def publish_one(genre_id: str) -> Tuple[dict, int]:
+        path, sha256 = archives[genre_id], hashes[genre_id]
+        key = archive_key(genre_id, sha256)
+        sent = 0
+        if not target.has(key, sha256):
+            target.upload(key, path, sha256)
+            sent = path.stat().st_size
+        target.alias(key, f"{genre_id}.zip", sha256)
+        entry = {"id": genre_id, "zip": f"{genre_id}.zip", "object": key, "file": path.name,
+                 "bytes": path.stat().st_size, "sha256": sha256}
+        return entry, sent
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        futures = {pool.submit(publish_one, g): g for g in changed}
+        for future in as_completed(futures):
+            genre_id = futures[future]
+            try:
+                entry, sent = future.result()
+            except (PublishError, OSError) as e:
+                report.failed[genre_id] = str(e)
+                print(f"  ✗ {genre_id}: {e}")
+                continue
+            entries[genre_id] = entry
+            report.uploaded.append(genre_id)
+            report.bytes_uploaded += sent
+            print(f"  ✓ {genre_id}: {entry['object']}（{entry['bytes'] / 2**20:.2f} MB）")
+
+    if report.uploaded:
+        new_index = {
+            "version": 1,
+            "published_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "genres": [entries[g] for g in sorted(entries)],
+        }
+        target.write_index(json.dumps(new_index, ensure_ascii=False, indent=2).encode("utf-8"))
+        report.index_updated = True
+    report.elapsed_sec = time.monotonic() - started
+    return report
+
+
+def print_publish_report(report: PublishReport, target: PublishTarget):
+    verb = "アップロード予定" if report.dry_run else "アップロード"
+    print(f"\n公開先: {target.describe()}")
+    print(f"  {verb}: {len(report.uploaded)}件 {', '.join(sorted(report.uploaded))}")
+    print(f"  変更なし: {len(report.skipped)}件")
+    if report.failed:
+        print(f"  失敗: {len(report.failed)}件（index.json は前の記録のまま）")
+    if report.bytes_uploaded:
+        rate = report.bytes_uploaded / 2**20 / report.elapsed_sec if report.elapsed_sec else 0.0
+        print(f"  転送: {report.bytes_uploaded / 2**20:.1f} MB / {report.elapsed_sec:.1f}秒（{rate:.1f} MB/秒）")
+    if isinstance(target, S3Target):
+        print(f"  リクエスト: {target.requests}（再試行 {target.retries}）")
+    if report.index_updated:
+        print(f"  ✓ {INDEX_KEY} を更新しました")
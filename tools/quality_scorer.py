@@ -0,0 +1,188 @@
+"""
+画像の品質スコア（候補の選別用）
+
+候補は API の順に保存していたため、ぼやけた・暗い・小さい写真も先に見つかっただけで
+テストセットに入っていた。取り込み時に必要な枚数より多めに候補を集め、ここで採点して
+アイテムごとに上位の画像だけを残す。
+
+- sharpness   ラプラシアンの分散（log スケール）。ピンぼけ・ブレで小さくなる
+- exposure    明るさの平均が中間に近いか × 白飛び・黒つぶれの少なさ × コントラスト
+- resolution  短辺が RESOLUTION_REF ピクセルに届いているか
+- aspect      極端に細長い画像（パノラマ・バナー）でないか
+- score       上の4つの重み付き幾何平均（0〜1。どれか1つが0に近いと全体も低くなる）
+
+画像は JPEG の draft で縮小デコードし、QUALITY_SIZE の正方形のグレースケールにそろえて
+QUALITY_BATCH 枚ずつ NumPy でまとめて計算する。バッチはプロセスプールで並列に処理する。
+
+使い方（フォルダの画像を採点して低い順に表示）:
+  python tools/quality_scorer.py test_sets/dogs/akita test_sets/dogs/corgi --worst 5
+"""
+
+import os
+import io
+import sys
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from dir_index import IMAGE_EXTENSIONS
+
+
+QUALITY_WORKERS = os.cpu_count() or 1  # プロセス数
+QUALITY_BATCH = 8          # 1回の NumPy 計算（プロセスへの1回の受け渡し）でまとめる枚数
+QUALITY_SIZE = 256         # この大きさの正方形に縮小して計算する
+SHARPNESS_REF = 400.0      # ラプラシアンの分散がこれ以上なら sharpness = 1
+CLIP_LOW, CLIP_HIGH = 5, 250  # これ以下・以上の画素を黒つぶれ・白飛びとみなす
+CONTRAST_REF = 40.0        # 明るさの標準偏差がこれ以上なら十分なコントラスト
+RESOLUTION_REF = 400       # 短辺がこれ以上なら resolution = 1
+ASPECT_OK = 1.8            # 長辺/短辺 がここまでは aspect = 1
+ASPECT_MAX = 3.0           # ここで aspect = 0
+
+# 各スコアの重み（幾何平均）
+QUALITY_WEIGHTS = {"sharpness": 0.4, "exposure": 0.3, "resolution": 0.2, "aspect": 0.1}
+
+
+# =============================================================================
+# 採点（プロセスプールで実行される）
+# =============================================================================
+
+def decode_small(data: bytes):
+    """縮小デコードしたグレースケール（QUALITY_SIZE の正方形）と元の幅・高さ"""
+    with Image.open(io.BytesIO(data)) as img:
+        # draft（縮小デコード）は exif_transpose の前に呼ぶ（後だと元の大きさでデコードされる）。
+        # 幅・高さは元の大きさ（resolution・aspect は短辺・長辺しか見ないので回転は気にしない）
+        width, height = img.size
+        img.draft("L", (QUALITY_SIZE, QUALITY_SIZE))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert("L").resize((QUALITY_SIZE, QUALITY_SIZE), Image.BILINEAR)
+    return np.asarray(small), width, height
+
+
+def score_arrays(gray: np.ndarray, widths: np.ndarray, heights: np.ndarray) -> Dict[str, np.ndarray]:
+    """グレースケール (B, H, W) と元の大きさからスコアをまとめて計算"""
+    g = gray.astype(np.float32)
+    laplacian = (4 * g[:, 1:-1, 1:-1] - g[:, :-2, 1:-1] - g[:, 2:, 1:-1]
+                 - g[:, 1:-1, :-2] - g[:, 1:-1, 2:])
+    sharpness = np.clip(np.log1p(laplacian.var(axis=(1, 2))) / np.log1p(SHARPNESS_REF), 0, 1)
+
+    mean = g.mean(axis=(1, 2))
+    clipped = ((g <= CLIP_LOW) | (g >= CLIP_HIGH)).mean(axis=(1, 2))
+    contrast = np.minimum(g.std(axis=(1, 2)) / CONTRAST_REF, 1)
+    exposure = (1 - ((mean - 128) / 128) ** 2) * (1 - clipped) * contrast
+
+    short = np.minimum(widths, heights).astype(np.float32)
+    long = np.maximum(widths, heights).astype(np.float32)
+    resolution = np.minimum(short / RESOLUTION_REF, 1)
+    aspect = np.clip((ASPECT_MAX - long / np.maximum(short, 1)) / (ASPECT_MAX - ASPECT_OK), 0, 1)
+
+    scores = {"sharpness": sharpness, "exposure": exposure, "resolution": resolution, "aspect": aspect}
+    log_total = sum(w * np.log(np.maximum(scores[name], 1e-3)) for name, w in QUALITY_WEIGHTS.items())
+    scores["score"] = np.exp(log_total / sum(QUALITY_WEIGHTS.values()))
+    return scores
+
+
+def score_blobs(blobs: Sequence[bytes]) -> List[Optional[dict]]:
+    """画像のバイト列をまとめて採点（読めない画像は None）"""
+    decoded = []
+    for data in blobs:
+        try:
+            decoded.append(decode_small(data))
+        except Exception:
+            decoded.append(None)
+    ok = [d for d in decoded if d is not None]
+    if not ok:
+        return [None] * len(blobs)
+
+    scores = score_arrays(np.stack([d[0] for d in ok]),
+                          np.array([d[1] for d in ok]), np.array([d[2] for d in ok]))
+    results, i = [], 0
+    for d in decoded:
+        if d is None:
+            results.append(None)
+            continue
+        results.append({name: round(float(values[i]), 4) for name, values in scores.items()})
+        i += 1
+    return results
+
+
+def select_best(scores: Sequence[Optional[dict]], count: int, min_score: float = 0.0) -> List[int]:
+    """スコアの高い順に count 枚のインデックス（min_score 未満と読めない画像は除く）"""
+    ranked = sorted((i for i, s in enumerate(scores) if s is not None and s["score"] >= min_score),
+                    key=lambda i: -scores[i]["score"])
+    return ranked[:count]
+
+
+# =============================================================================
+# プロセスプール
+# =============================================================================
+
+class QualityScorer:
+    """画像の品質をプロセスプールで採点する"""
+
+    def __init__(self, workers: int = QUALITY_WORKERS):
+        self.workers = max(1, workers)
+        self.scored = 0
+        self.errors = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 呼び出し側ではダウンロードのスレッドが動いているので fork ではなく spawn を使う
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def score(self, blobs: Sequence[bytes]) -> List[Optional[dict]]:
+        """画像のバイト列を採点（QUALITY_BATCH 枚ずつプロセスに分ける）"""
+        batches = [blobs[i:i + QUALITY_BATCH] for i in range(0, len(blobs), QUALITY_BATCH)]
+        results = [s for batch in self._get_pool().map(score_blobs, batches) for s in batch]
+        errors = sum(s is None for s in results)
+        with self._lock:
+            self.scored += len(results) - errors
+            self.errors += errors
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="画像フォルダの画像の品質を採点して表示")
+    parser.add_argument("dirs", nargs="+", help="画像フォルダ")
+    parser.add_argument("--worst", type=int, default=None, help="フォルダごとに低い順にこの枚数だけ表示")
+    parser.add_argument("--workers", type=int, default=QUALITY_WORKERS, help="プロセス数")
+    args = parser.parse_args(argv)
+
+    scorer = QualityScorer(args.workers)
+    try:
+        for directory in args.dirs:
+            files = sorted(p for p in Path(directory).iterdir()
+                           if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+            scores = scorer.score([p.read_bytes() for p in files])
+            ranked = sorted(zip(files, scores), key=lambda fs: fs[1]["score"] if fs[1] else -1)
+            print(f"\n{directory}: {len(files)}枚")
+            for path, s in ranked[:args.worst]:
+                if s is None:
+                    print(f"  {'-':>5}  {path.name}（読めません）")
+                    continue
+                print(f"  {s['score']:.3f}  {path.name}  sharpness={s['sharpness']:.2f} "
+                      f"exposure={s['exposure']:.2f} resolution={s['resolution']:.2f} aspect={s['aspect']:.2f}")
+    finally:
+        scorer.close()
+    if scorer.errors:
+        print(f"読み込めなかった画像: {scorer.errors}枚", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
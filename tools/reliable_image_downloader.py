@@ -20,18 +20,48 @@
       └── husky/
 """
 
+import io
 import os
+import copy
+import sys
 import json
+import math
 import time
+import shutil
+import socket
+import argparse
+import threading
 import hashlib
 import requests
 import zipfile
 from pathlib import Path
 from datetime import datetime
-from typing import Optional, Dict, List, Tuple
+from typing import Callable, Optional, Dict, List, Tuple
 from dataclasses import dataclass, field, asdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from PIL import Image
+
+import confusability
+import manifest_writer
+import profiling
+import publisher
+import test_set_verifier
+from candidate_store import CandidateStore
+from dir_index import get_index
+from feature_store import FEATURE_WORKERS, FeatureExtractor
+from host_health import (CircuitBreakers, HostBusyError, HostConcurrency, LatencyTracker,
+                         NegativeCache, percentile)
+from image_optimizer import OPTIMIZE_WORKERS, ImageOptimizer, print_optimize_report
+from ingest_pipeline import Pipeline, Stage, print_stage_stats
+from publisher import PUBLISH_WORKERS, PublishError, open_target, print_publish_report
+from quality_scorer import QualityScorer, select_best
+from manifest_writer import (BINARY_MANIFEST_FILENAME, load_sources, record_image_source, update_json_locked,
+                             write_manifest)
+from subject_boxes import BOX_WORKERS, SubjectBoxer
+from test_set_verifier import VERIFY_WORKERS, verify_genre_dir, verify_zip
+from work_queue import WorkQueue
+
 
 # =============================================================================
 # 設定
@@ -40,6 +70,43 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 USER_AGENT = "SimilarityQuiz/1.0 (Educational Research App - Japanese High School)"
 OUTPUT_DIR = Path("test_sets")
 IMAGES_PER_TYPE = 20  # 各種類ごとにダウンロードする画像数
+CURSORS_PATH = OUTPUT_DIR / ".harvest_cursors.json"  # API検索の続きの位置（アイテム・ソースごと）
+CANDIDATES_DB = OUTPUT_DIR / "candidates.db"  # 収集した候補URL
+DOWNLOAD_WORKERS = 8  # 同時に処理するアイテム数（ホストごとの同時接続数は自動調整）
+NEGATIVE_CACHE_PATH = OUTPUT_DIR / ".negative_cache.json"  # 404や画像でなかったURL（有効期限付き）
+HOST_LIMITS_PATH = OUTPUT_DIR / ".host_limits.json"  # ホストごとの同時接続数の上限（次回の初期値）
+WORK_QUEUE_PATH = OUTPUT_DIR / "work_queue.db"  # 複数ワーカーで分担する場合の作業キュー
+WORKER_BATCH_SIZE = 8     # ワーカーが一度に借りるアイテム数
+WORKER_POLL_SEC = 10      # 借りられる作業が無いときの待ち時間
+
+# タイムアウト（接続, 読み込み）秒。読み込みは1回の受信ごとの待ち時間
+CONNECT_TIMEOUT = 5
+API_TIMEOUT = (CONNECT_TIMEOUT, 10)
+IMAGE_TIMEOUT = (CONNECT_TIMEOUT, 15)
+ITEM_TIME_BUDGET_SEC = 180  # 1アイテムのダウンロードに使う時間の上限（残りは次回に回す）
+
+ITEM_MAX_IN_FLIGHT = 4  # 1アイテムで同時にダウンロードする候補の数
+
+# ヘッジリクエスト: 最後に始めたダウンロードがホストのp95応答時間を超えたら、
+# 枠を超えて次の順位の候補のダウンロードも始め、先に終わったものから使う
+HEDGE_REQUESTS = True
+HEDGE_PERCENTILE = 95
+HEDGE_EXTRA = 1  # ヘッジで枠を超えてよい数
+
+# 取り込みパイプラインの各ステージの並列数
+HARVEST_WORKERS = 2
+FETCH_WORKERS = 16
+DECODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+OPTIMIZE_IMAGES = True  # 保存した JPEG を最適化する（メタデータの削除など、image_optimizer.py）
+OPTIMIZE_ITEM_WORKERS = 2  # 同時に最適化するアイテム数（画像ごとの処理はプロセスプールで並列）
+COMPUTE_SUBJECT_BOXES = True  # 被写体・顔のボックスを計算して manifest.json に入れる（subject_boxes.py）
+BOX_ITEM_WORKERS = 2       # 同時にボックスを計算するアイテム数
+EXTRACT_FEATURES = True    # manifest.json の更新後に画像の特徴量を計算する（feature_store.py）
+AUTO_SIMILAR_PAIRS = True  # 特徴量から紛らわしいアイテムの組を求めて similar_pairs に足す（confusability.py）
+SELECT_BY_QUALITY = True   # 多めに候補を集め、品質スコアの高い画像を残す（quality_scorer.py）
+QUALITY_OVERFETCH = 1.5    # 品質で選ぶ場合に集める候補の数（不足枚数に対する倍率）
+MIN_QUALITY = 0.2          # 品質スコアがこれ未満の画像は保存しない
+QUALITY_ITEM_WORKERS = 2   # 同時に採点するアイテム数（採点はプロセスプールで並列）
 
 # API URLs
 INATURALIST_API = "https://api.inaturalist.org/v1"
@@ -48,6 +115,26 @@ DOG_API = "https://api.thedogapi.com/v1"
 CAT_API = "https://api.thecatapi.com/v1"
 WIKIMEDIA_API = "https://commons.wikimedia.org/w/api.php"
 
+# 複数アイテムをまとめて問い合わせる際の上限
+INATURALIST_BATCH_SIZE = 20    # 1リクエストあたりのtaxon_id数
+INATURALIST_MAX_PER_PAGE = 200
+GBIF_BATCH_SIZE = 10           # 1リクエストあたりのspeciesKey数
+GBIF_MAX_LIMIT = 300
+
+# 画像サイズ（長辺ピクセル）の目標。各ソースはこれを満たす最小のサイズを選ぶ
+SIZE_TIERS = {
+    "thumb": 240,
+    "standard": 500,
+    "large": 1024,
+}
+SIZE_TIER = "standard"
+
+# iNaturalistの配信サイズ（名前, 長辺の上限）
+INATURALIST_SIZES = [("small", 240), ("medium", 500), ("large", 1024), ("original", 2048)]
+
+# GBIFの画像キャッシュ（size は "{幅}x" で幅、"x{高さ}" で高さを指定して縮小したサムネイルを返す）
+GBIF_THUMBNAIL_URL = GBIF_API + "/image/cache/{size}/occurrence/{key}/media/{md5}"
+
 
 # =============================================================================
 # データ定義
@@ -70,6 +157,16 @@ class SimilarPair:
     id2: str
 
 
+@dataclass
+class ImageCandidate:
+    url: str
+    source: str  # 取得元API（inaturalist / gbif / dog_api / cat_api / wikimedia）
+    license_url: Optional[str] = None
+    width: Optional[int] = None   # APIが報告したサイズ（分かる場合のみ）
+    height: Optional[int] = None
+    fallback_url: Optional[str] = None  # url（縮小版など）が取れなかったときに使う元のURL
+
+
 @dataclass
 class GenreInfo:
     id: str
@@ -77,6 +174,7 @@ class GenreInfo:
     description: str
     items: List[ItemInfo] = field(default_factory=list)
     similar_pairs: List[SimilarPair] = field(default_factory=list)
+    detect_faces: bool = False  # 人物のジャンル: 被写体に加えて顔のボックスも計算する
 
 
 # iNaturalist taxon_id マッピング
@@ -394,103 +492,291 @@ GENRES: Dict[str, GenreInfo] = {
 # 画像取得関数
 # =============================================================================
 
-def fetch_from_inaturalist(taxon_id: int, max_results: int = 30) -> List[str]:
-    """iNaturalist APIから画像URLを取得"""
-    urls = []
+def target_long_edge() -> int:
+    """現在のサイズ設定の長辺ピクセル"""
+    return SIZE_TIERS[SIZE_TIER]
+
+
+def pick_inaturalist_size(original_width: Optional[int], original_height: Optional[int],
+                          long_edge: int) -> Tuple[str, Optional[int], Optional[int]]:
+    """目標の長辺を満たす最小のiNaturalist配信サイズを選ぶ
+
+    元画像が目標より小さい場合は、元画像の大きさに届く最小のサイズを選ぶ。
+    戻り値: (サイズ名, 配信される幅, 高さ)
+    """
+    original_long = max(original_width or 0, original_height or 0)
+    for name, cap in INATURALIST_SIZES:
+        if cap >= long_edge or (original_long and cap >= original_long):
+            break
+    if not original_long:
+        return name, None, None
+    scale = min(1.0, cap / original_long)
+    return name, round(original_width * scale), round(original_height * scale)
+
+
+def creative_commons_url(code: Optional[str]) -> Optional[str]:
+    """ライセンスコード（cc-by-nc 等）をCreative CommonsのURLに変換"""
+    if not code:
+        return None
+    code = code.lower()
+    if code == "cc0":
+        return "https://creativecommons.org/publicdomain/zero/1.0/"
+    if code.startswith("cc-"):
+        return f"https://creativecommons.org/licenses/{code[3:]}/4.0/"
+    return None
+
+
+def load_cursors() -> Dict[str, Dict[str, dict]]:
+    """保存済みのカーソルを読み込む {"ジャンル/アイテム": {ソース: カーソル}}"""
     try:
-        url = f"{INATURALIST_API}/observations?taxon_id={taxon_id}&photos=true&quality_grade=research&per_page={max_results}&order=desc&order_by=votes"
-        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+        with open(CURSORS_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cursors(cursors: Dict[str, Dict[str, dict]], loaded: Dict[str, Dict[str, dict]]):
+    """loaded（読み込んだ時点の内容）から変わったキーだけを保存
+
+    複数のワーカーが同じファイルを使うので、ロックを取って読み直してから変更したキーだけを書き戻す。
+    """
+    changed = {key: value for key, value in cursors.items() if loaded.get(key) != value}
+    if changed:
+        update_json_locked(CURSORS_PATH, lambda current: {**current, **changed})
+
+
+def fetch_from_inaturalist(taxon_id: int, max_results: int = 30,
+                           cursor: Optional[dict] = None) -> List[ImageCandidate]:
+    """iNaturalist APIから画像URLを取得
+
+    cursor を渡すと続きのページから取得し、cursor を進める。
+    cursor は取得済みの件数（offset）で持ち、max_results が前回と違っても
+    取りこぼしが出ないページを選ぶ。最後まで取得したら先頭に戻る。
+    """
+    candidates = []
+    offset = cursor.get("offset", 0) if cursor is not None else 0
+    page = offset // max_results + 1
+    try:
+        url = f"{INATURALIST_API}/observations?taxon_id={taxon_id}&photos=true&quality_grade=research&per_page={max_results}&page={page}&order=desc&order_by=votes"
+        response = http_get(url, timeout=API_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
-            for obs in data.get("results", []):
-                for photo in obs.get("photos", []):
-                    photo_url = photo.get("url", "").replace("square", "medium")
-                    if photo_url and is_valid_image_url(photo_url):
-                        urls.append(photo_url)
+            results = data.get("results", [])
+            if cursor is not None:
+                # iNaturalistは page * per_page が10000件までしか取得できない
+                next_offset = (page - 1) * max_results + len(results)
+                exhausted = (next_offset >= min(data.get("total_results", 0), 10000)
+                             or len(results) < max_results)
+                cursor["offset"] = 0 if exhausted else next_offset
+            for obs in results:
+                candidates.extend(_inaturalist_candidates(obs))
     except Exception as e:
         print(f"  iNaturalist error for taxon_id={taxon_id}: {e}")
     
-    return urls
+    return candidates
+
+
+def _inaturalist_candidates(obs: dict) -> List[ImageCandidate]:
+    """iNaturalistの観察1件から画像候補を作る"""
+    candidates = []
+    for photo in obs.get("photos", []):
+        dims = photo.get("original_dimensions") or {}
+        size, width, height = pick_inaturalist_size(
+            dims.get("width"), dims.get("height"), target_long_edge())
+        photo_url = photo.get("url", "").replace("square", size)
+        if photo_url and is_valid_image_url(photo_url):
+            candidates.append(ImageCandidate(
+                photo_url, "inaturalist", creative_commons_url(photo.get("license_code")),
+                width, height,
+            ))
+    return candidates
+
+
+def fetch_from_inaturalist_batch(taxon_ids: List[int], per_taxon: int,
+                                 cursor: Optional[dict] = None) -> Dict[int, List[ImageCandidate]]:
+    """複数のtaxon_idを1リクエストで問い合わせ、観察のtaxonごとに振り分ける
+
+    観察のtaxon（とその祖先）に含まれる要求taxonのうち、最も下位のものに割り当てる
+    （例: 甲虫目とクワガタ科を同時に要求した場合、クワガタの観察はクワガタ科へ）。
+    """
+    results_by_taxon: Dict[int, List[ImageCandidate]] = {t: [] for t in taxon_ids}
+    per_page = min(INATURALIST_MAX_PER_PAGE, per_taxon * len(taxon_ids))
+    offset = cursor.get("offset", 0) if cursor is not None else 0
+    page = offset // per_page + 1
+    ids = ",".join(str(t) for t in taxon_ids)
+    try:
+        url = f"{INATURALIST_API}/observations?taxon_id={ids}&photos=true&quality_grade=research&per_page={per_page}&page={page}&order=desc&order_by=votes"
+        response = http_get(url, timeout=API_TIMEOUT)
+        
+        if response.status_code == 200:
+            data = response.json()
+            results = data.get("results", [])
+            if cursor is not None:
+                next_offset = (page - 1) * per_page + len(results)
+                exhausted = (next_offset >= min(data.get("total_results", 0), 10000)
+                             or len(results) < per_page)
+                cursor["offset"] = 0 if exhausted else next_offset
+            requested = set(taxon_ids)
+            for obs in results:
+                taxon = obs.get("taxon") or {}
+                lineage = list(taxon.get("ancestor_ids") or []) + [taxon.get("id")]
+                matches = [t for t in lineage if t in requested]
+                if matches:
+                    results_by_taxon[matches[-1]].extend(_inaturalist_candidates(obs))
+    except Exception as e:
+        print(f"  iNaturalist error for taxon_ids={ids}: {e}")
+    
+    return results_by_taxon
 
 
-def fetch_from_gbif(species_key: int, max_results: int = 30) -> List[str]:
-    """GBIF APIから画像URLを取得"""
-    urls = []
+def fetch_from_gbif(species_key: int, max_results: int = 30,
+                    cursor: Optional[dict] = None) -> List[ImageCandidate]:
+    """GBIF APIから画像URLを取得（cursor は offset で進める）"""
+    candidates = []
+    offset = cursor.get("offset", 0) if cursor is not None else 0
     try:
-        url = f"{GBIF_API}/occurrence/search?speciesKey={species_key}&mediaType=StillImage&limit={max_results}"
-        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+        url = f"{GBIF_API}/occurrence/search?speciesKey={species_key}&mediaType=StillImage&limit={max_results}&offset={offset}"
+        response = http_get(url, timeout=API_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
+            if cursor is not None:
+                cursor["offset"] = 0 if data.get("endOfRecords", True) else offset + max_results
             for occ in data.get("results", []):
-                for media in occ.get("media", []):
-                    photo_url = media.get("identifier", "")
-                    if photo_url and is_valid_image_url(photo_url):
-                        urls.append(photo_url)
+                candidates.extend(_gbif_candidates(occ))
     except Exception as e:
         print(f"  GBIF error for species_key={species_key}: {e}")
     
-    return urls
+    return candidates
+
+
+def _gbif_candidates(occ: dict) -> List[ImageCandidate]:
+    """GBIFのオカレンス1件から画像候補を作る"""
+    candidates = []
+    for media in occ.get("media", []):
+        photo_url = media.get("identifier", "")
+        if photo_url and is_valid_image_url(photo_url):
+            license_url = media.get("license") or occ.get("license")
+            if license_url and not license_url.startswith("http"):
+                license_url = None
+            sized_url = gbif_sized_url(photo_url, occ.get("key"))
+            fallback_url = photo_url if sized_url != photo_url else None
+            candidates.append(ImageCandidate(sized_url, "gbif", license_url, fallback_url=fallback_url))
+    return candidates
+
+
+def gbif_sized_url(identifier: str, occurrence_key: Optional[int]) -> str:
+    """GBIFのメディアURLを目標サイズのURLに変換
+
+    iNaturalist由来の画像はiNaturalistの配信サイズに、それ以外はGBIFの
+    画像キャッシュの縮小版にする（元画像は数千ピクセルのことが多い）。
+    画像キャッシュは幅（{長辺}x）か高さ（x{長辺}）の一方しか指定できず、GBIF のメディアには
+    大きさが無いので向きも分からない。幅で指定するため、縦長の画像は長辺が目標より大きくなる
+    （横長・正方形の画像は目標どおり）。
+    取得できなかったときは、候補の fallback_url（元のURL）でダウンロードし直す。
+    """
+    long_edge = target_long_edge()
+    if "inaturalist" in identifier and "/original." in identifier:
+        size, _, _ = pick_inaturalist_size(None, None, long_edge)
+        return identifier.replace("/original.", f"/{size}.")
+    if occurrence_key:
+        md5 = hashlib.md5(identifier.encode("utf-8")).hexdigest()
+        return GBIF_THUMBNAIL_URL.format(size=f"{long_edge}x", key=occurrence_key, md5=md5)
+    return identifier
+
+
+def fetch_from_gbif_batch(species_keys: List[int], per_key: int,
+                          cursor: Optional[dict] = None) -> Dict[int, List[ImageCandidate]]:
+    """複数のspeciesKeyを1リクエストで問い合わせ、オカレンスのspeciesKeyごとに振り分ける"""
+    results_by_key: Dict[int, List[ImageCandidate]] = {k: [] for k in species_keys}
+    limit = min(GBIF_MAX_LIMIT, per_key * len(species_keys))
+    offset = cursor.get("offset", 0) if cursor is not None else 0
+    keys = "&".join(f"speciesKey={k}" for k in species_keys)
+    try:
+        url = f"{GBIF_API}/occurrence/search?{keys}&mediaType=StillImage&limit={limit}&offset={offset}"
+        response = http_get(url, timeout=API_TIMEOUT)
+        
+        if response.status_code == 200:
+            data = response.json()
+            if cursor is not None:
+                cursor["offset"] = 0 if data.get("endOfRecords", True) else offset + limit
+            for occ in data.get("results", []):
+                key = occ.get("speciesKey") or occ.get("acceptedTaxonKey")
+                if key in results_by_key:
+                    results_by_key[key].extend(_gbif_candidates(occ))
+    except Exception as e:
+        print(f"  GBIF error for species_keys={species_keys}: {e}")
+    
+    return results_by_key
 
 
-def fetch_from_dog_api(breed_id: int, max_results: int = 20) -> List[str]:
+def fetch_from_dog_api(breed_id: int, max_results: int = 20) -> List[ImageCandidate]:
     """The Dog APIから画像URLを取得"""
-    urls = []
+    candidates = []
     try:
         url = f"{DOG_API}/images/search?breed_ids={breed_id}&limit={max_results}"
-        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+        response = http_get(url, timeout=API_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
             for item in data:
                 photo_url = item.get("url", "")
                 if photo_url and is_valid_image_url(photo_url):
-                    urls.append(photo_url)
+                    candidates.append(ImageCandidate(photo_url, "dog_api"))
     except Exception as e:
         print(f"  Dog API error for breed_id={breed_id}: {e}")
     
-    return urls
+    return candidates
 
 
-def fetch_from_cat_api(breed_id: str, max_results: int = 20) -> List[str]:
+def fetch_from_cat_api(breed_id: str, max_results: int = 20) -> List[ImageCandidate]:
     """The Cat APIから画像URLを取得"""
-    urls = []
+    candidates = []
     try:
         url = f"{CAT_API}/images/search?breed_ids={breed_id}&limit={max_results}"
-        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+        response = http_get(url, timeout=API_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
             for item in data:
                 photo_url = item.get("url", "")
                 if photo_url and is_valid_image_url(photo_url):
-                    urls.append(photo_url)
+                    candidates.append(ImageCandidate(photo_url, "cat_api"))
     except Exception as e:
         print(f"  Cat API error for breed_id={breed_id}: {e}")
     
-    return urls
+    return candidates
 
 
-def fetch_from_wikimedia(search_term: str, max_results: int = 20) -> List[str]:
-    """Wikimedia Commonsから画像URLを取得"""
-    urls = []
+def fetch_from_wikimedia(search_term: str, max_results: int = 20,
+                         cursor: Optional[dict] = None) -> List[ImageCandidate]:
+    """Wikimedia Commonsから画像URLを取得（cursor は continue の gsroffset で進める）"""
+    candidates = []
+    offset = cursor.get("gsroffset", 0) if cursor is not None else 0
+    edge = target_long_edge()  # 幅・高さとも edge 以内に収まるサムネイルを要求
     try:
-        url = f"{WIKIMEDIA_API}?action=query&generator=search&gsrsearch={search_term}&gsrlimit={max_results}&prop=imageinfo&iiprop=url&iiurlwidth=800&format=json"
-        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=10)
+        url = f"{WIKIMEDIA_API}?action=query&generator=search&gsrsearch={search_term}&gsrlimit={max_results}&gsroffset={offset}&prop=imageinfo&iiprop=url|extmetadata&iiextmetadatafilter=LicenseUrl&iiurlwidth={edge}&iiurlheight={edge}&format=json"
+        response = http_get(url, timeout=API_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
+            if cursor is not None:
+                cursor["gsroffset"] = data.get("continue", {}).get("gsroffset", 0)
             pages = data.get("query", {}).get("pages", {})
             for page in pages.values():
                 for info in page.get("imageinfo", []):
                     photo_url = info.get("thumburl") or info.get("url", "")
                     if photo_url and is_valid_image_url(photo_url):
-                        urls.append(photo_url)
+                        license_url = info.get("extmetadata", {}).get("LicenseUrl", {}).get("value")
+                        candidates.append(ImageCandidate(
+                            photo_url, "wikimedia", license_url,
+                            info.get("thumbwidth"), info.get("thumbheight"),
+                        ))
     except Exception as e:
         print(f"  Wikimedia error for '{search_term}': {e}")
     
-    return urls
+    return candidates
 
 
 def is_valid_image_url(url: str) -> bool:
@@ -500,67 +786,715 @@ def is_valid_image_url(url: str) -> bool:
             and "placeholder" not in lower and "default" not in lower)
 
 
-def get_image_urls(item: ItemInfo, max_results: int = 30) -> List[str]:
-    """アイテムから画像URLを取得（複数APIを試行）"""
-    urls = []
+def _batches(values: list, size: int) -> List[list]:
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def prefetch_candidates(items: List[ItemInfo], max_results: int) -> Dict[str, Dict[str, List[ImageCandidate]]]:
+    """複数アイテム（ジャンルをまたいでもよい）の候補をまとめて取得
+
+    iNaturalist と GBIF はIDをまとめて問い合わせ、結果を各アイテムに振り分ける。
+    バッチごとのカーソルも保存し、次回は続きから取得する。
+    戻り値: {アイテムID: {ソース: [候補, ...]}}（get_image_candidates の prefetched に渡す）
+    """
+    prefetched: Dict[str, Dict[str, List[ImageCandidate]]] = {}
+    cursors = load_cursors()
+    loaded = copy.deepcopy(cursors)
+    
+    # 1. iNaturalist（同じtaxonのアイテムは1回だけ問い合わせる）
+    items_by_taxon: Dict[int, List[ItemInfo]] = {}
+    for item in items:
+        if item.inaturalist_taxon_id:
+            items_by_taxon.setdefault(item.inaturalist_taxon_id, []).append(item)
+    for batch in _batches(sorted(items_by_taxon), INATURALIST_BATCH_SIZE):
+        print(f"  Batch iNaturalist: {len(batch)} taxa...")
+        cursor = cursors.setdefault(f"_batch/inaturalist/{','.join(map(str, batch))}", {})
+        for taxon_id, candidates in fetch_from_inaturalist_batch(batch, max_results, cursor).items():
+            for item in items_by_taxon[taxon_id]:
+                prefetched.setdefault(item.id, {})["inaturalist"] = candidates[:max_results]
+        time.sleep(0.3)  # レート制限対策
+    
+    # 2. GBIF（iNaturalistで足りなかったアイテムのみ）
+    items_by_key: Dict[int, List[ItemInfo]] = {}
+    for item in items:
+        found = len(prefetched.get(item.id, {}).get("inaturalist", []))
+        if item.gbif_species_key and found < max_results // 2:
+            items_by_key.setdefault(item.gbif_species_key, []).append(item)
+    for batch in _batches(sorted(items_by_key), GBIF_BATCH_SIZE):
+        print(f"  Batch GBIF: {len(batch)} species...")
+        cursor = cursors.setdefault(f"_batch/gbif/{','.join(map(str, batch))}", {})
+        for species_key, candidates in fetch_from_gbif_batch(batch, max_results, cursor).items():
+            for item in items_by_key[species_key]:
+                prefetched.setdefault(item.id, {})["gbif"] = candidates[:max_results]
+    
+    save_cursors(cursors, loaded)
+    return prefetched
+
+
+def get_image_candidates(item: ItemInfo, max_results: int = 30,
+                         cursors: Optional[Dict[str, dict]] = None,
+                         prefetched: Optional[Dict[str, List[ImageCandidate]]] = None) -> List[ImageCandidate]:
+    """アイテムから画像URLを取得（複数APIを試行）
+
+    cursors（{ソース: カーソル}）を渡すと、各ソースで前回の続きから取得し、
+    カーソルを進める。
+    prefetched（prefetch_candidates の結果）があるソースはそれを使い、
+    足りない場合だけ個別に問い合わせる。
+    """
+    candidates = []
+    prefetched = prefetched or {}
+    
+    def cursor_for(source: str) -> Optional[dict]:
+        return cursors.setdefault(source, {}) if cursors is not None else None
     
     # 1. iNaturalist
-    if item.inaturalist_taxon_id:
+    candidates.extend(prefetched.get("inaturalist", []))
+    if item.inaturalist_taxon_id and ("inaturalist" not in prefetched
+                                      or len(candidates) < max_results // 2):
         print(f"    Trying iNaturalist (taxon_id={item.inaturalist_taxon_id})...")
-        urls.extend(fetch_from_inaturalist(item.inaturalist_taxon_id, max_results))
+        candidates.extend(fetch_from_inaturalist(
+            item.inaturalist_taxon_id, max_results, cursor_for("inaturalist")))
     
     # 2. GBIF
-    if len(urls) < max_results // 2 and item.gbif_species_key:
+    candidates.extend(prefetched.get("gbif", []))
+    if len(candidates) < max_results // 2 and item.gbif_species_key and "gbif" not in prefetched:
         print(f"    Trying GBIF (species_key={item.gbif_species_key})...")
-        urls.extend(fetch_from_gbif(item.gbif_species_key, max_results))
+        candidates.extend(fetch_from_gbif(item.gbif_species_key, max_results, cursor_for("gbif")))
     
     # 3. Dog API
-    if len(urls) < max_results // 2 and item.dog_api_breed_id:
+    if len(candidates) < max_results // 2 and item.dog_api_breed_id:
         print(f"    Trying Dog API (breed_id={item.dog_api_breed_id})...")
-        urls.extend(fetch_from_dog_api(item.dog_api_breed_id, max_results))
+        candidates.extend(fetch_from_dog_api(item.dog_api_breed_id, max_results))
     
     # 4. Cat API
-    if len(urls) < max_results // 2 and item.cat_api_breed_id:
+    if len(candidates) < max_results // 2 and item.cat_api_breed_id:
         print(f"    Trying Cat API (breed_id={item.cat_api_breed_id})...")
-        urls.extend(fetch_from_cat_api(item.cat_api_breed_id, max_results))
+        candidates.extend(fetch_from_cat_api(item.cat_api_breed_id, max_results))
     
     # 5. Wikimedia（フォールバック）
-    if len(urls) < max_results // 2:
+    if len(candidates) < max_results // 2:
         print(f"    Trying Wikimedia (query='{item.query}')...")
-        urls.extend(fetch_from_wikimedia(item.query, max_results))
+        candidates.extend(fetch_from_wikimedia(item.query, max_results, cursor_for("wikimedia")))
     
     # 重複を除去
     seen = set()
-    unique_urls = []
-    for url in urls:
-        if url not in seen:
-            seen.add(url)
-            unique_urls.append(url)
+    unique_candidates = []
+    for candidate in candidates:
+        if candidate.url not in seen:
+            seen.add(candidate.url)
+            unique_candidates.append(candidate)
     
-    return unique_urls[:max_results]
+    return unique_candidates[:max_results]
 
 
-def download_image(url: str, save_path: Path) -> bool:
-    """画像をダウンロードして保存"""
+def get_image_urls(item: ItemInfo, max_results: int = 30) -> List[str]:
+    """アイテムから画像URLのみを取得"""
+    return [c.url for c in get_image_candidates(item, max_results)]
+
+
+# =============================================================================
+# HTTPリクエスト（ホストごとのサーキットブレーカー・ネガティブキャッシュ）
+# =============================================================================
+
+host_breakers = CircuitBreakers()
+host_latency = LatencyTracker()
+_negative_cache: Optional[NegativeCache] = None
+_host_state_lock = threading.Lock()
+_host_concurrency: Optional[HostConcurrency] = None
+
+
+def get_negative_cache() -> NegativeCache:
+    """失敗したURLの記録（プロセス内で共有）"""
+    global _negative_cache
+    with _host_state_lock:
+        if _negative_cache is None:
+            _negative_cache = NegativeCache(NEGATIVE_CACHE_PATH)
+        return _negative_cache
+
+
+def get_host_concurrency() -> HostConcurrency:
+    """ホストごとの同時接続数の上限（プロセス内で共有）"""
+    global _host_concurrency
+    with _host_state_lock:
+        if _host_concurrency is None:
+            _host_concurrency = HostConcurrency(HOST_LIMITS_PATH)
+        return _host_concurrency
+
+
+def save_host_state():
+    """ネガティブキャッシュと同時接続数の上限を保存"""
+    get_negative_cache().save()
+    get_host_concurrency().save()
+
+
+def http_get(url: str, timeout: Tuple[float, float]) -> requests.Response:
+    """GETリクエスト（ホストのサーキットが open なら CircuitOpenError）
+
+    ホストごとの同時接続数の上限（AIMD）まで空くのを待ってからリクエストする。
+    接続エラー・タイムアウト・429/5xx をホストの失敗として数え、
+    応答時間（本文の受信まで）をホストごとに記録する。
+    429/503・タイムアウト・応答時間の急増があれば同時接続数を下げる。
+    """
+    breaker = host_breakers.get(url)
+    breaker.before_request()
+    limiter = get_host_concurrency().get(url)
+    limiter.acquire()
+    started = time.monotonic()
     try:
-        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=15)
-        if response.status_code == 200 and len(response.content) > 1000:
+        response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=timeout)
+    except requests.RequestException as e:
+        limiter.release(None, overloaded=isinstance(e, requests.Timeout))
+        breaker.record_failure()
+        raise
+    except BaseException:
+        limiter.release(None, overloaded=False)
+        raise
+    latency = time.monotonic() - started
+    limiter.release(latency, overloaded=response.status_code in (429, 503))
+    host_latency.record(url, latency)
+    if response.status_code == 429 or response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+def fetch_image_bytes(url: str) -> Optional[bytes]:
+    """画像をダウンロード（画像でなければNone）
+
+    404や画像でない内容を返したURLはネガティブキャッシュに記録し、次回からは問い合わせない。
+    ホストのサーキットが open の場合や 429/5xx の場合は HostBusyError を送出する
+    （URL自体の失敗ではないので、後で再試行できる）。
+    """
+    negative_cache = get_negative_cache()
+    if url in negative_cache:
+        return None
+    try:
+        response = http_get(url, timeout=IMAGE_TIMEOUT)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise HostBusyError(f"HTTP {response.status_code}")
+        if response.status_code in (404, 410):
+            negative_cache.add(url, f"http_{response.status_code}")
+        elif response.status_code == 200:
             # 画像形式を確認
             content_type = response.headers.get("content-type", "")
-            if "image" in content_type or is_valid_image_url(url):
-                save_path.write_bytes(response.content)
-                return True
+            if len(response.content) <= 1000:
+                negative_cache.add(url, "too_small")
+            elif "image" in content_type or is_valid_image_url(url):
+                return response.content
+            else:
+                negative_cache.add(url, "not_image")
+    except HostBusyError:
+        raise
     except Exception as e:
         print(f"    Download failed: {e}")
-    return False
+    return None
+
+
+def download_image(url: str, save_path: Path) -> bool:
+    """画像をダウンロードして保存"""
+    try:
+        content = fetch_image_bytes(url)
+    except HostBusyError:
+        return False
+    if content is None:
+        return False
+    save_path.write_bytes(content)
+    return True
+
+
+# =============================================================================
+# 候補の収集（harvest）とダウンロード（fetch）
+# =============================================================================
+
+_candidate_store: Optional[CandidateStore] = None
+_candidate_store_lock = threading.Lock()
+
+
+def get_candidate_store(wal: bool = True) -> CandidateStore:
+    """候補URLのDB（プロセス内で共有。wal は最初に開くときだけ有効）"""
+    global _candidate_store
+    with _candidate_store_lock:
+        if _candidate_store is None:
+            _candidate_store = CandidateStore(CANDIDATES_DB, wal=wal)
+        return _candidate_store
+
+
+def _harvest_needed(genre_id: str, item: ItemInfo, target_count: int) -> int:
+    """候補の収集が必要なら不足枚数、不要なら0
+
+    DBに未ダウンロードの候補が十分に残っているアイテムは収集しない。
+    """
+    needed = target_count - get_index(OUTPUT_DIR).count_images(OUTPUT_DIR / genre_id / item.id)
+    if needed > 0 and get_candidate_store().count_pending(genre_id, item.id) < needed * 2:
+        return needed
+    return 0
+
+
+def _short_items(genre_id: str, target_count: int) -> List[Tuple[ItemInfo, int]]:
+    """候補の収集が必要なアイテムと不足枚数"""
+    short_items = []
+    for item in GENRES[genre_id].items:
+        needed = _harvest_needed(genre_id, item, target_count)
+        if needed:
+            short_items.append((item, needed))
+    return short_items
+
+
+def harvest_item(genre_id: str, item: ItemInfo, needed: int, cursors: Dict[str, Dict[str, dict]],
+                 prefetched: Optional[Dict[str, Dict[str, List[ImageCandidate]]]] = None) -> int:
+    """アイテム1つ分の候補URLをAPIから集めてDBに追加（戻り値: 新しく追加した候補の数）"""
+    print(f"\n  [{item.id}] {item.name_ja}: 候補を収集中...")
+    candidates = get_image_candidates(
+        item, max_results=needed * 3,
+        cursors=cursors.setdefault(f"{genre_id}/{item.id}", {}),
+        prefetched=(prefetched or {}).get(item.id))
+    negative_cache = get_negative_cache()
+    added = get_candidate_store().add(
+        genre_id, item.id, [c for c in candidates if c.url not in negative_cache])
+    print(f"    [{item.id}] Found {len(candidates)} URLs (新規 {added}件)")
+    if not candidates:
+        print(f"    [{item.id}] WARNING: No URLs found!")
+    return added
+
+
+def harvest_genre(genre_id: str, target_count: int,
+                  prefetched: Optional[Dict[str, Dict[str, List[ImageCandidate]]]] = None) -> int:
+    """不足しているアイテムの候補URLをAPIから集めてDBに追加
+
+    DBに未ダウンロードの候補が十分に残っているアイテムは、APIに問い合わせない。
+    戻り値: 新しく追加した候補の数
+    """
+    short_items = _short_items(genre_id, target_count)
+    if not short_items:
+        print("  候補URLは収集済みです（APIへの問い合わせなし）")
+        return 0
+    
+    if prefetched is None:
+        max_results = max(needed for _, needed in short_items) * 3
+        prefetched = prefetch_candidates([item for item, _ in short_items], max_results)
+    
+    cursors = load_cursors()
+    loaded = copy.deepcopy(cursors)
+    total_added = sum(harvest_item(genre_id, item, needed, cursors, prefetched)
+                      for item, needed in short_items)
+    save_cursors(cursors, loaded)
+    save_host_state()
+    return total_added
+
+
+# =============================================================================
+# 取り込みパイプライン（harvest → schedule → fetch → decode → dedup → store → manifest）
+# =============================================================================
+
+@dataclass
+class ItemJob:
+    """パイプラインで処理中のアイテム1つ分の状態"""
+    genre_id: str
+    item: ItemInfo
+    target_count: int
+    needed: int = 0
+    quota: int = 0            # 集める候補の数（品質で選ぶ場合は needed より多い）
+    stored: int = 0           # 保存した（品質で選ぶ場合は選別前に集めた）画像の数
+    in_flight: int = 0        # schedule が送り出し、まだ結果の出ていない候補の数
+    closed: bool = False      # 目標達成・時間切れ（以降の結果は保存しない）
+    next_num: int = 1
+    hashes: set = field(default_factory=set)
+    fetch_started: Dict[str, float] = field(default_factory=dict)  # URL -> ダウンロード開始時刻
+    collected: List["CandidateTask"] = field(default_factory=list)  # 品質で選ぶ前の候補
+    cond: threading.Condition = field(default_factory=threading.Condition)
+    
+    @property
+    def item_dir(self) -> Path:
+        return OUTPUT_DIR / self.genre_id / self.item.id
+    
+    def finish(self, stored: bool = False):
+        """候補1件の処理が終わった（保存・失敗・重複・破棄）"""
+        with self.cond:
+            self.in_flight -= 1
+            if stored:
+                self.stored += 1
+            self.cond.notify_all()
+
+
+@dataclass
+class CandidateTask:
+    """ダウンロード対象の候補1件"""
+    job: ItemJob
+    row: object
+    content: Optional[bytes] = None
+    content_hash: Optional[str] = None
+    fetched_url: Optional[str] = None  # 実際にダウンロードしたURL（fallback_url のこともある）
+
+
+@dataclass
+class ItemDone:
+    """アイテムの処理がすべて終わった（パイプラインの最後まで流れる）"""
+    job: ItemJob
+
+
+def _candidate_stage(func):
+    """候補を処理するステージ用: ItemDone はそのまま次へ渡し、
+    例外で候補が失われた場合も schedule が待ち続けないよう finish する"""
+    def stage(task):
+        if isinstance(task, ItemDone):
+            yield task
+            return
+        try:
+            yield from func(task)
+        except Exception:
+            task.job.finish()
+            raise
+    return stage
+
+
+def _item_stage(func):
+    """アイテム単位のステージ用: 処理に失敗してもログに残して ItemDone を次へ渡す
+    （落とすと manifest ステージの残りアイテム数が 0 にならず manifest が更新されない）"""
+    def stage(done: ItemDone):
+        try:
+            func(done)
+        except Exception as e:
+            print(f"    [{done.job.item.id}] {func.__name__.replace('_stage', '')} error: {e}")
+        yield done
+    return stage
+
+
+def _prepare_job(job: ItemJob):
+    """既存の画像から次の番号と重複チェック用のハッシュを求める"""
+    job.item_dir.mkdir(parents=True, exist_ok=True)
+    existing_files = get_index(OUTPUT_DIR).list_images(job.item_dir)
+    # 最適化で内容が変わった画像は、元の内容のハッシュでも重複を判定する
+    for entry in load_sources(job.item_dir).values():
+        if entry.get("original_md5"):
+            job.hashes.add(entry["original_md5"])
+    max_num = 0
+    for f in existing_files:
+        try:
+            max_num = max(max_num, int(f.stem))
+        except ValueError:
+            pass
+        try:
+            job.hashes.add(hashlib.md5(f.read_bytes()).hexdigest()[:16])
+        except OSError:
+            pass
+    job.next_num = max_num + 1
+
+
+def _hedge_at(job: ItemJob) -> Optional[float]:
+    """最後に始めたダウンロードがホストのp95を超える時刻（呼び出し側で job.cond を取得済み）"""
+    if not HEDGE_REQUESTS or not job.fetch_started:
+        return None
+    url, started = max(job.fetch_started.items(), key=lambda kv: kv[1])
+    p95 = host_latency.percentile(url, HEDGE_PERCENTILE)
+    return None if p95 is None else started + p95
+
+
+def ingest_genres(genre_ids: List[str], target_count: int,
+                  prefetched: Optional[Dict[str, Dict[str, List[ImageCandidate]]]] = None,
+                  harvest: bool = True, item_workers: int = DOWNLOAD_WORKERS) -> int:
+    """ジャンルの全アイテムを目標枚数まで取り込む（ingest_items を参照）"""
+    units = [(g, item, target_count) for g in genre_ids for item in GENRES[g].items]
+    return ingest_items(units, prefetched, harvest, item_workers)
+
+
+def ingest_items(units: List[Tuple[str, ItemInfo, int]],
+                 prefetched: Optional[Dict[str, Dict[str, List[ImageCandidate]]]] = None,
+                 harvest: bool = True, item_workers: int = DOWNLOAD_WORKERS,
+                 update_manifests: bool = True,
+                 on_item_done: Optional[Callable[["ItemJob"], None]] = None,
+                 optimize: bool = OPTIMIZE_IMAGES,
+                 compute_boxes: bool = COMPUTE_SUBJECT_BOXES,
+                 extract_features: bool = EXTRACT_FEATURES,
+                 select_by_quality: bool = SELECT_BY_QUALITY) -> int:
+    """アイテムの画像を目標枚数まで取り込む（段階ごとに並列化したパイプライン）
+
+    units: [(ジャンルID, アイテム, 目標枚数), ...]
+
+    harvest   不足しているアイテムの候補をAPIから集めてDBに追加
+    schedule  アイテムごとにDBの候補をランク順に送り出す（目標枚数・時間・ヘッジを管理）
+    fetch     画像をダウンロード（ホストごとの同時接続数はAIMDで調整）
+    decode    画像としてデコードできるか確認
+    dedup     既存の画像と同じ内容なら除外
+    store     番号を付けて保存し、取得元を記録
+    select    品質で選ぶ場合（select_by_quality）は、store は不足枚数の QUALITY_OVERFETCH 倍まで
+              候補を集めるだけにしておき、アイテムの候補がそろったらまとめて採点して
+              （プロセスプール）、スコアの高い順に不足枚数まで保存する。残りは rejected にする
+    optimize  アイテムの画像がそろったら、未処理の JPEG を最適化（プロセスプール、optimize=False なら省略）
+    boxes     被写体・顔のボックスを計算（プロセスプール、compute_boxes=False なら省略）
+    manifest  ジャンルの（units に含まれる）全アイテムが終わったら manifest.json を更新
+              （update_manifests=False なら更新しない）。続けて新しい画像の特徴量を
+              計算する（プロセスプール、extract_features=False なら省略）。on_item_done があれば
+              アイテムごとに呼ぶ
+
+    ステージ間は上限付きのキューでつなぐ。harvest=False の場合はAPIに問い合わせず、
+    DBに残っている候補だけを使う。戻り値: 保存した画像の数
+    """
+    store = get_candidate_store()
+    negative_cache = get_negative_cache()
+    index = get_index(OUTPUT_DIR)
+    cursors = load_cursors()
+    loaded_cursors = copy.deepcopy(cursors)
+    
+    if harvest and prefetched is None:
+        short_items = [(item, needed) for g, item, target in units
+                       for needed in [_harvest_needed(g, item, target)] if needed]
+        if short_items:
+            max_results = max(needed for _, needed in short_items) * 3
+            prefetched = prefetch_candidates([item for item, _ in short_items], max_results)
+    
+    durations: List[float] = []
+    stored_total = 0
+    remaining_items: Dict[str, int] = {}
+    for g, _, _ in units:
+        remaining_items[g] = remaining_items.get(g, 0) + 1
+    remaining_lock = threading.Lock()
+    stored_lock = threading.Lock()
+    scorer = QualityScorer() if select_by_quality else None
+    optimizer = ImageOptimizer(OUTPUT_DIR) if optimize else None
+    boxer = SubjectBoxer() if compute_boxes else None
+    extractor = FeatureExtractor(OUTPUT_DIR) if extract_features and update_manifests else None
+    
+    def harvest_stage(job: ItemJob):
+        job.needed = max(0, job.target_count - index.count_images(job.item_dir))
+        job.quota = math.ceil(job.needed * QUALITY_OVERFETCH) if scorer is not None else job.needed
+        if (harvest and job.needed > 0
+                and store.count_pending(job.genre_id, job.item.id) < job.needed * 2):
+            harvest_item(job.genre_id, job.item, job.needed, cursors, prefetched)
+        yield job
+    
+    def schedule_stage(job: ItemJob):
+        started = time.monotonic()
+        if job.needed > 0:
+            _prepare_job(job)
+            rows = iter(store.pending(job.genre_id, job.item.id))
+            deadline = started + ITEM_TIME_BUDGET_SEC
+            exhausted = False
+            while True:
+                with job.cond:
+                    launch = False
+                    while not job.closed:
+                        now = time.monotonic()
+                        remaining = job.quota - job.stored
+                        if remaining <= 0:
+                            job.closed = True
+                        elif now >= deadline:
+                            print(f"    [{job.item.id}] 時間切れ（残りの候補は次回に回します）")
+                            job.closed = True
+                        elif exhausted:
+                            if job.in_flight == 0:
+                                job.closed = True
+                            else:
+                                job.cond.wait(deadline - now)
+                        else:
+                            limit = min(remaining, ITEM_MAX_IN_FLIGHT)
+                            hedge_at = _hedge_at(job) if job.in_flight >= limit else None
+                            if job.in_flight < limit or (hedge_at is not None and now >= hedge_at
+                                                         and job.in_flight < limit + HEDGE_EXTRA):
+                                launch = True
+                                break
+                            wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                            job.cond.wait(max(0.01, wake_at - now))
+                if not launch:
+                    break
+                
+                row = next((r for r in rows if host_breakers.available(r["url"])), None)
+                if row is None:
+                    exhausted = True  # ホストが落ちている候補は pending のまま残す
+                    continue
+                with job.cond:
+                    job.in_flight += 1
+                yield CandidateTask(job, row)
+            
+            # 送り出した候補の結果がすべて出るまで待つ
+            with job.cond:
+                while job.in_flight > 0:
+                    job.cond.wait()
+            if scorer is None:
+                status = "" if job.stored >= job.needed else "（候補不足）"
+                print(f"    [{job.item.id}] +{job.stored}枚 (計 {job.target_count - job.needed + job.stored}枚){status}")
+        durations.append(time.monotonic() - started)
+        yield ItemDone(job)
+    
+    @_candidate_stage
+    def fetch_stage(task: CandidateTask):
+        job, url = task.job, task.row["url"]
+        if job.closed:
+            job.finish()  # 結果を使わないので pending のまま残す
+            return
+        with job.cond:
+            job.fetch_started[url] = time.monotonic()
+        try:
+            task.content, task.fetched_url = fetch_image_bytes(url), url
+            fallback_url = task.row["fallback_url"]
+            if task.content is None and fallback_url:
+                # 縮小版（画像キャッシュなど）が取れなければ元のURLで取り直す
+                task.content, task.fetched_url = fetch_image_bytes(fallback_url), fallback_url
+        except HostBusyError:
+            job.finish()  # ホストが混雑・障害中なら pending のまま残す
+            return
+        finally:
+            with job.cond:
+                job.fetch_started.pop(url, None)
+        if task.content is None:
+            store.mark(job.genre_id, job.item.id, url, "failed")
+            job.finish()
+            return
+        yield task
+    
+    @_candidate_stage
+    def decode_stage(task: CandidateTask):
+        job, url = task.job, task.row["url"]
+        try:
+            with Image.open(io.BytesIO(task.content)) as img:
+                img.draft("RGB", (max(1, img.width // 8), max(1, img.height // 8)))
+                img.load()
+        except Exception:
+            negative_cache.add(task.fetched_url or url, "undecodable")
+            store.mark(job.genre_id, job.item.id, url, "failed")
+            job.finish()
+            return
+        yield task
+    
+    @_candidate_stage
+    def dedup_stage(task: CandidateTask):
+        job, url = task.job, task.row["url"]
+        task.content_hash = hashlib.md5(task.content).hexdigest()[:16]
+        if task.content_hash in job.hashes:
+            print(f"    [{job.item.id}] スキップ（重複）: {url[:50]}...")
+            store.mark(job.genre_id, job.item.id, url, "duplicate")
+            job.finish()
+            return
+        job.hashes.add(task.content_hash)
+        yield task
+    
+    def save_candidate(task: CandidateTask, quality: Optional[float] = None):
+        nonlocal stored_total
+        job, row = task.job, task.row
+        save_path = job.item_dir / f"{job.next_num:03d}.jpg"
+        save_path.write_bytes(task.content)
+        record_image_source(job.item_dir, save_path.name, task.fetched_url or row["url"], row["license_url"], quality)
+        store.mark(job.genre_id, job.item.id, row["url"], "downloaded", save_path.name)
+        job.next_num += 1
+        print(f"    [{job.item.id}] Downloaded: {save_path.name}")
+        with stored_lock:
+            stored_total += 1
+    
+    def store_stage(task):
+        if isinstance(task, ItemDone):
+            yield task
+            return
+        job = task.job
+        try:
+            if job.stored >= job.quota:
+                job.finish()  # 目標に達した後に届いた結果は使わない（pending のまま残す）
+                return
+            if scorer is not None:
+                job.collected.append(task)
+            else:
+                save_candidate(task)
+        except Exception:
+            job.finish()
+            raise
+        job.finish(stored=True)
+    
+    def select_stage(done: ItemDone):
+        job = done.job
+        candidates, job.collected = job.collected, []
+        if candidates:
+            scores = scorer.score([t.content for t in candidates])
+            keep = select_best(scores, job.needed, MIN_QUALITY)
+            for i in keep:
+                save_candidate(candidates[i], scores[i]["score"])
+            kept = set(keep)
+            for i, task in enumerate(candidates):
+                if i not in kept:
+                    store.mark(job.genre_id, job.item.id, task.row["url"], "rejected")
+            job.stored = len(keep)
+            status = "" if job.stored >= job.needed else "（候補不足）"
+            print(f"    [{job.item.id}] +{job.stored}枚 (計 {job.target_count - job.needed + job.stored}枚、"
+                  f"候補 {len(candidates)}枚から品質で選択){status}")
+        elif job.needed > 0:
+            print(f"    [{job.item.id}] +0枚 (計 {job.target_count - job.needed}枚)（候補不足）")
+    
+    def optimize_stage(done: ItemDone):
+        optimizer.optimize_item(done.job.genre_id, done.job.item_dir)
+    
+    def boxes_stage(done: ItemDone):
+        job = done.job
+        boxer.update_dir(job.item_dir, faces=GENRES[job.genre_id].detect_faces,
+                         files=index.list_images(job.item_dir))
+    
+    def manifest_stage(done: ItemDone):
+        genre_id = done.job.genre_id
+        if on_item_done is not None:
+            on_item_done(done.job)
+        with remaining_lock:
+            remaining_items[genre_id] -= 1
+            finished = remaining_items[genre_id] == 0
+        if finished and update_manifests:
+            manifest = update_manifest(genre_id)
+            print(f"  ✓ {genre_id}: manifest.json を更新しました")
+            if extractor is not None:
+                update_features(extractor, genre_id, manifest)
+        return ()
+    
+    stages = [
+        Stage("harvest", harvest_stage, workers=HARVEST_WORKERS),
+        Stage("schedule", schedule_stage, workers=item_workers),
+        Stage("fetch", fetch_stage, workers=FETCH_WORKERS),
+        Stage("decode", decode_stage, workers=DECODE_WORKERS),
+        Stage("dedup", dedup_stage),
+        Stage("store", store_stage),
+    ]
+    if scorer is not None:
+        stages.append(Stage("select", _item_stage(select_stage), workers=QUALITY_ITEM_WORKERS))
+    if optimizer is not None:
+        stages.append(Stage("optimize", _item_stage(optimize_stage), workers=OPTIMIZE_ITEM_WORKERS))
+    if boxer is not None:
+        stages.append(Stage("boxes", _item_stage(boxes_stage), workers=BOX_ITEM_WORKERS))
+    stages.append(Stage("manifest", manifest_stage))
+    jobs = (ItemJob(g, item, target) for g, item, target in units)
+    try:
+        stats = Pipeline(stages).run(jobs)
+    finally:
+        save_cursors(cursors, loaded_cursors)
+        save_host_state()
+        if scorer is not None:
+            scorer.close()
+        if optimizer is not None:
+            optimizer.close()
+        if boxer is not None:
+            boxer.close()
+        if extractor is not None:
+            extractor.close()
+    
+    print_stage_stats(stats)
+    if optimizer is not None:
+        print_optimize_report(optimizer.stats)
+    if durations:
+        p50, p95, p99 = (percentile(durations, q) for q in (50, 95, 99))
+        print(f"  アイテム完了時間: p50={p50:.1f}s p95={p95:.1f}s p99={p99:.1f}s")
+    limits = get_host_concurrency().limits()
+    if limits:
+        print("  同時接続数: " + ", ".join(f"{h}={l:g}" for h, l in sorted(limits.items())))
+    open_hosts = host_breakers.open_hosts()
+    if open_hosts:
+        print(f"  応答のないホスト（後で再試行）: {', '.join(sorted(open_hosts))}")
+    
+    return stored_total
 
 
 # =============================================================================
 # メイン処理
 # =============================================================================
 
-def download_genre(genre_id: str, images_per_type: int = IMAGES_PER_TYPE):
-    """指定ジャンルの画像をダウンロード"""
+def download_genre(genre_id: str, images_per_type: int = IMAGES_PER_TYPE,
+                   prefetched: Optional[Dict[str, Dict[str, List[ImageCandidate]]]] = None):
+    """指定ジャンルの画像をダウンロード（候補の収集 → ダウンロード）
+
+    prefetched を省略すると、不足しているアイテムの候補をまとめて先に取得する。
+    """
     if genre_id not in GENRES:
         print(f"Unknown genre: {genre_id}")
         print(f"Available genres: {', '.join(GENRES.keys())}")
@@ -576,68 +1510,10 @@ def download_genre(genre_id: str, images_per_type: int = IMAGES_PER_TYPE):
     print(f"アイテム数: {len(genre.items)}")
     print(f"{'='*60}")
     
-    manifest = {
-        "version": 1,
-        "genre": genre_id,
-        "display_name": genre.display_name,
-        "description": genre.description,
-        "types": {},
-        "similar_pairs": [{"id1": p.id1, "id2": p.id2} for p in genre.similar_pairs],
-    }
+    # 候補の収集 → ダウンロード → 検証 → 保存 → manifest.json の更新
+    ingest_genres([genre_id], images_per_type, prefetched)
     
-    for item in genre.items:
-        item_dir = genre_dir / item.id
-        item_dir.mkdir(exist_ok=True)
-        
-        print(f"\n  [{item.id}] {item.name_ja}")
-        
-        # 既存の画像を確認
-        existing = list(item_dir.glob("*.jpg")) + list(item_dir.glob("*.png"))
-        if len(existing) >= images_per_type:
-            print(f"    Already have {len(existing)} images, skipping")
-            manifest["types"][item.id] = {
-                "display_name": item.name_ja,
-                "count": len(existing),
-            }
-            continue
-        
-        # 画像URLを取得
-        urls = get_image_urls(item, max_results=images_per_type * 2)
-        print(f"    Found {len(urls)} URLs")
-        
-        if not urls:
-            print(f"    WARNING: No URLs found!")
-            manifest["types"][item.id] = {
-                "display_name": item.name_ja,
-                "count": 0,
-            }
-            continue
-        
-        # ダウンロード
-        downloaded = len(existing)
-        for i, url in enumerate(urls):
-            if downloaded >= images_per_type:
-                break
-            
-            save_path = item_dir / f"{downloaded + 1:03d}.jpg"
-            if download_image(url, save_path):
-                downloaded += 1
-                print(f"    Downloaded: {save_path.name}")
-            
-            time.sleep(0.3)  # レート制限対策
-        
-        manifest["types"][item.id] = {
-            "display_name": item.name_ja,
-            "count": downloaded,
-        }
-        print(f"    Total: {downloaded} images")
-    
-    # manifest.jsonを保存
-    manifest_path = genre_dir / "manifest.json"
-    with open(manifest_path, "w", encoding="utf-8") as f:
-        json.dump(manifest, f, ensure_ascii=False, indent=2)
-    
-    print(f"\n✓ manifest.json saved: {manifest_path}")
+    print(f"\n✓ manifest.json saved: {genre_dir / 'manifest.json'}")
     print(f"✓ Genre '{genre_id}' complete!")
 
 
@@ -658,16 +1534,13 @@ def show_genre_stats(genre_id: str):
     print(f"ジャンル: {genre.display_name} ({genre_id})")
     print(f"{'='*60}")
     
+    index = get_index(OUTPUT_DIR)
     total_images = 0
     min_count = float('inf')
     max_count = 0
     
     for item in genre.items:
-        item_dir = genre_dir / item.id
-        if item_dir.exists():
-            count = len(list(item_dir.glob("*.jpg")) + list(item_dir.glob("*.png")))
-        else:
-            count = 0
+        count = index.count_images(genre_dir / item.id)
         
         total_images += count
         min_count = min(min_count, count)
@@ -680,6 +1553,7 @@ def show_genre_stats(genre_id: str):
     print(f"合計: {total_images} 枚")
     print(f"最小: {min_count if min_count != float('inf') else 0} 枚, 最大: {max_count} 枚")
     
+    index.save()
     return min_count if min_count != float('inf') else 0
 
 
@@ -701,119 +1575,37 @@ def refill_genre(genre_id: str, target_count: int):
     print(f"目標枚数: 各タイプ {target_count} 枚")
     print(f"{'='*60}")
     
+    index = get_index(OUTPUT_DIR)
     for item in genre.items:
-        item_dir = genre_dir / item.id
-        item_dir.mkdir(exist_ok=True)
-        
-        # 既存の画像を確認
-        existing_files = sorted(item_dir.glob("*.jpg")) + sorted(item_dir.glob("*.png"))
-        current_count = len(existing_files)
-        
+        current_count = index.count_images(genre_dir / item.id)
         if current_count >= target_count:
-            print(f"\n  [{item.id}] {item.name_ja}: {current_count}枚 → スキップ")
-            continue
-        
-        needed = target_count - current_count
-        print(f"\n  [{item.id}] {item.name_ja}: {current_count}枚 → {needed}枚不足")
-        
-        # 既存のファイル名から次の番号を決定
-        max_num = 0
-        for f in existing_files:
-            try:
-                num = int(f.stem)
-                max_num = max(max_num, num)
-            except ValueError:
-                pass
-        
-        # 画像URLを取得（多めに取得）
-        urls = get_image_urls(item, max_results=needed * 3)
-        print(f"    Found {len(urls)} URLs")
-        
-        if not urls:
-            print(f"    WARNING: No URLs found!")
-            continue
-        
-        # 既存の画像のハッシュを取得（重複防止）
-        existing_hashes = set()
-        for f in existing_files:
-            try:
-                existing_hashes.add(hashlib.md5(f.read_bytes()).hexdigest()[:16])
-            except:
-                pass
-        
-        # ダウンロード
-        downloaded = 0
-        next_num = max_num + 1
-        
-        for url in urls:
-            if downloaded >= needed:
-                break
-            
-            # 一時的にダウンロードしてハッシュチェック
-            try:
-                response = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=15)
-                if response.status_code != 200 or len(response.content) < 1000:
-                    continue
-                
-                # 重複チェック
-                content_hash = hashlib.md5(response.content).hexdigest()[:16]
-                if content_hash in existing_hashes:
-                    print(f"    スキップ（重複）: {url[:50]}...")
-                    continue
-                
-                # 保存
-                save_path = item_dir / f"{next_num:03d}.jpg"
-                save_path.write_bytes(response.content)
-                existing_hashes.add(content_hash)
-                
-                downloaded += 1
-                next_num += 1
-                print(f"    Downloaded: {save_path.name}")
-                
-            except Exception as e:
-                print(f"    Error: {e}")
-            
-            time.sleep(0.3)
-        
-        print(f"    補填完了: +{downloaded}枚 (計 {current_count + downloaded}枚)")
+            print(f"  [{item.id}] {item.name_ja}: {current_count}枚 → スキップ")
+        else:
+            print(f"  [{item.id}] {item.name_ja}: {current_count}枚 → {target_count - current_count}枚不足")
     
-    # manifest.jsonを更新
-    update_manifest(genre_id)
+    ingest_genres([genre_id], target_count)
     print(f"\n✓ 補填ダウンロード完了!")
 
 
-def update_manifest(genre_id: str):
-    """manifest.jsonを現在の状態に更新"""
+def update_manifest(genre_id: str, write_binary: bool = False):
+    """manifest.jsonを現在の状態に更新（変更のあった画像だけ読み直す）"""
     if genre_id not in GENRES:
         return
     
     genre = GENRES[genre_id]
     genre_dir = OUTPUT_DIR / genre_id
     
-    manifest = {
-        "version": 1,
-        "genre": genre_id,
-        "display_name": genre.display_name,
-        "description": genre.description,
-        "types": {},
-        "similar_pairs": [{"id1": p.id1, "id2": p.id2} for p in genre.similar_pairs],
-    }
-    
-    for item in genre.items:
-        item_dir = genre_dir / item.id
-        if item_dir.exists():
-            count = len(list(item_dir.glob("*.jpg")) + list(item_dir.glob("*.png")))
-        else:
-            count = 0
-        
-        manifest["types"][item.id] = {
-            "display_name": item.name_ja,
-            "count": count,
-        }
-    
-    manifest_path = genre_dir / "manifest.json"
-    with open(manifest_path, "w", encoding="utf-8") as f:
-        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return write_manifest(
+        genre_dir,
+        header={
+            "genre": genre_id,
+            "display_name": genre.display_name,
+            "description": genre.description,
+        },
+        types=[(item.id, item.name_ja) for item in genre.items],
+        similar_pairs=[{"id1": p.id1, "id2": p.id2} for p in genre.similar_pairs],
+        write_binary=write_binary,
+    )
 
 
 def list_genres():
@@ -849,13 +1641,38 @@ def select_genre():
 
 
 def download_all_genres(images_per_type: int = IMAGES_PER_TYPE):
-    """全ジャンルをダウンロード"""
+    """全ジャンルをダウンロード
+
+    全ジャンルを1つのパイプラインで処理する（候補は全ジャンル分をまとめて先に取得し、
+    manifest.json はジャンルごとに全アイテムが終わった時点で更新する）。
+    """
+    print(f"\n{'='*60}")
+    print(f"全ジャンルをダウンロード: {len(GENRES)}ジャンル / 各タイプ {images_per_type} 枚")
+    print(f"{'='*60}")
     for genre_id in GENRES.keys():
-        download_genre(genre_id, images_per_type)
+        (OUTPUT_DIR / genre_id).mkdir(parents=True, exist_ok=True)
+    
+    ingest_genres(list(GENRES.keys()), images_per_type)
+
+
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # ZIP のエントリの日時（固定にして同じ内容なら同じバイト列にする）
+
+
+def add_to_zip(zf: zipfile.ZipFile, path: Path, arcname: str):
+    """ファイルを ZIP に追加（mtime・パーミッションは入れない）"""
+    info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    with open(path, "rb") as src, zf.open(info, "w") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
 
 
 def create_genre_zip(genre_id: str) -> Optional[Path]:
-    """ジャンルフォルダからZIPファイルを作成"""
+    """ジャンルフォルダからZIPファイルを作成
+
+    エントリは名前順・日時固定で書くので、画像と manifest が同じなら ZIP も同じバイト列になる
+    （publish は ZIP の SHA-256 で変更の有無を判断する）。
+    """
     if genre_id not in GENRES:
         print(f"Unknown genre: {genre_id}")
         return None
@@ -869,10 +1686,10 @@ def create_genre_zip(genre_id: str) -> Optional[Path]:
         return None
     
     # 画像数をカウント
-    image_count = 0
-    for item_dir in genre_dir.iterdir():
-        if item_dir.is_dir():
-            image_count += len(list(item_dir.glob("*.jpg")) + list(item_dir.glob("*.png")))
+    index = get_index(OUTPUT_DIR)
+    item_dirs = index.list_subdirs(genre_dir)
+    image_count = sum(index.count_images(item_dir) for item_dir in item_dirs)
+    index.save()
     
     if image_count == 0:
         print(f"画像がありません: {genre_dir}")
@@ -890,17 +1707,18 @@ def create_genre_zip(genre_id: str) -> Optional[Path]:
         # manifest.jsonを追加
         manifest_path = genre_dir / "manifest.json"
         if manifest_path.exists():
-            zf.write(manifest_path, "manifest.json")
+            add_to_zip(zf, manifest_path, "manifest.json")
+        binary_manifest_path = genre_dir / BINARY_MANIFEST_FILENAME
+        if binary_manifest_path.exists():
+            add_to_zip(zf, binary_manifest_path, BINARY_MANIFEST_FILENAME)
         
         # 各タイプのフォルダと画像を追加
-        for item_dir in sorted(genre_dir.iterdir()):
-            if item_dir.is_dir():
-                item_id = item_dir.name
-                for img_file in sorted(item_dir.glob("*")):
-                    if img_file.suffix.lower() in ['.jpg', '.jpeg', '.png']:
-                        arcname = f"{item_id}/{img_file.name}"
-                        zf.write(img_file, arcname)
-                        print(f"    追加: {arcname}")
+        for item_dir in item_dirs:
+            item_id = item_dir.name
+            for img_file in index.list_images(item_dir):
+                arcname = f"{item_id}/{img_file.name}"
+                add_to_zip(zf, img_file, arcname)
+                print(f"    追加: {arcname}")
     
     print(f"\n✓ ZIP作成完了: {zip_path}")
     print(f"  サイズ: {zip_path.stat().st_size / 1024 / 1024:.2f} MB")
@@ -918,8 +1736,478 @@ def create_all_genre_zips():
             print(f"スキップ（未ダウンロード）: {genre_id}")
 
 
+def find_latest_zip(genre_id: str) -> Optional[Path]:
+    """ジャンルの最新のZIP（create_genre_zipで作成したもの）"""
+    zips = sorted(OUTPUT_DIR.glob(f"{genre_id}_2*.zip"))
+    return zips[-1] if zips else None
+
+
+def verify_genre(genre_id: str, zip_path: Optional[Path] = None,
+                 max_workers: int = VERIFY_WORKERS) -> dict:
+    """ジャンルフォルダと最新のZIPの整合性をチェック"""
+    genre_dir = OUTPUT_DIR / genre_id
+    report = {"genre": genre_id, "dir": verify_genre_dir(genre_dir, max_workers)}
+    
+    zip_path = zip_path or find_latest_zip(genre_id)
+    if zip_path:
+        report["zip"] = verify_zip(zip_path, max_workers)
+    
+    report["ok"] = all(r["ok"] for r in (report.get("dir"), report.get("zip")) if r)
+    return report
+
+
+def print_verify_report(report: dict):
+    """整合性チェックの結果を表示"""
+    mark = "✓" if report["ok"] else "✗"
+    print(f"\n{mark} {report['genre']}")
+    for key in ("dir", "zip"):
+        result = report.get(key)
+        if not result:
+            continue
+        print(f"  {result['path']}: {result['images_checked']}枚, "
+              f"{len(result['errors'])}件のエラー ({result['elapsed_sec']}秒)")
+        for error in result["errors"][:10]:
+            print(f"    - {error['file']}: {error['error']}")
+        if len(result["errors"]) > 10:
+            print(f"    ... 他 {len(result['errors']) - 10}件")
+
+
+def run_verify(genre_ids: List[str], zip_path: Optional[str], output: Optional[str],
+               max_workers: int) -> int:
+    """verifyコマンド: 結果をJSONで出力し、問題があれば終了コード1を返す"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    genre_ids = genre_ids or [g for g in GENRES if (OUTPUT_DIR / g).exists()]
+    reports = [
+        verify_genre(g, Path(zip_path) if zip_path else None, max_workers)
+        for g in genre_ids
+    ]
+    result = {"ok": all(r["ok"] for r in reports), "genres": reports}
+    
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if output:
+        Path(output).write_text(text, encoding="utf-8")
+    else:
+        print(text)
+    return 0 if result["ok"] else 1
+
+
+def run_phase(command: str, genre_ids: List[str], count: int, max_workers: int) -> int:
+    """harvest / fetch コマンド"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    for genre_id in genre_ids or list(GENRES.keys()):
+        print(f"\n=== {command}: {genre_id} ===")
+        if command == "harvest":
+            harvest_genre(genre_id, count)
+        else:
+            ingest_genres([genre_id], count, harvest=False, item_workers=max_workers)
+    return 0
+
+
+def run_optimize(genre_ids: List[str], workers: int) -> int:
+    """optimize コマンド: 保存済みの画像を最適化して manifest.json を更新"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    optimizer = ImageOptimizer(OUTPUT_DIR, workers)
+    try:
+        for genre_id in genre_ids or list(GENRES.keys()):
+            genre_dir = OUTPUT_DIR / genre_id
+            if not genre_dir.exists():
+                continue
+            print(f"=== optimize: {genre_id} ===")
+            for item in GENRES[genre_id].items:
+                if (genre_dir / item.id).is_dir():
+                    optimizer.optimize_item(genre_id, genre_dir / item.id)
+            update_manifest(genre_id)
+    finally:
+        optimizer.close()
+    print_optimize_report(optimizer.stats)
+    return 0
+
+
+def run_boxes(genre_ids: List[str], workers: int) -> int:
+    """boxes コマンド: 保存済みの画像の被写体・顔のボックスを計算して manifest.json を更新"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    index = get_index(OUTPUT_DIR)
+    boxer = SubjectBoxer(workers)
+    try:
+        for genre_id in genre_ids or list(GENRES.keys()):
+            genre_dir = OUTPUT_DIR / genre_id
+            if not genre_dir.exists():
+                continue
+            computed = 0
+            for item in GENRES[genre_id].items:
+                item_dir = genre_dir / item.id
+                if item_dir.is_dir():
+                    computed += boxer.update_dir(item_dir, faces=GENRES[genre_id].detect_faces,
+                                                 files=index.list_images(item_dir))
+            update_manifest(genre_id)
+            print(f"  {genre_id}: {computed}枚のボックスを計算")
+    finally:
+        boxer.close()
+    if boxer.errors:
+        print(f"読み込めなかった画像: {boxer.errors}枚", file=sys.stderr)
+    return 0
+
+
+def update_features(extractor: FeatureExtractor, genre_id: str, manifest: dict) -> int:
+    """特徴量を更新し、紛らわしいアイテムの組が変わったら manifest.json を作り直す。戻り値は計算した枚数"""
+    computed = extractor.update_genre(genre_id, manifest)
+    if AUTO_SIMILAR_PAIRS and confusability.update_auto_pairs(OUTPUT_DIR, genre_id, extractor.store):
+        update_manifest(genre_id)
+        print(f"  ✓ {genre_id}: similar_pairs を更新しました")
+    return computed
+
+
+def run_features(genre_ids: List[str], workers: int, embed_model: Optional[str]) -> int:
+    """features コマンド: manifest.json の画像のうち、新しい・変わったものの特徴量を計算"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    try:
+        extractor = FeatureExtractor(OUTPUT_DIR, workers, embed_model)
+    except RuntimeError as e:
+        print(f"[error] {e}", file=sys.stderr)
+        return 2
+    try:
+        for genre_id in genre_ids or list(GENRES.keys()):
+            if not (OUTPUT_DIR / genre_id).exists():
+                continue
+            computed = update_features(extractor, genre_id, update_manifest(genre_id))
+            print(f"  {genre_id}: {computed}枚の特徴量を計算")
+    finally:
+        extractor.close()
+    print(f"特徴量: {extractor.store.dir}（{len(extractor.store.items)}枚）")
+    if extractor.errors:
+        print(f"読み込めなかった画像: {extractor.errors}枚", file=sys.stderr)
+    return 0
+
+
+def run_enqueue(queue_path: Path, genre_ids: List[str], count: int, reset: bool) -> int:
+    """enqueue コマンド: ジャンルのアイテムを作業キューに追加"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    queue = WorkQueue(queue_path)
+    try:
+        units = [(g, item.id) for g in genre_ids or list(GENRES.keys()) for item in GENRES[g].items]
+        added = queue.enqueue(units, count, reset=reset)
+        print(f"作業キュー: {queue_path}（{added}件を追加・更新 / 全{len(units)}件）")
+    finally:
+        queue.close()
+    return 0
+
+
+def run_worker(queue_path: Path, batch_size: int, item_workers: int,
+               worker_id: Optional[str] = None, shared_storage: bool = False) -> int:
+    """worker コマンド: 作業キューからアイテムを借りて取り込む
+
+    借りている間はリースを定期的に延長し、止まった場合は期限切れで他のワーカーに引き継がれる。
+    manifest.json と ZIP はコーディネーターが作るので、ワーカーは更新しない。
+    shared_storage=True の場合、候補DBを共有ストレージ向けのジャーナルで開く。
+    """
+    owner = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    get_candidate_store(wal=not shared_storage)
+    queue = WorkQueue(queue_path)
+    print(f"ワーカー {owner}: {queue_path}")
+    
+    try:
+        while True:
+            rows = queue.claim(owner, batch_size)
+            if not rows:
+                if not queue.has_open_units():
+                    break
+                time.sleep(WORKER_POLL_SEC)  # 他のワーカーのリース切れを待つ
+                continue
+            
+            held = set()
+            units = []
+            for row in rows:
+                items = {item.id: item for item in GENRES[row["genre_id"]].items} if row["genre_id"] in GENRES else {}
+                if row["item_id"] in items:
+                    units.append((row["genre_id"], items[row["item_id"]], row["target_count"]))
+                    held.add((row["genre_id"], row["item_id"]))
+                else:
+                    queue.complete(owner, row["genre_id"], row["item_id"], error="unknown item")
+            print(f"\n[{owner}] {len(units)}件を処理: " + ", ".join(f"{g}/{i.id}" for g, i, _ in units))
+            
+            held_lock = threading.Lock()
+            stop = threading.Event()
+            
+            def heartbeat():
+                while not stop.wait(queue.lease_sec / 3):
+                    with held_lock:
+                        current = list(held)
+                    for genre_id, item_id in queue.heartbeat(owner, current):
+                        print(f"  WARNING: {genre_id}/{item_id} のリースが他のワーカーに移りました")
+            
+            def on_item_done(job: ItemJob):
+                images = job.target_count - job.needed + job.stored
+                queue.complete(owner, job.genre_id, job.item.id, images=images)
+                with held_lock:
+                    held.discard((job.genre_id, job.item.id))
+            
+            beat = threading.Thread(target=heartbeat, daemon=True)
+            beat.start()
+            error: Optional[Exception] = None
+            try:
+                ingest_items(units, item_workers=item_workers,
+                             update_manifests=False, on_item_done=on_item_done)
+            except Exception as e:
+                error = e
+                print(f"  ERROR: {e}")
+            finally:
+                stop.set()
+                beat.join()
+            # 最後まで終わらなかったアイテムは再試行に回す
+            for genre_id, item_id in held:
+                queue.complete(owner, genre_id, item_id, error=str(error or "not finished"))
+    finally:
+        queue.release(owner)
+        queue.close()
+    
+    print(f"ワーカー {owner}: 処理できる作業がなくなりました")
+    return 0
+
+
+def run_coordinator(queue_path: Path, make_zip: bool, poll_sec: float) -> int:
+    """coordinate コマンド: 全アイテムが終わったジャンルから manifest.json と ZIP を作る"""
+    queue = WorkQueue(queue_path)
+    extractor = FeatureExtractor(OUTPUT_DIR) if EXTRACT_FEATURES else None
+    try:
+        while True:
+            for genre_id in queue.genres_ready():
+                if genre_id in GENRES:
+                    manifest = update_manifest(genre_id)
+                    print(f"✓ {genre_id}: manifest.json を更新しました")
+                    if extractor is not None:
+                        update_features(extractor, genre_id, manifest)
+                    if make_zip:
+                        create_genre_zip(genre_id)
+                queue.mark_finalized(genre_id)
+            
+            if not queue.unfinalized_genres():
+                break
+            progress = queue.progress()
+            summary = ", ".join(
+                f"{g} {counts.get('done', 0) + counts.get('failed', 0)}/{sum(counts.values())}"
+                for g, counts in sorted(progress.items()) if g in queue.unfinalized_genres())
+            print(f"  進捗: {summary}")
+            time.sleep(poll_sec)
+        
+        failed = [(g, counts["failed"]) for g, counts in sorted(queue.progress().items()) if counts.get("failed")]
+    finally:
+        queue.close()
+        if extractor is not None:
+            extractor.close()
+    
+    for genre_id, count in failed:
+        print(f"  WARNING: {genre_id}: {count}件のアイテムが失敗しました")
+    print("✓ すべてのジャンルが完了しました")
+    return 1 if failed else 0
+
+
+def run_publish(target_spec: str, genre_ids: List[str], build: bool, workers: int,
+                dry_run: bool, force: bool, endpoint: Optional[str]) -> int:
+    """publish コマンド: 各ジャンルの最新のZIPのうち、配信先と内容が違うものだけをアップロード"""
+    unknown = [g for g in genre_ids if g not in GENRES]
+    if unknown:
+        print(f"Unknown genre: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    
+    genre_ids = genre_ids or [g for g in GENRES if (OUTPUT_DIR / g).exists()]
+    if build:
+        for genre_id in genre_ids:
+            create_genre_zip(genre_id)
+    
+    archives = {}
+    for genre_id in genre_ids:
+        zip_path = find_latest_zip(genre_id)
+        if zip_path is None:
+            print(f"スキップ（ZIPがありません）: {genre_id}")
+            continue
+        archives[genre_id] = zip_path
+    if not archives:
+        print("公開するZIPがありません（--build で作成できます）", file=sys.stderr)
+        return 2
+    
+    try:
+        target = open_target(target_spec, endpoint)
+        report = publisher.publish(archives, target, workers, dry_run, force)
+    except PublishError as e:
+        print(f"公開できませんでした: {e}", file=sys.stderr)
+        return 2
+    print_publish_report(report, target)
+    return 1 if report.failed else 0
+
+
+def start_profiling(output: str, cprofile_spans: List[str], trace_memory: bool):
+    """--profile: 主な処理を自動でスパンとして記録する
+
+    パイプラインの各ステージはタスクごとに記録される。それ以外に、名前解決（dns）・
+    接続とTLS（connect）・HTTPリクエスト・ハッシュ計算・manifest・ZIP書き込みを包む。
+    """
+    import urllib3.connection
+
+    profiling.enable_profiling(Path(output), set(cprofile_spans or ()), trace_memory)
+    this_module = sys.modules[__name__]
+    targets = [
+        (socket, "getaddrinfo", "net", "dns"),
+        (urllib3.connection.HTTPConnection, "connect", "net", "connect"),
+        (urllib3.connection.HTTPSConnection, "connect", "net", "connect+tls"),
+        (this_module, "http_get", "http", None),
+        (this_module, "prefetch_candidates", "api", None),
+        (this_module, "harvest_item", "api", None),
+        (this_module, "_prepare_job", "hash", "hash_existing"),
+        (this_module, "update_manifest", "manifest", None),
+        (this_module, "create_genre_zip", "zip", None),
+        (this_module, "verify_genre", "verify", None),
+        (ImageOptimizer, "optimize_item", "optimize", None),
+        (QualityScorer, "score", "quality", None),
+        (SubjectBoxer, "update_dir", "boxes", None),
+        (FeatureExtractor, "update_genre", "features", None),
+        (confusability, "update_auto_pairs", "similar_pairs", None),
+        (manifest_writer, "build_image_entry", "hash", "hash_image"),
+        (manifest_writer, "write_json_atomic", "io", None),
+        (publisher.DirectoryTarget, "upload", "publish", None),
+        (publisher.S3Target, "upload", "publish", None),
+        (publisher, "sha256_file", "hash", "hash_archive"),
+        (this_module, "write_manifest", "manifest", None),
+        (test_set_verifier, "check_image_bytes", "verify", None),
+        (this_module, "add_to_zip", "zip", "zip_write"),
+    ]
+    for owner, attr, cat, name in targets:
+        profiling.instrument(owner, attr, cat, name)
+
+
+def parse_args(argv=None):
+    """コマンドライン引数（省略時は対話メニュー）"""
+    parser = argparse.ArgumentParser(description="テストセット画像ダウンローダー")
+    parser.add_argument("--profile", metavar="TRACE_JSON",
+                        help="処理時間を Chrome trace-event 形式で記録（chrome://tracing / Perfetto で表示）")
+    parser.add_argument("--profile-stage", action="append", default=[], metavar="NAME",
+                        help="このスパン（例: decode, fetch, update_manifest）の間 cProfile で計測し .prof に出力（複数可）")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="--profile と併用: メモリ使用量を記録し、割り当ての多い箇所を .allocs.txt に出力")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    verify_parser = subparsers.add_parser("verify", help="テストセットとZIPの整合性をチェック")
+    verify_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時はダウンロード済みの全ジャンル）")
+    verify_parser.add_argument("--zip", help="チェックするZIP（省略時はジャンルの最新ZIP）")
+    verify_parser.add_argument("--output", "-o", help="結果JSONの出力先（省略時は標準出力）")
+    verify_parser.add_argument("--workers", type=int, default=VERIFY_WORKERS, help="並列数")
+    
+    harvest_parser = subparsers.add_parser("harvest", help="候補URLを収集してDBに保存（ダウンロードしない）")
+    harvest_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時は全ジャンル）")
+    harvest_parser.add_argument("--count", type=int, default=IMAGES_PER_TYPE, help="各タイプの目標枚数")
+    
+    fetch_parser = subparsers.add_parser("fetch", help="DBの候補URLをダウンロード（APIに問い合わせない）")
+    fetch_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時は全ジャンル）")
+    fetch_parser.add_argument("--count", type=int, default=IMAGES_PER_TYPE, help="各タイプの目標枚数")
+    fetch_parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS, help="同時に処理するアイテム数")
+    
+    optimize_parser = subparsers.add_parser("optimize", help="保存済みの JPEG を最適化（メタデータの削除など）")
+    optimize_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時は全ジャンル）")
+    optimize_parser.add_argument("--workers", type=int, default=OPTIMIZE_WORKERS, help="プロセス数")
+    
+    boxes_parser = subparsers.add_parser("boxes", help="被写体・顔のボックスを計算して manifest.json に入れる")
+    boxes_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時は全ジャンル）")
+    boxes_parser.add_argument("--workers", type=int, default=BOX_WORKERS, help="プロセス数")
+    
+    features_parser = subparsers.add_parser("features", help="画像の特徴量（色・pHash など）を計算して保存")
+    features_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時は全ジャンル）")
+    features_parser.add_argument("--workers", type=int, default=FEATURE_WORKERS, help="プロセス数")
+    features_parser.add_argument("--embed-model", help="埋め込みを計算する ONNX モデル（任意、onnxruntime が必要）")
+    
+    enqueue_parser = subparsers.add_parser("enqueue", help="ジャンルのアイテムを作業キューに追加（複数ワーカーで分担）")
+    enqueue_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時は全ジャンル）")
+    enqueue_parser.add_argument("--count", type=int, default=IMAGES_PER_TYPE, help="各タイプの目標枚数")
+    enqueue_parser.add_argument("--reset", action="store_true", help="登録済みのアイテムも未処理に戻す")
+    enqueue_parser.add_argument("--queue", default=str(WORK_QUEUE_PATH), help="作業キューのファイル")
+    
+    worker_parser = subparsers.add_parser("worker", help="作業キューからアイテムを借りて取り込む")
+    worker_parser.add_argument("--queue", default=str(WORK_QUEUE_PATH), help="作業キューのファイル")
+    worker_parser.add_argument("--batch", type=int, default=WORKER_BATCH_SIZE, help="一度に借りるアイテム数")
+    worker_parser.add_argument("--workers", type=int, default=DOWNLOAD_WORKERS, help="同時に処理するアイテム数")
+    worker_parser.add_argument("--id", help="ワーカー名（省略時は ホスト名:PID）")
+    worker_parser.add_argument("--shared-storage", action="store_true",
+                               help="複数のマシンで共有ストレージを使う（候補DBでWALを使わない）")
+    
+    coordinate_parser = subparsers.add_parser("coordinate", help="完了したジャンルの manifest.json・ZIPを作成")
+    coordinate_parser.add_argument("--queue", default=str(WORK_QUEUE_PATH), help="作業キューのファイル")
+    coordinate_parser.add_argument("--zip", action="store_true", help="ZIPも作成する")
+    coordinate_parser.add_argument("--poll", type=float, default=WORKER_POLL_SEC, help="進捗を確認する間隔（秒）")
+    
+    publish_parser = subparsers.add_parser("publish", help="内容が変わったZIPだけを配信先（S3互換・フォルダ）にアップロード")
+    publish_parser.add_argument("target", help="配信先（s3://バケット/プレフィックス またはフォルダ）")
+    publish_parser.add_argument("genres", nargs="*", help="ジャンルID（省略時はダウンロード済みの全ジャンル）")
+    publish_parser.add_argument("--build", action="store_true", help="先にZIPを作成する")
+    publish_parser.add_argument("--workers", type=int, default=PUBLISH_WORKERS, help="同時にアップロードするZIPの数")
+    publish_parser.add_argument("--dry-run", action="store_true", help="アップロードするZIPを表示するだけ")
+    publish_parser.add_argument("--force", action="store_true", help="変わっていないZIPもアップロードする")
+    publish_parser.add_argument("--endpoint", help="S3 互換 API の URL（省略時は S3_ENDPOINT_URL か AWS）")
+    
+    return parser.parse_args(argv)
+
+
 def main():
     """メイン関数"""
+    args = parse_args()
+    if args.profile:
+        start_profiling(args.profile, args.profile_stage, args.tracemalloc)
+    try:
+        with profiling.span(args.command or "menu", cat="command"):
+            run_command(args)
+    finally:
+        for path in profiling.finish_profiling():
+            print(f"プロファイル: {path}")
+
+
+def run_command(args):
+    """サブコマンドを実行（省略時は対話メニュー）"""
+    if args.command == "verify":
+        sys.exit(run_verify(args.genres, args.zip, args.output, args.workers))
+    if args.command in ("harvest", "fetch"):
+        sys.exit(run_phase(args.command, args.genres, args.count, getattr(args, "workers", DOWNLOAD_WORKERS)))
+    if args.command == "optimize":
+        sys.exit(run_optimize(args.genres, args.workers))
+    if args.command == "boxes":
+        sys.exit(run_boxes(args.genres, args.workers))
+    if args.command == "features":
+        sys.exit(run_features(args.genres, args.workers, args.embed_model))
+    if args.command == "enqueue":
+        sys.exit(run_enqueue(Path(args.queue), args.genres, args.count, args.reset))
+    if args.command == "worker":
+        sys.exit(run_worker(Path(args.queue), args.batch, args.workers, args.id, args.shared_storage))
+    if args.command == "coordinate":
+        sys.exit(run_coordinator(Path(args.queue), args.zip, args.poll))
+    if args.command == "publish":
+        sys.exit(run_publish(args.target, args.genres, args.build, args.workers,
+                             args.dry_run, args.force, args.endpoint))
+    
+    interactive_menu()
+
+
+def interactive_menu():
+    """対話メニュー"""
     print("="*60)
     print("  テストセット画像ダウンローダー")
     print("  (iNaturalist / GBIF / Dog API / Cat API / Wikimedia)")
@@ -936,6 +2224,8 @@ def main():
         print("5. 補填ダウンロード（不足分を追加）")
         print("6. 特定のジャンルをZIP化")
         print("7. 全ジャンルをZIP化")
+        print("8. manifest.jsonを更新（manifest.binも出力）")
+        print("9. 整合性チェック（画像・ZIP）")
         print("0. 終了")
         
         choice = input("\n番号を入力: ").strip()
@@ -971,6 +2261,15 @@ def main():
                 create_genre_zip(genre_id)
         elif choice == "7":
             create_all_genre_zips()
+        elif choice == "8":
+            genre_id = select_genre()
+            if genre_id:
+                update_manifest(genre_id, write_binary=True)
+                print(f"✓ manifest.json / {BINARY_MANIFEST_FILENAME} を更新しました")
+        elif choice == "9":
+            genre_id = select_genre()
+            if genre_id:
+                print_verify_report(verify_genre(genre_id))
         elif choice == "0":
             print("終了します")
             break
@@ -0,0 +1,759 @@
+"""
+クイズ結果・推論結果の集計（Realtime Database のエクスポートから）
+
+Firebase コンソールからエクスポートした JSON（数百MB〜になる）を丸ごと読み込まずに
+少しずつ読み、集計に必要な項目だけを列ごとのファイル（列指向）に保存してから、
+NumPy でまとめて集計する。
+
+読み込む場所:
+- users/{uid}/histories/{historyId}   人のクイズ履歴（questionResults を1問1行にする）
+- runs/{runId}/{imageId}              エンジンの推論結果（engine-test・engine_runner.py）
+- engine_runner.py --output の結果JSON（ResultRecord のリスト）
+
+保存形式（--store のフォルダ）:
+  human/part-000001/{列名}.npy   人の回答（1問1行）
+  engine/part-000001/{列名}.npy  推論結果（1枚1行）
+  state.json                     読み込んだファイル（サイズ・更新日時）
+ingest のたびに新しいレコード（履歴ID・runId/imageId がまだ無いもの）だけを
+パートとして追加する。読み込み済みのレコードはデコードせずに読み飛ばす。
+
+集計（report）:
+- 正答率       人: ジャンル別・ペア別・アイテム別 / エンジン: エンジン・ジャンル・ラベル別（top1）
+- 人とエンジン ペア（同じ/違う）ごとの正答率の比較と一致度（エンジンは問題形式の実行のみ）
+- 推論時間     エンジン・プロバイダ別のパーセンタイル
+
+人の履歴の問題は表示名（「柴犬 × 秋田犬」）なので、--test-sets の manifest.json で
+タイプIDに直してからエンジンの結果と突き合わせる。
+
+使い方:
+  python tools/result_analytics.py ingest export.json results.json --store analytics
+  python tools/result_analytics.py report --store analytics --json report.json
+"""
+
+import re
+import sys
+import json
+import shutil
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from manifest_writer import MANIFEST_FILENAME, write_json_atomic
+
+
+STORE_DIR = Path("analytics")   # 列指向の保存先
+TEST_SETS_DIR = Path("test_sets")
+READ_CHUNK = 1 << 20            # ファイルを読む単位（文字数）
+PAIR_SEPARATOR = " × "          # 問題の description の区切り（ZipQuizQuestion.description）
+MIN_PAIR_ANSWERS = 5            # 人とエンジンの比較に使うペアの最小回答数
+TOP_ROWS = 20                   # 表に出す行数
+LATENCY_PERCENTILES = (50, 90, 95, 99)
+STATE_FILENAME = "state.json"
+
+HISTORY_PATTERN = ("users", "*", "histories", "*")
+RUN_PATTERN = ("runs", "*", "*")
+
+# テーブルごとの列（名前 → dtype。str は可変長の Unicode）
+HUMAN_COLUMNS = {
+    "key": str,             # {uid}/{historyId}
+    "uid": str,
+    "genre": str,
+    "responder": str,
+    "timestamp": np.int64,  # 回答日時（ミリ秒）
+    "question": np.int32,
+    "type1": str,
+    "type2": str,
+    "was_same": np.bool_,
+    "answered_same": np.bool_,
+    "correct": np.bool_,
+}
+ENGINE_COLUMNS = {
+    "key": str,             # {runId}/{imageId}
+    "run_id": str,
+    "image_id": str,
+    "engine": str,
+    "provider": str,
+    "genre": str,
+    "label": str,
+    "top1": str,
+    "top1_score": np.float32,
+    "latency_ms": np.float32,
+    "timestamp": np.int64,
+    "question": np.int32,   # 問題形式でなければ -1
+    "position": np.int8,
+    "is_same": np.int8,     # 1 / 0、問題形式でなければ -1
+    "type1": str,
+    "type2": str,
+}
+TABLES = {"human": HUMAN_COLUMNS, "engine": ENGINE_COLUMNS}
+
+
+# =============================================================================
+# JSON の逐次読み込み
+# =============================================================================
+
+_NON_SPACE = re.compile(r"\S")
+_STRUCTURAL = re.compile(r'["{}\[\]]')
+_STRING_TAIL = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_decoder = json.JSONDecoder()
+
+
+class JsonStream:
+    """ファイルを少しずつ読みながら JSON をたどる（必要な値だけデコードする）"""
+
+    def __init__(self, f, chunk: int = READ_CHUNK):
+        self.f = f
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """読み終わった部分を捨てて続きを読む。ファイルの終わりなら False"""
+        data = self.f.read(self.chunk)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """次の空白以外の文字（ファイルの終わりなら空文字）"""
+        while True:
+            m = _NON_SPACE.search(self.buf, self.pos)
+            if m:
+                self.pos = m.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            if not self._fill():
+                return ""
+
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"'{ch}' が必要です（{self.buf[self.pos:self.pos + 20]!r}）")
+        self.pos += 1
+
+    def value(self):
+        """次の値をデコードする（レコード1件分など、小さい値に使う）"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # 数値はバッファの終わりで切れていても読めてしまうので、続きを読んでから確定する
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def skip(self):
+        """次の値をデコードせずに読み飛ばす"""
+        if self.peek() not in "{[":
+            self.value()
+            return
+        depth = 0
+        while True:
+            m = _STRUCTURAL.search(self.buf, self.pos)
+            if not m:
+                self.pos = len(self.buf)
+                if not self._fill():
+                    raise ValueError("JSON が途中で終わっています")
+                continue
+            ch = m.group()
+            self.pos = m.end()
+            if ch == '"':
+                while not (m := _STRING_TAIL.match(self.buf, self.pos)):
+                    if not self._fill():
+                        raise ValueError("文字列が途中で終わっています")
+                self.pos = m.end()
+            elif ch in "{[":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def members(self) -> Iterator[str]:
+        """オブジェクトのキーを順に返す（値は呼び出し側が value / skip で読む）"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def elements(self) -> Iterator[str]:
+        """配列の要素を順に返す（キーは添字の文字列。RTDB は連番のキーを配列で書き出す）"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield str(index)
+            index += 1
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+
+def _matches(pattern: Sequence[str], path: Sequence[str]) -> bool:
+    return len(pattern) == len(path) and all(p in ("*", k) for p, k in zip(pattern, path))
+
+
+def _is_prefix(pattern: Sequence[str], path: Sequence[str]) -> bool:
+    return len(path) < len(pattern) and all(p in ("*", k) for p, k in zip(pattern, path))
+
+
+def iter_records(stream: JsonStream, patterns: Sequence[Sequence[str]],
+                 wanted: Callable[[Tuple[str, ...]], bool] = lambda path: True
+                 ) -> Iterator[Tuple[Tuple[str, ...], object]]:
+    """パターンに一致する場所の値を（パス, 値）で返す
+
+    パターンにつながらない部分木と、wanted が False のレコードはデコードせずに読み飛ばす。
+    """
+    def walk(path: Tuple[str, ...]):
+        if any(_matches(p, path) for p in patterns):
+            if wanted(path):
+                yield path, stream.value()
+            else:
+                stream.skip()
+            return
+        ch = stream.peek()
+        if ch not in "{[" or not any(_is_prefix(p, path) for p in patterns):
+            stream.skip()
+            return
+        keys = stream.members() if ch == "{" else stream.elements()
+        for key in keys:
+            yield from walk(path + (key,))
+
+    yield from walk(())
+
+
+# =============================================================================
+# レコード → 行
+# =============================================================================
+
+def _split_pair(description: str, was_same: bool) -> Tuple[str, str]:
+    """「柴犬 × 秋田犬」→（柴犬, 秋田犬）"""
+    left, sep, right = (description or "").partition(PAIR_SEPARATOR)
+    if not sep:
+        return left.strip(), left.strip() if was_same else ""
+    return left.strip(), right.strip()
+
+
+def _as_list(value) -> list:
+    """RTDB は配列を連番キーのオブジェクトで返すことがある"""
+    if isinstance(value, dict):
+        return [value[k] for k in sorted(value, key=lambda k: int(k) if str(k).isdigit() else 0)]
+    return value if isinstance(value, list) else []
+
+
+def human_rows(uid: str, history_id: str, history: dict) -> List[dict]:
+    """クイズ履歴1件 → 1問1行"""
+    if not isinstance(history, dict):
+        return []
+    base = {
+        "key": f"{uid}/{history_id}",
+        "uid": uid,
+        "genre": str(history.get("genre") or ""),
+        "responder": str(history.get("responderName") or ""),
+        "timestamp": int(history.get("timestamp") or 0),
+    }
+    rows = []
+    for result in _as_list(history.get("questionResults")):
+        if not isinstance(result, dict):
+            continue
+        was_same = bool(result.get("wasSame"))
+        type1, type2 = _split_pair(result.get("description", ""), was_same)
+        rows.append({
+            **base,
+            "question": int(result.get("questionNumber") or 0),
+            "type1": type1,
+            "type2": type2,
+            "was_same": was_same,
+            "answered_same": bool(result.get("answeredSame")),
+            "correct": bool(result.get("isCorrect")),
+        })
+    return rows
+
+
+def _genre_of_source(source: str) -> str:
+    """meta.source（ZIP・フォルダ）からジャンルID（dogs_20250101_120000.zip → dogs）"""
+    stem = Path(source).stem if source else ""
+    return re.sub(r"_\d{8}_\d{6}$", "", stem)
+
+
+def _parse_time(value) -> int:
+    """ISO 8601 の timestamp（ミリ秒まで、末尾 Z）→ エポックミリ秒"""
+    if not isinstance(value, str):
+        return int(value or 0)
+    try:
+        value = np.datetime64(value.rstrip("Z"), "ms")
+    except ValueError:
+        return 0
+    return int(value.astype(np.int64))
+
+
+def engine_row(key: str, record: dict) -> dict:
+    """推論結果1件 → 1行"""
+    meta = record.get("meta") if isinstance(record.get("meta"), dict) else {}
+    predictions = _as_list(record.get("predictions"))
+    top = max(predictions, key=lambda p: p.get("score", 0), default={}) if predictions else {}
+    is_same = meta.get("isSame")
+    return {
+        "key": key,
+        "run_id": str(record.get("runId") or key.split("/")[0]),
+        "image_id": str(record.get("imageId") or key.partition("/")[2]),
+        "engine": str(record.get("engine") or ""),
+        "provider": str(record.get("provider") or ""),
+        "genre": _genre_of_source(str(meta.get("source") or "")),
+        "label": str(record.get("label") or ""),
+        "top1": str(top.get("label") or ""),
+        "top1_score": float(top.get("score") or 0.0),
+        "latency_ms": float(record.get("latencyMs") or 0.0),
+        "timestamp": _parse_time(record.get("timestamp")),
+        "question": int(meta.get("questionIndex") or -1),
+        "position": int(meta.get("position") or 0),
+        "is_same": -1 if is_same is None else int(bool(is_same)),
+        "type1": str(meta.get("type1") or ""),
+        "type2": str(meta.get("type2") or ""),
+    }
+
+
+def _engine_records(key: str, value) -> Iterator[Tuple[str, dict]]:
+    """runs/{runId}/ 以下の推論結果（imageId に / が入るとさらに入れ子になる）"""
+    if not isinstance(value, dict):
+        return
+    if "predictions" in value or "latencyMs" in value:
+        yield key, value
+        return
+    for child, sub in value.items():
+        yield from _engine_records(f"{key}/{child}", sub)
+
+
+# =============================================================================
+# 列指向の保存
+# =============================================================================
+
+def _to_array(values: list, dtype) -> np.ndarray:
+    if dtype is str:
+        return np.array(values, dtype=str) if values else np.zeros(0, dtype="<U1")
+    return np.array(values, dtype=dtype)
+
+
+def _part_dirs(store: Path, table: str) -> List[Path]:
+    return sorted((store / table).glob("part-*"))
+
+
+def write_part(store: Path, table: str, rows: List[dict]) -> Optional[Path]:
+    """行をパートとして書き出す（一時フォルダに書いてからリネーム）"""
+    if not rows:
+        return None
+    columns = TABLES[table]
+    parts = _part_dirs(store, table)
+    number = int(parts[-1].name.split("-")[1]) + 1 if parts else 1
+    part_dir = store / table / f"part-{number:06d}"
+    tmp_dir = part_dir.with_name(part_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    for name, dtype in columns.items():
+        np.save(tmp_dir / f"{name}.npy", _to_array([row[name] for row in rows], dtype))
+    tmp_dir.rename(part_dir)
+    return part_dir
+
+
+def load_table(store: Path, table: str, columns: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+    """テーブルの列をすべてのパートからつなげて読み込む（数値の列はメモリマップ）"""
+    columns = list(columns or TABLES[table])
+    chunks: Dict[str, List[np.ndarray]] = {name: [] for name in columns}
+    for part_dir in _part_dirs(store, table):
+        for name in columns:
+            dtype = TABLES[table][name]
+            chunks[name].append(np.load(part_dir / f"{name}.npy", mmap_mode=None if dtype is str else "r"))
+    return {name: np.concatenate(arrays) if arrays else _to_array([], TABLES[table][name])
+            for name, arrays in chunks.items()}
+
+
+def _load_state(store: Path) -> dict:
+    try:
+        with open(store / STATE_FILENAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+
+@dataclass
+class IngestStats:
+    files: int = 0
+    skipped_files: int = 0
+    human_rows: int = 0
+    engine_rows: int = 0
+    known_records: int = 0
+
+
+def ingest(paths: List[Path], store: Path = STORE_DIR, force: bool = False) -> IngestStats:
+    """エクスポートを読み、新しいレコードだけをパートとして追加する"""
+    store.mkdir(parents=True, exist_ok=True)
+    state = _load_state(store)
+    stats = IngestStats()
+    known = {table: set(load_table(store, table, ["key"])["key"].tolist()) for table in TABLES}
+
+    for path in paths:
+        st = path.stat()
+        signature = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        if not force and state["files"].get(str(path.resolve())) == signature:
+            stats.skipped_files += 1
+            continue
+
+        def wanted(record_path: Tuple[str, ...]) -> bool:
+            if record_path[0] == "users":
+                key, table = f"{record_path[1]}/{record_path[3]}", "human"
+            elif record_path[0] == "runs":
+                key, table = f"{record_path[1]}/{record_path[2]}", "engine"
+            else:
+                return True  # 結果JSONのリストはキーが中身にあるので読んでから判定する
+            is_new = key not in known[table]
+            stats.known_records += int(not is_new)
+            return is_new
+
+        human: List[dict] = []
+        engine: List[dict] = []
+        with open(path, encoding="utf-8") as f:
+            stream = JsonStream(f)
+            patterns = [("*",)] if stream.peek() == "[" else [HISTORY_PATTERN, RUN_PATTERN]
+            for record_path, value in iter_records(stream, patterns, wanted):
+                if record_path[0] == "users":
+                    rows = human_rows(record_path[1], record_path[3], value)
+                    human.extend(rows)
+                    known["human"].update(row["key"] for row in rows[:1])
+                    continue
+                if record_path[0] == "runs":
+                    records = _engine_records(f"{record_path[1]}/{record_path[2]}", value)
+                else:
+                    records = [(f"{value.get('runId')}/{value.get('imageId')}", value)] \
+                        if isinstance(value, dict) else []
+                for key, record in records:
+                    if key in known["engine"]:
+                        stats.known_records += 1
+                        continue
+                    known["engine"].add(key)
+                    engine.append(engine_row(key, record))
+
+        write_part(store, "human", human)
+        write_part(store, "engine", engine)
+        stats.files += 1
+        stats.human_rows += len(human)
+        stats.engine_rows += len(engine)
+        state["files"][str(path.resolve())] = signature
+        write_json_atomic(store / STATE_FILENAME, state)
+    return stats
+
+
+def compact(store: Path = STORE_DIR):
+    """パートを1つにまとめる（ingest を何度も繰り返してパートが増えたとき）"""
+    for table in TABLES:
+        parts = _part_dirs(store, table)
+        if len(parts) <= 1:
+            continue
+        data = load_table(store, table)
+        merged = store / table / "merged.tmp"
+        shutil.rmtree(merged, ignore_errors=True)
+        merged.mkdir()
+        for name, values in data.items():
+            np.save(merged / f"{name}.npy", values)
+        for part_dir in parts:
+            shutil.rmtree(part_dir)
+        merged.rename(parts[0])
+
+
+# =============================================================================
+# 集計（ベクトル化）
+# =============================================================================
+
+@dataclass
+class GroupRate:
+    """グループごとの件数と割合"""
+    keys: np.ndarray
+    count: np.ndarray
+    rate: np.ndarray
+
+    def rows(self, limit: Optional[int] = None, min_count: int = 1) -> List[dict]:
+        order = np.lexsort((-self.count, self.rate))  # 割合の低い順（同じなら件数の多い順）
+        order = order[self.count[order] >= min_count]
+        return [{"key": str(self.keys[i]), "count": int(self.count[i]), "rate": float(self.rate[i])}
+                for i in order[:limit]]
+
+
+def _join_keys(*columns: np.ndarray) -> np.ndarray:
+    """複数の列を1つのキーにまとめる（タブ区切り）"""
+    key = columns[0].astype(str)
+    for column in columns[1:]:
+        key = np.char.add(np.char.add(key, "\t"), column.astype(str))
+    return key
+
+
+def group_rate(keys: np.ndarray, values: np.ndarray) -> GroupRate:
+    """キーごとの件数と values（真偽値）の平均"""
+    if len(keys) == 0:
+        return GroupRate(np.zeros(0, dtype=str), np.zeros(0, dtype=np.int64), np.zeros(0))
+    unique, inverse = np.unique(keys, return_inverse=True)
+    count = np.bincount(inverse)
+    hits = np.bincount(inverse, weights=values.astype(np.float64))
+    return GroupRate(unique, count, hits / count)
+
+
+def group_percentiles(keys: np.ndarray, values: np.ndarray,
+                      qs: Sequence[float] = LATENCY_PERCENTILES) -> Dict[str, dict]:
+    """キーごとのパーセンタイル（最近傍法。グループをまとめて並べ替えて添字で取り出す）"""
+    if len(keys) == 0:
+        return {}
+    unique, inverse = np.unique(keys, return_inverse=True)
+    order = np.lexsort((values, inverse))
+    sorted_values = np.asarray(values)[order]
+    count = np.bincount(inverse, minlength=len(unique))
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+    result = {str(k): {"count": int(n), "mean": 0.0} for k, n in zip(unique, count)}
+    means = np.bincount(inverse, weights=np.asarray(values, dtype=np.float64)) / count
+    for q in qs:
+        rank = np.clip(np.ceil(q / 100 * count).astype(np.int64) - 1, 0, count - 1)
+        picked = sorted_values[start + rank]
+        for k, v in zip(unique, picked):
+            result[str(k)][f"p{q:g}"] = float(v)
+    for k, mean in zip(unique, means):
+        result[str(k)]["mean"] = float(mean)
+    return result
+
+
+def _pair_key(type1: np.ndarray, type2: np.ndarray, same: np.ndarray) -> np.ndarray:
+    """ペアのキー（順序をそろえる）。同じタイプの問題は「A (same)」"""
+    first = np.where(type1 <= type2, type1, type2)
+    second = np.where(type1 <= type2, type2, type1)
+    return np.where(same, np.char.add(type1.astype(str), " (same)"),
+                    np.char.add(np.char.add(first.astype(str), PAIR_SEPARATOR), second.astype(str)))
+
+
+def load_display_names(test_sets: Path) -> Dict[str, str]:
+    """manifest.json の表示名 → ID（ジャンルとタイプ）"""
+    names: Dict[str, str] = {}
+    if not test_sets.is_dir():
+        return names
+    for manifest_path in sorted(test_sets.glob(f"*/{MANIFEST_FILENAME}")):
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        genre_id = manifest.get("genre") or manifest_path.parent.name
+        if manifest.get("display_name"):
+            names[manifest["display_name"]] = genre_id
+        for type_id, info in manifest.get("types", {}).items():
+            if info.get("display_name"):
+                names[info["display_name"]] = type_id
+    return names
+
+
+def _to_ids(values: np.ndarray, names: Dict[str, str]) -> np.ndarray:
+    """表示名をIDに置き換える（ユニークな値だけ辞書を引く）"""
+    if len(values) == 0 or not names:
+        return values
+    unique, inverse = np.unique(values, return_inverse=True)
+    mapped = np.array([names.get(v, v) for v in unique.tolist()], dtype=str)
+    return mapped[inverse]
+
+
+def engine_answers(engine: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """問題形式の推論結果から、問題ごとの「同じ/違う」の回答（2枚の top1 が同じなら「同じ」）"""
+    mask = engine["question"] >= 0
+    run_id = engine["run_id"][mask]
+    question = engine["question"][mask]
+    position = engine["position"][mask]
+    _, group = np.unique(_join_keys(run_id, question), return_inverse=True)
+    order = np.lexsort((position, group))
+    group = group[order]
+    # 1枚目と2枚目が並んでいる問題だけを使う
+    first = np.flatnonzero((group[:-1] == group[1:]) & (position[order][:-1] == 1))
+    second = first + 1
+    pick = lambda name: engine[name][mask][order]  # noqa: E731
+    top1 = pick("top1")
+    answered_same = top1[first] == top1[second]
+    was_same = pick("is_same")[first] == 1
+    return {
+        "engine": pick("engine")[first],
+        "genre": pick("genre")[first],
+        "type1": pick("type1")[first],
+        "type2": pick("type2")[first],
+        "was_same": was_same,
+        "answered_same": answered_same,
+        "correct": answered_same == was_same,
+    }
+
+
+def build_report(store: Path = STORE_DIR, test_sets: Path = TEST_SETS_DIR) -> dict:
+    """保存済みの列から集計する"""
+    human = load_table(store, "human")
+    engine = load_table(store, "engine")
+    names = load_display_names(test_sets)
+    report: dict = {"human": {}, "engine": {}, "agreement": {}, "latency": {}}
+
+    # --- 人の正答率 ---
+    h_genre = _to_ids(human["genre"], names)
+    h_type1 = _to_ids(human["type1"], names)
+    h_type2 = _to_ids(human["type2"], names)
+    h_pair = _pair_key(h_type1, h_type2, human["was_same"])
+    diff = ~human["was_same"]
+    report["human"] = {
+        "answers": int(len(human["key"])),
+        "histories": int(len(np.unique(human["key"]))),
+        "accuracy": float(human["correct"].mean()) if len(human["correct"]) else None,
+        "by_genre": group_rate(h_genre, human["correct"]).rows(),
+        "by_pair": group_rate(_join_keys(h_genre, h_pair), human["correct"]).rows(),
+        # アイテム別: 問題に出た両方のタイプに数える（同じタイプの問題は1回）
+        "by_item": group_rate(_join_keys(np.concatenate((h_genre, h_genre[diff])),
+                                         np.concatenate((h_type1, h_type2[diff]))),
+                              np.concatenate((human["correct"], human["correct"][diff]))).rows(),
+    }
+
+    # --- エンジンの正答率（top1 がラベルと一致） ---
+    labelled = engine["label"] != ""
+    e_correct = engine["top1"][labelled] == engine["label"][labelled]
+    e_engine = engine["engine"][labelled]
+    report["engine"] = {
+        "records": int(len(engine["key"])),
+        "runs": int(len(np.unique(engine["run_id"]))),
+        "by_engine": group_rate(e_engine, e_correct).rows(),
+        "by_genre": group_rate(_join_keys(e_engine, engine["genre"][labelled]), e_correct).rows(),
+        "by_label": group_rate(_join_keys(e_engine, engine["label"][labelled]), e_correct).rows(),
+    }
+
+    # --- 人とエンジンの比較（ペアごとの正答率） ---
+    answers = engine_answers(engine)
+    if len(answers["correct"]):
+        report["engine"]["question_accuracy"] = group_rate(answers["engine"], answers["correct"]).rows()
+        e_pair = _join_keys(answers["engine"],
+                            _pair_key(answers["type1"], answers["type2"], answers["was_same"]))
+        human_by_pair = group_rate(h_pair, human["correct"])
+        engine_by_pair = group_rate(e_pair, answers["correct"])
+        for engine_name in np.unique(answers["engine"]).tolist():
+            prefix = engine_name + "\t"
+            mine = np.char.startswith(engine_by_pair.keys, prefix)
+            pairs = np.char.replace(engine_by_pair.keys[mine], prefix, "", count=1)
+            common, hi, ei = np.intersect1d(human_by_pair.keys, pairs, return_indices=True)
+            e_count = engine_by_pair.count[mine][ei]
+            keep = (human_by_pair.count[hi] >= MIN_PAIR_ANSWERS) & (e_count >= 1)
+            h_rate = human_by_pair.rate[hi][keep]
+            e_rate = engine_by_pair.rate[mine][ei][keep]
+            entry = {"pairs": int(keep.sum())}
+            if keep.sum():
+                entry["mean_abs_diff"] = float(np.abs(h_rate - e_rate).mean())
+                # 人とエンジンが同じペアを難しいと感じているか（正答率の相関）
+                if keep.sum() >= 3 and h_rate.std() > 0 and e_rate.std() > 0:
+                    entry["correlation"] = float(np.corrcoef(h_rate, e_rate)[0, 1])
+                gap = e_rate - h_rate
+                order = np.argsort(gap)
+                entry["worst_for_engine"] = [
+                    {"pair": str(common[keep][i]), "human": float(h_rate[i]), "engine": float(e_rate[i])}
+                    for i in order[:TOP_ROWS]]
+            report["agreement"][engine_name] = entry
+
+    # --- 推論時間 ---
+    report["latency"] = group_percentiles(_join_keys(engine["engine"], engine["provider"]),
+                                          engine["latency_ms"])
+    return report
+
+
+def print_report(report: dict, limit: int = TOP_ROWS):
+    def table(title: str, rows: List[dict]):
+        if not rows:
+            return
+        print(f"\n  {title}（正答率の低い順）:")
+        for row in rows[:limit]:
+            print(f"    {row['key'].replace(chr(9), ' / '):<45} {row['rate'] * 100:5.1f}%  ({row['count']})")
+
+    human = report["human"]
+    print(f"人の回答: {human['answers']}問（履歴 {human['histories']}件）", end="")
+    print(f"  正答率 {human['accuracy'] * 100:.1f}%" if human["accuracy"] is not None else "")
+    table("ジャンル別", human["by_genre"])
+    table("ペア別", human["by_pair"])
+    table("アイテム別", human["by_item"])
+
+    engine = report["engine"]
+    print(f"\nエンジンの結果: {engine['records']}件（実行 {engine['runs']}回）")
+    table("エンジン別（top1）", engine["by_engine"])
+    table("ジャンル別（top1）", engine["by_genre"])
+    table("ラベル別（top1）", engine["by_label"])
+    table("問題形式（同じ/違う）", engine.get("question_accuracy", []))
+
+    for engine_name, entry in report["agreement"].items():
+        print(f"\n人と {engine_name} の比較: {entry['pairs']}ペア", end="")
+        if "mean_abs_diff" in entry:
+            print(f"  正答率の差の平均 {entry['mean_abs_diff'] * 100:.1f}pt", end="")
+        if "correlation" in entry:
+            print(f"  相関 {entry['correlation']:.2f}", end="")
+        print()
+        for row in entry.get("worst_for_engine", [])[:limit]:
+            print(f"    {row['pair']:<40} 人 {row['human'] * 100:5.1f}%  エンジン {row['engine'] * 100:5.1f}%")
+
+    if report["latency"]:
+        print("\n推論時間:")
+        for key, values in sorted(report["latency"].items()):
+            ps = " ".join(f"p{q:g}={values[f'p{q:g}']:.1f}ms" for q in LATENCY_PERCENTILES)
+            print(f"    {key.replace(chr(9), ' / '):<30} {ps}  ({values['count']})")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="RTDB のエクスポートからクイズ結果・推論結果を集計")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = sub.add_parser("ingest", help="エクスポートを読み、新しいレコードを列指向で保存")
+    ingest_parser.add_argument("files", nargs="+", help="RTDB のエクスポートJSON、または engine_runner の結果JSON")
+    ingest_parser.add_argument("--store", type=Path, default=STORE_DIR, help="保存先")
+    ingest_parser.add_argument("--force", action="store_true", help="読み込み済みのファイルも読み直す")
+    ingest_parser.add_argument("--compact", action="store_true", help="読み込み後にパートを1つにまとめる")
+
+    report_parser = sub.add_parser("report", help="集計を表示")
+    report_parser.add_argument("--store", type=Path, default=STORE_DIR, help="保存先")
+    report_parser.add_argument("--test-sets", type=Path, default=TEST_SETS_DIR,
+                               help="表示名をIDに直すための manifest.json のフォルダ")
+    report_parser.add_argument("--json", help="集計をJSONで保存")
+    report_parser.add_argument("--limit", type=int, default=TOP_ROWS, help="表の行数")
+    args = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        missing = [f for f in args.files if not Path(f).is_file()]
+        if missing:
+            print(f"[error] ファイルがありません: {', '.join(missing)}", file=sys.stderr)
+            return 64
+        stats = ingest([Path(f) for f in args.files], args.store, args.force)
+        print(f"読み込み: {stats.files}ファイル（変更なし {stats.skipped_files}） "
+              f"人 +{stats.human_rows}問 / エンジン +{stats.engine_rows}件"
+              f"（読み込み済み {stats.known_records}件は読み飛ばし）")
+        if args.compact:
+            compact(args.store)
+        return 0
+
+    report = build_report(args.store, args.test_sets)
+    print_report(report, args.limit)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,591 @@
+"""
+Firebase Realtime Database の REST API の代わりになるローカルサーバー（SQLite）
+
+engine-test の FirebaseSync（1件ずつ PUT・fetchRun で実行を丸ごと GET）や、アプリの
+同期（users/{uid}/histories の PUT・DELETE・SSE）を、オフラインで負荷試験するためのもの。
+本物の RTDB のうち、クライアントが使っている範囲だけを実装する:
+
+- GET     ?shallow=true / ?orderBy=&startAt=&endAt=&equalTo=&limitToFirst=&limitToLast=
+          Accept: text/event-stream のときは SSE（put / patch / keep-alive イベント）
+- PUT     場所の値を置き換える（null は削除）
+- PATCH   子を置き換える。キーに / を含めると複数の場所をまとめて更新（マルチパス更新）
+- POST    プッシュID（時刻順のキー）で子を追加し {"name": キー} を返す
+- DELETE  場所を削除する
+- ?print=silent で 204、?auth= は --require-auth のときだけ確認する（値は見ない）
+
+データは葉（プリミティブ値）ごとに1行（path / parent / key / value）で保存する。
+親子のインデックスで shallow と orderBy を子の数だけで処理し、部分木は path の範囲検索で読む。
+
+--latency-ms / --jitter-ms で応答を遅らせ、--error-rate で一部のリクエストを 503 にできる
+（クライアントのリトライ・タイムアウトの確認用）。
+
+使い方:
+  python tools/rtdb_emulator.py --port 9000 --db rtdb.sqlite3 --latency-ms 80 --jitter-ms 40
+  # engine-test: --database-url http://127.0.0.1:9000
+"""
+
+import sys
+import json
+import time
+import queue
+import random
+import sqlite3
+import argparse
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from host_health import percentile
+
+
+DEFAULT_PORT = 9000
+KEEP_ALIVE_SEC = 30         # SSE の keep-alive イベントの間隔
+INVALID_KEY_CHARS = set(".$#[]")
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+MAX_INT_KEY = 2 ** 31 - 1   # これ以下の整数のキーは数値として並べる
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    path   TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    key    TEXT NOT NULL,
+    value  TEXT             -- 葉は JSON、途中の節は NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_nodes_parent ON nodes (parent, key);
+"""
+
+
+class RtdbError(Exception):
+    """REST のエラー応答（{"error": message}）"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# =============================================================================
+# パスと並び順
+# =============================================================================
+
+def split_path(path: str) -> List[str]:
+    """/runs/abc/ → ["runs", "abc"]（使えない文字を含むキーはエラー）"""
+    keys = [k for k in path.split("/") if k]
+    for key in keys:
+        if INVALID_KEY_CHARS & set(key):
+            raise RtdbError(400, f"Invalid path: {path}")
+    return keys
+
+
+def _join(*keys: str) -> str:
+    return "/".join(k for k in keys if k)
+
+
+def _parent(path: str) -> str:
+    return path.rpartition("/")[0]
+
+
+def _key_order(key: str) -> tuple:
+    """$key の並び順（32ビット整数のキーが先、次に文字列）"""
+    if key.lstrip("-").isdigit() and abs(int(key)) <= MAX_INT_KEY:
+        return (0, int(key), "")
+    return (1, 0, key)
+
+
+def _value_order(value) -> tuple:
+    """値の並び順（null < false < true < 数値 < 文字列 < オブジェクト）"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+
+def _flatten(path: str, value, rows: List[tuple]) -> bool:
+    """値を（path, parent, key, JSON）の行にする。空のオブジェクトは行を作らない（null と同じ）"""
+    if isinstance(value, list):
+        value = {str(i): v for i, v in enumerate(value)}
+    if isinstance(value, dict):
+        start = len(rows)
+        rows.append((path, _parent(path), path.rpartition("/")[2], None))
+        has_child = False
+        for key, child in value.items():
+            split_path(str(key))
+            has_child |= _flatten(_join(path, str(key)), child, rows)
+        if not has_child:
+            del rows[start:]
+        return has_child
+    if value is None:
+        return False
+    rows.append((path, _parent(path), path.rpartition("/")[2], json.dumps(value, ensure_ascii=False)))
+    return True
+
+
+def _as_array(obj: dict):
+    """連番のキーだけのオブジェクトは配列で返す（RTDB と同じく、半分以上が埋まっている場合）"""
+    if obj and all(k.isdigit() for k in obj):
+        top = max(int(k) for k in obj)
+        if top < 2 * len(obj):
+            return [obj.get(str(i)) for i in range(top + 1)]
+    return obj
+
+
+# =============================================================================
+# データベース
+# =============================================================================
+
+class RtdbStore:
+    """パスごとの値を SQLite に保存する（書き込みはロックで直列化）"""
+
+    def __init__(self, db_path: str = ":memory:"):
+        if db_path != ":memory:":
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._last_push = (0, [0] * 12)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, func):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    # --- 読み込み ---
+
+    def _subtree_rows(self, conn, path: str) -> List[Tuple[str, Optional[str]]]:
+        if not path:
+            return conn.execute("SELECT path, value FROM nodes WHERE value IS NOT NULL").fetchall()
+        return conn.execute(
+            "SELECT path, value FROM nodes WHERE value IS NOT NULL AND "
+            "(path = ? OR (path > ? AND path < ?))", (path, path + "/", path + "0")).fetchall()
+
+    def _read(self, conn, path: str):
+        rows = self._subtree_rows(conn, path)
+        if len(rows) == 1 and rows[0][0] == path:
+            return json.loads(rows[0][1])
+        if not rows:
+            return None
+        root: dict = {}
+        skip = len(path) + 1 if path else 0
+        for row_path, value in rows:
+            keys = row_path[skip:].split("/")
+            node = root
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = json.loads(value)
+        return self._arrays(root)
+
+    def _arrays(self, obj):
+        if isinstance(obj, dict):
+            return _as_array({k: self._arrays(v) for k, v in obj.items()})
+        return obj
+
+    def get(self, path: str):
+        with self._lock:
+            return self._read(self._conn, path)
+
+    def shallow(self, path: str):
+        """子のキー → true（オブジェクト）またはプリミティブ値"""
+        with self._lock:
+            leaf = self._conn.execute("SELECT value FROM nodes WHERE path = ?", (path,)).fetchone()
+            if leaf is not None and leaf[0] is not None:
+                return json.loads(leaf[0])
+            rows = self._conn.execute("SELECT key, value FROM nodes WHERE parent = ?",
+                                      (path,)).fetchall()
+        if not rows:
+            return None
+        return {key: True if value is None else json.loads(value) for key, value in rows}
+
+    def query(self, path: str, order_by: str, start_at=None, end_at=None, equal_to=None,
+              limit_first: Optional[int] = None, limit_last: Optional[int] = None) -> dict:
+        """子を並べて範囲・件数で絞り込む（orderBy）"""
+        with self._lock:
+            children = self._conn.execute("SELECT key, value FROM nodes WHERE parent = ?",
+                                          (path,)).fetchall()
+            if order_by == "$key":
+                ordered = [(_key_order(key), key) for key, _ in children]
+                bound = lambda v: None if v is None else _key_order(str(v))  # noqa: E731
+            else:
+                if order_by == "$value":
+                    values = {key: None if value is None else json.loads(value) for key, value in children}
+                else:
+                    child_keys = split_path(order_by)
+                    paths = {_join(path, key, *child_keys): key for key, _ in children}
+                    values = dict.fromkeys((key for key, _ in children), None)
+                    items = list(paths)
+                    for i in range(0, len(items), 500):
+                        chunk = items[i:i + 500]
+                        for row_path, value in self._conn.execute(
+                                f"SELECT path, value FROM nodes WHERE path IN ({','.join('?' * len(chunk))})",
+                                chunk):
+                            values[paths[row_path]] = None if value is None else json.loads(value)
+                ordered = [((_value_order(values[key]), _key_order(key)), key) for key, _ in children]
+                bound = lambda v: None if v is None else (_value_order(v),)  # noqa: E731
+
+            if equal_to is not None:
+                start_at = end_at = equal_to
+            lo, hi = bound(start_at), bound(end_at)
+            ordered.sort()
+            keys = [key for order, key in ordered
+                    if (lo is None or order[:len(lo)] >= lo) and (hi is None or order[:len(hi)] <= hi)]
+            if limit_first is not None:
+                keys = keys[:limit_first]
+            if limit_last is not None:
+                keys = keys[-limit_last:] if limit_last else []
+            return {key: self._read(self._conn, _join(path, key)) for key in keys}
+
+    # --- 書き込み ---
+
+    def _set(self, conn, path: str, value):
+        if path:
+            conn.execute("DELETE FROM nodes WHERE path = ? OR (path > ? AND path < ?)",
+                         (path, path + "/", path + "0"))
+        else:
+            conn.execute("DELETE FROM nodes")
+        rows: List[tuple] = []
+        if _flatten(path, value, rows):
+            # 親を途中の節にする（プリミティブ値だった親は置き換わる）
+            keys = path.split("/") if path else []
+            ancestors = [("/".join(keys[:i]), "/".join(keys[:i - 1]), keys[i - 1]) for i in range(1, len(keys))]
+            conn.executemany("INSERT INTO nodes (path, parent, key, value) VALUES (?, ?, ?, NULL) "
+                             "ON CONFLICT (path) DO UPDATE SET value = NULL", ancestors)
+            conn.executemany("INSERT INTO nodes (path, parent, key, value) VALUES (?, ?, ?, ?)",
+                             [row for row in rows if row[0]])
+        else:
+            self._prune(conn, _parent(path) if path else "")
+
+    def _prune(self, conn, path: str):
+        """子が無くなった途中の節を消す"""
+        while path:
+            if conn.execute("SELECT 1 FROM nodes WHERE parent = ? LIMIT 1", (path,)).fetchone():
+                return
+            conn.execute("DELETE FROM nodes WHERE path = ? AND value IS NULL", (path,))
+            path = _parent(path)
+
+    def put(self, path: str, value):
+        self._write(lambda conn: self._set(conn, path, value))
+
+    def update(self, path: str, updates: dict):
+        """PATCH（キーに / を含む場合はマルチパス更新）。重なるパスはエラー"""
+        targets = sorted(_join(path, *split_path(str(key))) for key in updates)
+        for a, b in zip(targets, targets[1:]):
+            if b == a or b.startswith(a + "/"):
+                raise RtdbError(400, f"Invalid data; path {b} is an ancestor or descendant of another")
+
+        def op(conn):
+            for key, value in updates.items():
+                self._set(conn, _join(path, *split_path(str(key))), value)
+        self._write(op)
+
+    def push(self, path: str, value) -> str:
+        key = self.push_id()
+        self.put(_join(path, key), value)
+        return key
+
+    def push_id(self) -> str:
+        """Firebase と同じ形式のプッシュID（先頭8文字が時刻。同じミリ秒なら末尾を1増やす）"""
+        with self._lock:
+            now = int(time.time() * 1000)
+            last_time, suffix = self._last_push
+            if now == last_time:
+                suffix = list(suffix)
+                i = len(suffix) - 1
+                while suffix[i] == 63:
+                    suffix[i] = 0
+                    i -= 1
+                suffix[i] += 1
+            else:
+                suffix = [random.randrange(64) for _ in range(12)]
+            self._last_push = (now, suffix)
+        head = []
+        for _ in range(8):
+            head.append(PUSH_CHARS[now % 64])
+            now //= 64
+        return "".join(reversed(head)) + "".join(PUSH_CHARS[i] for i in suffix)
+
+
+# =============================================================================
+# HTTP サーバー
+# =============================================================================
+
+@dataclass
+class ServerOptions:
+    latency_ms: float = 0.0       # 応答を遅らせる時間
+    jitter_ms: float = 0.0        # 遅延のばらつき（0〜jitter_ms を足す）
+    error_rate: float = 0.0       # 503 を返す割合
+    require_auth: bool = False    # ?auth= が無いリクエストを 401 にする
+    verbose: bool = False
+
+
+@dataclass
+class ServerStats:
+    requests: Dict[str, int] = field(default_factory=dict)
+    errors: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    handle_ms: List[float] = field(default_factory=list)
+
+
+class RtdbServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store: RtdbStore, options: ServerOptions):
+        super().__init__(address, RtdbHandler)
+        self.store = store
+        self.options = options
+        self.stats = ServerStats()
+        self.stats_lock = threading.Lock()
+        self.listeners: List[Tuple[str, "queue.Queue"]] = []
+        self.listeners_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def notify(self, path: str, data, event: str = "put"):
+        """書き込みを SSE の購読者に送る"""
+        with self.listeners_lock:
+            listeners = list(self.listeners)
+        for listen_path, events in listeners:
+            if path == listen_path or path.startswith(listen_path + "/") or not listen_path:
+                relative = path[len(listen_path):] if listen_path else "/" + path
+                events.put((event, {"path": relative or "/", "data": data}))
+            elif listen_path.startswith(path + "/") or not path:
+                events.put(("put", {"path": "/", "data": self.store.get(listen_path)}))
+
+
+class RtdbHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # クライアントが接続を使い回せるように
+    server: RtdbServer
+
+    def log_message(self, fmt, *args):
+        if self.server.options.verbose:
+            super().log_message(fmt, *args)
+
+    def _send_json(self, status: int, data, silent: bool = False):
+        body = b"" if silent else json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self.send_response(204 if silent and status == 200 else status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.stats_lock:
+            self.server.stats.bytes_out += len(body)
+            self.server.stats.errors += int(status >= 400)
+
+    def _read_raw(self) -> bytes:
+        """本文を先に読み切る（エラーを返すときも接続を使い回せるように）"""
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        with self.server.stats_lock:
+            self.server.stats.bytes_in += len(raw)
+        return raw
+
+    @staticmethod
+    def _parse_body(raw: bytes):
+        try:
+            return json.loads(raw or b"null")
+        except ValueError:
+            raise RtdbError(400, "Invalid data; couldn't parse JSON object, array, or value.")
+
+    def _handle(self, method: str):
+        started = time.perf_counter()
+        options = self.server.options
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        raw = self._read_raw()
+        with self.server.stats_lock:
+            counts = self.server.stats.requests
+            counts[method] = counts.get(method, 0) + 1
+
+        delay = options.latency_ms + random.uniform(0, options.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        try:
+            if options.error_rate and random.random() < options.error_rate:
+                raise RtdbError(503, "Service Unavailable (injected)")
+            if options.require_auth and not params.get("auth"):
+                raise RtdbError(401, "Permission denied")
+            raw_path = unquote(url.path)
+            if not raw_path.endswith(".json"):
+                raise RtdbError(400, "Paths must end in .json")
+            path = _join(*split_path(raw_path[:-len(".json")]))
+            if method == "GET" and "text/event-stream" in (self.headers.get("Accept") or ""):
+                self._stream(path)
+                return
+            status, data = self._dispatch(method, path, params, raw)
+            self._send_json(status, data, silent=params.get("print") == "silent")
+        except RtdbError as e:
+            self._send_json(e.status, {"error": str(e)})
+        finally:
+            with self.server.stats_lock:
+                self.server.stats.handle_ms.append((time.perf_counter() - started) * 1000)
+
+    def _dispatch(self, method: str, path: str, params: Dict[str, str], raw: bytes):
+        store = self.server.store
+        if method == "GET":
+            if params.get("shallow") == "true":
+                if "orderBy" in params:
+                    raise RtdbError(400, "shallow and orderBy can't be combined")
+                return 200, store.shallow(path)
+            if "orderBy" in params:
+                return 200, store.query(path, **_query_args(params))
+            return 200, store.get(path)
+        if method == "PUT":
+            value = self._parse_body(raw)
+            store.put(path, value)
+            self.server.notify(path, value)
+            return 200, value
+        if method == "PATCH":
+            updates = self._parse_body(raw)
+            if not isinstance(updates, dict):
+                raise RtdbError(400, "Invalid data; PATCH requires an object")
+            store.update(path, updates)
+            self.server.notify(path, updates, event="patch")
+            return 200, updates
+        if method == "POST":
+            value = self._parse_body(raw)
+            key = store.push(path, value)
+            self.server.notify(_join(path, key), value)
+            return 200, {"name": key}
+        if method == "DELETE":
+            store.put(path, None)
+            self.server.notify(path, None)
+            return 200, None
+        raise RtdbError(405, f"Method {method} not allowed")
+
+    def _stream(self, path: str):
+        """SSE: 最初に現在の値を put で送り、以降は書き込みのたびに送る"""
+        events: "queue.Queue" = queue.Queue()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        with self.server.listeners_lock:
+            self.server.listeners.append((path, events))
+        try:
+            self._send_event("put", {"path": "/", "data": self.server.store.get(path)})
+            while True:
+                try:
+                    event, data = events.get(timeout=KEEP_ALIVE_SEC)
+                except queue.Empty:
+                    event, data = "keep-alive", None
+                self._send_event(event, data)
+        except OSError:
+            pass  # クライアントが切断した
+        finally:
+            with self.server.listeners_lock:
+                self.server.listeners.remove((path, events))
+
+    def _send_event(self, event: str, data):
+        self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+    def do_POST(self):
+        # X-HTTP-Method-Override（REST API で PATCH・DELETE を POST で送る方法）
+        self._handle(self.headers.get("X-HTTP-Method-Override", "POST").upper())
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def _query_args(params: Dict[str, str]) -> dict:
+    """orderBy などのクエリ（値は JSON。orderBy="$key"、limitToFirst=10）"""
+    def parse(name):
+        if name not in params:
+            return None
+        try:
+            return json.loads(params[name])
+        except ValueError:
+            raise RtdbError(400, f"{name} must be a valid JSON value")
+
+    order_by = parse("orderBy")
+    if not isinstance(order_by, str):
+        raise RtdbError(400, "orderBy must be a string")
+    args = {"order_by": order_by, "start_at": parse("startAt"), "end_at": parse("endAt"),
+            "equal_to": parse("equalTo")}
+    for name, arg in (("limitToFirst", "limit_first"), ("limitToLast", "limit_last")):
+        value = parse(name)
+        if value is not None and (not isinstance(value, int) or value < 0):
+            raise RtdbError(400, f"{name} must be a non-negative integer")
+        args[arg] = value
+    return args
+
+
+def start_server(host: str = "127.0.0.1", port: int = DEFAULT_PORT, db_path: str = ":memory:",
+                 options: Optional[ServerOptions] = None) -> RtdbServer:
+    """サーバーを別スレッドで起動する（負荷試験から使う。port=0 で空いているポート）"""
+    server = RtdbServer((host, port), RtdbStore(db_path), options or ServerOptions())
+    threading.Thread(target=server.serve_forever, name="rtdb-emulator", daemon=True).start()
+    return server
+
+
+def print_server_stats(stats: ServerStats):
+    total = sum(stats.requests.values())
+    if not total:
+        return
+    methods = " ".join(f"{method}={count}" for method, count in sorted(stats.requests.items()))
+    print(f"  サーバー: {total}リクエスト（{methods}）エラー {stats.errors} "
+          f"受信 {stats.bytes_in / 2**20:.1f} MB / 送信 {stats.bytes_out / 2**20:.1f} MB")
+    p50, p95, p99 = (percentile(stats.handle_ms, q) for q in (50, 95, 99))
+    print(f"  サーバー側の処理時間（遅延を含む） p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Firebase RTDB の REST API のローカル版（負荷試験用）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--db", default=":memory:", help="SQLite のファイル（省略時はメモリ上）")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="応答を遅らせる時間")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="遅延のばらつき")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合（0〜1）")
+    parser.add_argument("--require-auth", action="store_true", help="?auth= の無いリクエストを拒否")
+    parser.add_argument("--verbose", action="store_true", help="リクエストを1件ずつ表示")
+    args = parser.parse_args(argv)
+
+    options = ServerOptions(args.latency_ms, args.jitter_ms, args.error_rate, args.require_auth, args.verbose)
+    server = RtdbServer((args.host, args.port), RtdbStore(args.db), options)
+    print(f"RTDB emulator: {server.url}（db={args.db}）  Ctrl+C で終了")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print_server_stats(server.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""
+RTDB の同期の負荷試験（rtdb_emulator.py、または本物の RTDB に対して）
+
+クライアントと同じリクエストを大量に送り、スループットと応答時間を測る。
+
+シナリオ:
+  results    engine-test の FirebaseSync と同じ形の ResultRecord を runs/{runId}/{imageId} に書き、
+             実行を丸ごと GET（fetchRun）・shallow・orderBy="$key" のページ分けで読み直す
+  histories  アプリと同じ形のクイズ履歴を users/{uid}/histories/{id} に書き、ユーザーごとに読み直す
+
+書き込み方（--mode）:
+  put    1件ずつ PUT（今のクライアントと同じ）
+  patch  --batch 件ずつマルチパス PATCH（{"runs/r/q1_1": {...}, ...}）
+比較することで、クライアントを変える前にどれだけ速くなるかが分かる。
+
+--url を省略すると rtdb_emulator をこのプロセス内で起動する（--latency-ms で遅延を入れる）。
+
+使い方:
+  python tools/rtdb_load.py --records 20000 --concurrency 16 --mode put --latency-ms 60 --jitter-ms 30
+  python tools/rtdb_load.py --records 20000 --mode patch --batch 500 --latency-ms 60
+  python tools/rtdb_load.py --url http://127.0.0.1:9000 --scenario histories --users 200
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from engine_runner import Prediction, ResultRecord
+from host_health import percentile
+from rtdb_emulator import ServerOptions, print_server_stats, start_server
+
+
+DEFAULT_RECORDS = 10000
+DEFAULT_CONCURRENCY = 8
+DEFAULT_BATCH = 200        # --mode patch の1リクエストあたりの件数
+PAGE_SIZE = 1000           # orderBy="$key" で読むときの1ページの件数
+REQUEST_TIMEOUT = 60
+LABELS = ["shiba", "akita", "husky", "malamute", "samoyed", "pomeranian", "corgi", "beagle"]
+LABELS_JA = ["柴犬", "秋田犬", "ハスキー", "マラミュート", "サモエド", "ポメラニアン", "コーギー", "ビーグル"]
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    """スレッドごとのセッション（接続を使い回す）"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
+@dataclass
+class OpStats:
+    """操作ごとの応答時間とエラー"""
+    latencies_ms: List[float] = field(default_factory=list)
+    errors: int = 0
+    bytes: int = 0
+    items: int = 0
+    elapsed_sec: float = 0.0
+
+
+class LoadClient:
+    """RTDB の REST API を呼び、操作ごとに時間を記録する"""
+
+    def __init__(self, url: str, auth: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.auth = auth
+        self.stats: Dict[str, OpStats] = {}
+        self._lock = threading.Lock()
+
+    def _uri(self, path: str, **params) -> Tuple[str, dict]:
+        query = {k: json.dumps(v) if k in ("orderBy", "startAt", "limitToFirst") else v
+                 for k, v in params.items()}
+        if self.auth:
+            query["auth"] = self.auth
+        return f"{self.url}/{path}.json", query
+
+    def call(self, op: str, method: str, path: str, body=None, items: int = 1, **params):
+        url, query = self._uri(path, **params)
+        data = None if body is None else json.dumps(body, ensure_ascii=False).encode("utf-8")
+        started = time.perf_counter()
+        result, size, failed = None, 0, False
+        try:
+            response = _session().request(method, url, params=query, data=data, timeout=REQUEST_TIMEOUT,
+                                          headers={"Content-Type": "application/json"})
+            size = len(response.content) + len(data or b"")
+            failed = response.status_code >= 400
+            if not failed and response.content:
+                result = response.json()
+        except requests.RequestException:
+            failed = True
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self.stats.setdefault(op, OpStats())
+            stats.latencies_ms.append(elapsed)
+            stats.errors += int(failed)
+            stats.bytes += size
+            stats.items += items
+        return result
+
+    def count(self, op: str, items: int):
+        """リクエストの後で分かった件数を足す（ページ分けの読み込み）"""
+        with self._lock:
+            self.stats.setdefault(op, OpStats()).items += items
+
+
+def _run_phase(client: LoadClient, op: str, tasks: List[Callable[[], None]], concurrency: int):
+    """タスクを並列に実行し、かかった時間を記録する"""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(task) for task in tasks]:
+            future.result()
+    client.stats.setdefault(op, OpStats()).elapsed_sec += time.perf_counter() - started
+
+
+# =============================================================================
+# シナリオ
+# =============================================================================
+
+def make_result(run_id: str, index: int, rng: random.Random) -> ResultRecord:
+    """問題形式の engine-test と同じ形の結果（imageId は q{問題}_{1|2}）"""
+    question, position = index // 2 + 1, index % 2 + 1
+    type1, type2 = rng.sample(range(len(LABELS)), 2)
+    is_same = rng.random() < 0.5
+    label = LABELS[type1] if position == 1 or is_same else LABELS[type2]
+    scores = sorted((rng.random() for _ in range(5)), reverse=True)
+    return ResultRecord(
+        run_id=run_id, image_id=f"q{question}_{position}", engine="mock", provider="cpu",
+        latency_ms=rng.randint(5, 80), input_size=[224, 224], label=label,
+        predictions=[Prediction(l, round(s, 4)) for l, s in zip(rng.sample(LABELS, 5), scores)],
+        meta={"questionIndex": question, "isSame": is_same, "type1": LABELS[type1],
+              "type2": LABELS[type1] if is_same else LABELS[type2], "position": position},
+    )
+
+
+def make_history(index: int, rng: random.Random) -> dict:
+    """アプリの _historyToFirebaseJson と同じ形のクイズ履歴"""
+    results = []
+    for number in range(1, 11):
+        a, b = rng.sample(LABELS_JA, 2)
+        was_same = rng.random() < 0.5
+        answered_same = was_same if rng.random() < 0.75 else not was_same
+        results.append({"questionNumber": number, "description": f"{a} × {a if was_same else b}",
+                        "isCorrect": answered_same == was_same, "wasSame": was_same,
+                        "answeredSame": answered_same})
+    stamp = datetime.now(timezone.utc) - timedelta(minutes=index)
+    return {"id": f"h{index:08d}", "genre": "犬種", "responderName": "load", "timeMillis": rng.randint(20000, 90000),
+            "timestamp": int(stamp.timestamp() * 1000), "total": 10,
+            "score": sum(r["isCorrect"] for r in results), "questionResults": results}
+
+
+def run_results(client: LoadClient, records: int, runs: int, mode: str, batch: int,
+                concurrency: int, seed: int):
+    rng = random.Random(seed)
+    prefix = f"load-{int(time.time())}"
+    run_ids = [f"{prefix}-{i}" for i in range(runs)]
+    per_run = {run_id: [make_result(run_id, i, rng).to_json() for i in range(records // runs)]
+               for run_id in run_ids}
+
+    if mode == "put":
+        tasks = [lambda run_id=run_id, record=record: client.call(
+                     "write", "PUT", f"runs/{run_id}/{record['imageId']}", record)
+                 for run_id, items in per_run.items() for record in items]
+    else:
+        tasks = []
+        for run_id, items in per_run.items():
+            for i in range(0, len(items), batch):
+                chunk = items[i:i + batch]
+                body = {f"runs/{run_id}/{r['imageId']}": r for r in chunk}
+                tasks.append(lambda body=body, n=len(chunk): client.call("write", "PATCH", "", body, items=n))
+    _run_phase(client, "write", tasks, concurrency)
+
+    # fetchRun と同じ読み方（実行を丸ごと）と、shallow・ページ分けの読み方を比べる
+    _run_phase(client, "fetch run", [
+        lambda run_id=run_id: client.call("fetch run", "GET", f"runs/{run_id}", items=len(per_run[run_id]))
+        for run_id in run_ids], concurrency)
+    _run_phase(client, "shallow", [
+        lambda run_id=run_id: client.call("shallow", "GET", f"runs/{run_id}", shallow="true")
+        for run_id in run_ids], concurrency)
+
+    def paged(run_id: str):
+        start = None
+        while True:
+            params = {"orderBy": "$key", "limitToFirst": PAGE_SIZE + (start is not None)}
+            if start is not None:
+                params["startAt"] = start
+            page = client.call("paged", "GET", f"runs/{run_id}", items=0, **params) or {}
+            keys = sorted(k for k in page if k != start)
+            client.count("paged", len(keys))
+            if len(keys) < PAGE_SIZE:
+                return
+            start = keys[-1]
+    _run_phase(client, "paged", [lambda run_id=run_id: paged(run_id) for run_id in run_ids], concurrency)
+
+
+def run_histories(client: LoadClient, users: int, per_user: int, mode: str, batch: int,
+                  concurrency: int, seed: int):
+    rng = random.Random(seed)
+    uids = [f"load-user-{i:05d}" for i in range(users)]
+    histories = {uid: [make_history(i, rng) for i in range(per_user)] for uid in uids}
+
+    if mode == "put":
+        tasks = [lambda uid=uid, h=h: client.call("write", "PUT", f"users/{uid}/histories/{h['id']}", h)
+                 for uid, items in histories.items() for h in items]
+    else:
+        pending = [(f"users/{uid}/histories/{h['id']}", h) for uid, items in histories.items() for h in items]
+        tasks = [lambda body=dict(pending[i:i + batch]): client.call("write", "PATCH", "", body, items=len(body))
+                 for i in range(0, len(pending), batch)]
+    _run_phase(client, "write", tasks, concurrency)
+    _run_phase(client, "fetch histories", [
+        lambda uid=uid: client.call("fetch histories", "GET", f"users/{uid}/histories", items=per_user)
+        for uid in uids], concurrency)
+
+
+def print_load_report(client: LoadClient):
+    print(f"\n{'操作':<16}{'件数':>8}{'req':>8}{'件/秒':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'エラー':>7}{'MB':>8}")
+    for op, stats in client.stats.items():
+        if not stats.latencies_ms:
+            continue
+        rate = stats.items / stats.elapsed_sec if stats.elapsed_sec else 0.0
+        p50, p95, p99 = (percentile(stats.latencies_ms, q) for q in (50, 95, 99))
+        print(f"{op:<16}{stats.items:>8}{len(stats.latencies_ms):>8}{rate:>10.0f}"
+              f"{p50:>7.1f}ms{p95:>7.1f}ms{p99:>7.1f}ms{stats.errors:>7}{stats.bytes / 2**20:>8.1f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="RTDB の同期の負荷試験")
+    parser.add_argument("--url", help="RTDB の URL（省略時は rtdb_emulator をプロセス内で起動）")
+    parser.add_argument("--auth", help="?auth= に付けるトークン")
+    parser.add_argument("--scenario", choices=["results", "histories"], default="results")
+    parser.add_argument("--mode", choices=["put", "patch"], default="put", help="書き込み方")
+    parser.add_argument("--records", type=int, default=DEFAULT_RECORDS, help="results: 結果の件数")
+    parser.add_argument("--runs", type=int, default=1, help="results: 実行の数（件数を分ける）")
+    parser.add_argument("--users", type=int, default=100, help="histories: ユーザー数")
+    parser.add_argument("--per-user", type=int, default=50, help="histories: ユーザーごとの履歴数")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH, help="--mode patch の1リクエストの件数")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="同時リクエスト数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", default=":memory:", help="内蔵サーバーの SQLite のファイル")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="内蔵サーバーの遅延")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="内蔵サーバーの遅延のばらつき")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="内蔵サーバーの 503 の割合")
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        server = start_server(port=0, db_path=args.db,
+                              options=ServerOptions(args.latency_ms, args.jitter_ms, args.error_rate))
+        url = server.url
+    client = LoadClient(url, args.auth)
+    print(f"負荷試験: {args.scenario} / {args.mode} / 同時 {args.concurrency} → {url}")
+    try:
+        if args.scenario == "results":
+            run_results(client, args.records, max(1, args.runs), args.mode, max(1, args.batch),
+                        max(1, args.concurrency), args.seed)
+        else:
+            run_histories(client, args.users, args.per_user, args.mode, max(1, args.batch),
+                          max(1, args.concurrency), args.seed)
+    finally:
+        print_load_report(client)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            print_server_stats(server.stats)
+    return 1 if any(s.errors for s in client.stats.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+"""
+S3 互換 API のローカル版（publisher.py の確認用）
+
+publisher.py の S3Target が使う範囲だけを、フォルダの上に実装する:
+
+- PUT     オブジェクトを置く（Content-MD5 を確認、x-amz-meta-* を保存）
+          x-amz-copy-source があればサーバー内でコピー
+          ?partNumber=&uploadId= はマルチパートのパート
+- POST    ?uploads でマルチパートを開始、?uploadId= で完了（パートを連結）
+- DELETE  オブジェクトの削除、?uploadId= はマルチパートの中止
+- GET / HEAD  オブジェクトの取得（ETag・Content-Length・x-amz-meta-*）
+
+ETag は本物と同じ計算（1回の PUT は MD5、マルチパートは パートの MD5 を連結した MD5-パート数）。
+エラーは S3 と同じ XML（NoSuchKey・BadDigest・InvalidPart など）で返す。バケットは最初の書き込みで作る。
+署名は確かめない（--require-auth のときは Authorization ヘッダがあるかだけ見る）。
+--error-rate で一部のリクエストを 503 にできる（publisher の再試行の確認用）。
+
+保存先:
+  {root}/{バケット}/{キー}          オブジェクト
+  {root}/.meta/{バケット}/{キー}.json  ETag・Content-Type・x-amz-meta-*
+  {root}/.uploads/{uploadId}/       途中のマルチパート
+
+使い方:
+  python tools/s3_standin.py --root /tmp/s3 --port 9100
+  AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test \\
+    python tools/reliable_image_downloader.py publish s3://testsets/v1 --endpoint http://127.0.0.1:9100
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import shutil
+import hashlib
+import argparse
+import threading
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from host_health import percentile
+
+
+DEFAULT_PORT = 9100
+COPY_CHUNK = 1024 * 1024
+
+
+class S3Error(Exception):
+    """S3 のエラー応答（<Error><Code>…）"""
+
+    def __init__(self, status: int, code: str, message: str = ""):
+        super().__init__(message or code)
+        self.status = status
+        self.code = code
+
+
+# =============================================================================
+# 保存
+# =============================================================================
+
+class ObjectStore:
+    """フォルダの上のオブジェクト（書き込みは一時ファイルから rename）"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()  # オブジェクトとメタデータを一緒に差し替える
+
+    def _object_path(self, bucket: str, key: str) -> Path:
+        parts = [bucket] + key.split("/")
+        if not bucket or any(p in ("", ".", "..") or p.startswith(".") for p in parts):
+            raise S3Error(400, "InvalidArgument", f"使えないキーです: {bucket}/{key}")
+        return self.root.joinpath(*parts)
+
+    def _meta_path(self, bucket: str, key: str) -> Path:
+        return self.root / ".meta" / bucket / f"{key}.json"
+
+    def _upload_dir(self, upload_id: str) -> Path:
+        if not upload_id.isalnum():
+            raise S3Error(404, "NoSuchUpload")
+        path = self.root / ".uploads" / upload_id
+        if not path.is_dir():
+            raise S3Error(404, "NoSuchUpload")
+        return path
+
+    def _commit(self, bucket: str, key: str, tmp: Path, meta: dict):
+        dest = self._object_path(bucket, key)
+        meta_path = self._meta_path(bucket, key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {**meta, "size": tmp.stat().st_size, "modified": time.time()}
+        with self._lock:
+            os.replace(tmp, dest)
+            meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+    def _tmp(self) -> Path:
+        path = self.root / ".uploads" / f"tmp-{uuid.uuid4().hex}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def head(self, bucket: str, key: str) -> Tuple[Path, dict]:
+        path = self._object_path(bucket, key)
+        with self._lock:
+            try:
+                meta = json.loads(self._meta_path(bucket, key).read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                raise S3Error(404, "NoSuchKey")
+        return path, meta
+
+    def put(self, bucket: str, key: str, data: bytes, meta: dict) -> str:
+        self._object_path(bucket, key)
+        etag = hashlib.md5(data).hexdigest()
+        tmp = self._tmp()
+        tmp.write_bytes(data)
+        self._commit(bucket, key, tmp, {**meta, "etag": etag})
+        return etag
+
+    def copy(self, bucket: str, key: str, src_bucket: str, src_key: str) -> str:
+        src, meta = self.head(src_bucket, src_key)
+        tmp = self._tmp()
+        shutil.copyfile(src, tmp)
+        self._commit(bucket, key, tmp, meta)
+        return meta["etag"]
+
+    def delete(self, bucket: str, key: str):
+        path = self._object_path(bucket, key)
+        with self._lock:
+            path.unlink(missing_ok=True)
+            self._meta_path(bucket, key).unlink(missing_ok=True)
+
+    def create_upload(self, bucket: str, key: str, meta: dict) -> str:
+        self._object_path(bucket, key)
+        upload_id = uuid.uuid4().hex
+        path = self.root / ".uploads" / upload_id
+        path.mkdir(parents=True)
+        (path / "upload.json").write_text(json.dumps({"bucket": bucket, "key": key, "meta": meta}),
+                                          encoding="utf-8")
+        return upload_id
+
+    def put_part(self, upload_id: str, number: int, data: bytes) -> str:
+        path = self._upload_dir(upload_id)
+        if not 1 <= number <= 10000:
+            raise S3Error(400, "InvalidArgument", "partNumber は 1〜10000")
+        tmp = path / f"{number}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, path / f"{number}.part")
+        return hashlib.md5(data).hexdigest()
+
+    def complete_upload(self, upload_id: str, parts: List[Tuple[int, str]]) -> str:
+        """パートを番号順に連結する（ETag はパートの MD5 を連結した MD5-パート数）"""
+        path = self._upload_dir(upload_id)
+        info = json.loads((path / "upload.json").read_text(encoding="utf-8"))
+        if not parts or [n for n, _ in parts] != sorted({n for n, _ in parts}):
+            raise S3Error(400, "InvalidPartOrder")
+        digests = []
+        tmp = self._tmp()
+        try:
+            with open(tmp, "wb") as out:
+                for number, etag in parts:
+                    part = path / f"{number}.part"
+                    if not part.is_file():
+                        raise S3Error(400, "InvalidPart", f"パート {number} がありません")
+                    md5 = hashlib.md5()
+                    with open(part, "rb") as f:
+                        while True:
+                            chunk = f.read(COPY_CHUNK)
+                            if not chunk:
+                                break
+                            md5.update(chunk)
+                            out.write(chunk)
+                    if md5.hexdigest() != etag.strip('"'):
+                        raise S3Error(400, "InvalidPart", f"パート {number} の ETag が一致しません")
+                    digests.append(md5.digest())
+            etag = hashlib.md5(b"".join(digests)).hexdigest() + f"-{len(digests)}"
+            self._commit(info["bucket"], info["key"], tmp, {**info["meta"], "etag": etag})
+        finally:
+            tmp.unlink(missing_ok=True)
+        shutil.rmtree(path, ignore_errors=True)
+        return etag
+
+    def abort_upload(self, upload_id: str):
+        shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
+
+
+# =============================================================================
+# HTTP サーバー
+# =============================================================================
+
+@dataclass
+class ServerOptions:
+    error_rate: float = 0.0       # 503 を返す割合
+    require_auth: bool = False    # Authorization ヘッダの無いリクエストを 403 にする
+    verbose: bool = False
+
+
+@dataclass
+class ServerStats:
+    requests: Dict[str, int] = field(default_factory=dict)
+    errors: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    handle_ms: List[float] = field(default_factory=list)
+
+
+class S3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store: ObjectStore, options: ServerOptions):
+        super().__init__(address, S3Handler)
+        self.store = store
+        self.options = options
+        self.stats = ServerStats()
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # クライアントが接続を使い回せるように
+    server: S3Server
+
+    def log_message(self, fmt, *args):
+        if self.server.options.verbose:
+            super().log_message(fmt, *args)
+
+    def _send(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None,
+              length: Optional[int] = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.stats_lock:
+            self.server.stats.bytes_out += len(body)
+            self.server.stats.errors += int(status >= 400)
+
+    def _send_xml(self, status: int, root: ET.Element):
+        body = b'<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(root)
+        self._send(status, body, {"Content-Type": "application/xml"})
+
+    def _send_error(self, error: S3Error, resource: str):
+        root = ET.Element("Error")
+        for name, value in (("Code", error.code), ("Message", str(error)), ("Resource", resource)):
+            ET.SubElement(root, name).text = value
+        if self.command == "HEAD":
+            self._send(error.status)
+        else:
+            self._send_xml(error.status, root)
+
+    def _read_raw(self) -> bytes:
+        """本文を先に読み切る（エラーを返すときも接続を使い回せるように）"""
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        with self.server.stats_lock:
+            self.server.stats.bytes_in += len(raw)
+        return raw
+
+    def _user_meta(self) -> dict:
+        meta = {name.lower(): value for name, value in self.headers.items()
+                if name.lower().startswith("x-amz-meta-")}
+        meta["content-type"] = self.headers.get("Content-Type", "application/octet-stream")
+        return meta
+
+    def _handle(self, method: str):
+        started = time.perf_counter()
+        options = self.server.options
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        raw = self._read_raw()
+        with self.server.stats_lock:
+            counts = self.server.stats.requests
+            counts[method] = counts.get(method, 0) + 1
+        try:
+            if options.error_rate and random.random() < options.error_rate:
+                raise S3Error(503, "SlowDown", "Service Unavailable (injected)")
+            if options.require_auth and not self.headers.get("Authorization"):
+                raise S3Error(403, "AccessDenied")
+            bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+            if not key:
+                raise S3Error(400, "InvalidRequest", "バケットの一覧・操作には対応していません")
+            self._dispatch(method, bucket, key, params, raw)
+        except S3Error as e:
+            self._send_error(e, url.path)
+        finally:
+            with self.server.stats_lock:
+                self.server.stats.handle_ms.append((time.perf_counter() - started) * 1000)
+
+    def _dispatch(self, method: str, bucket: str, key: str, params: Dict[str, str], raw: bytes):
+        store = self.server.store
+        if method == "PUT":
+            if "uploadId" in params:
+                self._check_md5(raw)
+                etag = store.put_part(params["uploadId"], int(params.get("partNumber", 0)), raw)
+                self._send(200, headers={"ETag": f'"{etag}"'})
+                return
+            source = self.headers.get("x-amz-copy-source")
+            if source:
+                src_bucket, _, src_key = unquote(source).lstrip("/").partition("/")
+                etag = store.copy(bucket, key, src_bucket, src_key)
+                root = ET.Element("CopyObjectResult")
+                ET.SubElement(root, "ETag").text = f'"{etag}"'
+                self._send_xml(200, root)
+                return
+            self._check_md5(raw)
+            etag = store.put(bucket, key, raw, self._user_meta())
+            self._send(200, headers={"ETag": f'"{etag}"'})
+        elif method == "POST":
+            if "uploads" in params:
+                upload_id = store.create_upload(bucket, key, self._user_meta())
+                root = ET.Element("InitiateMultipartUploadResult")
+                for name, value in (("Bucket", bucket), ("Key", key), ("UploadId", upload_id)):
+                    ET.SubElement(root, name).text = value
+                self._send_xml(200, root)
+            elif "uploadId" in params:
+                try:
+                    body = ET.fromstring(raw)
+                except ET.ParseError:
+                    raise S3Error(400, "MalformedXML")
+                parts = [(int(p.findtext("{*}PartNumber") or p.findtext("PartNumber") or 0),
+                          p.findtext("{*}ETag") or p.findtext("ETag") or "")
+                         for p in body.iter() if p.tag.split("}")[-1] == "Part"]
+                etag = store.complete_upload(params["uploadId"], parts)
+                root = ET.Element("CompleteMultipartUploadResult")
+                for name, value in (("Bucket", bucket), ("Key", key), ("ETag", f'"{etag}"')):
+                    ET.SubElement(root, name).text = value
+                self._send_xml(200, root)
+            else:
+                raise S3Error(405, "MethodNotAllowed")
+        elif method == "DELETE":
+            if "uploadId" in params:
+                store.abort_upload(params["uploadId"])
+            else:
+                store.delete(bucket, key)
+            self._send(204)
+        elif method in ("GET", "HEAD"):
+            path, meta = store.head(bucket, key)
+            headers = {name: value for name, value in meta.items() if name.startswith("x-amz-meta-")}
+            headers.update({"Content-Type": meta["content-type"], "ETag": f'"{meta["etag"]}"',
+                            "Last-Modified": formatdate(meta["modified"], usegmt=True)})
+            if method == "HEAD":
+                self._send(200, headers=headers, length=meta["size"])
+            else:
+                self._send(200, path.read_bytes(), headers)
+        else:
+            raise S3Error(405, "MethodNotAllowed")
+
+    def _check_md5(self, raw: bytes):
+        expected = self.headers.get("Content-MD5")
+        if expected and base64.b64encode(hashlib.md5(raw).digest()).decode("ascii") != expected:
+            raise S3Error(400, "BadDigest", "Content-MD5 が本文と一致しません")
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def start_server(root: Path, host: str = "127.0.0.1", port: int = DEFAULT_PORT,
+                 options: Optional[ServerOptions] = None) -> S3Server:
+    """サーバーを別スレッドで起動する（port=0 で空いているポート）"""
+    server = S3Server((host, port), ObjectStore(root), options or ServerOptions())
+    threading.Thread(target=server.serve_forever, name="s3-standin", daemon=True).start()
+    return server
+
+
+def print_server_stats(stats: ServerStats):
+    total = sum(stats.requests.values())
+    if not total:
+        return
+    methods = " ".join(f"{method}={count}" for method, count in sorted(stats.requests.items()))
+    print(f"  サーバー: {total}リクエスト（{methods}）エラー {stats.errors} "
+          f"受信 {stats.bytes_in / 2**20:.1f} MB / 送信 {stats.bytes_out / 2**20:.1f} MB")
+    p50, p95, p99 = (percentile(stats.handle_ms, q) for q in (50, 95, 99))
+    print(f"  サーバー側の処理時間 p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="S3 互換 API のローカル版（publish の確認用）")
+    parser.add_argument("--root", default="s3_standin", help="オブジェクトを置くフォルダ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合（0〜1）")
+    parser.add_argument("--require-auth", action="store_true", help="Authorization ヘッダの無いリクエストを拒否")
+    parser.add_argument("--verbose", action="store_true", help="リクエストを1件ずつ表示")
+    args = parser.parse_args(argv)
+
+    options = ServerOptions(args.error_rate, args.require_auth, args.verbose)
+    server = S3Server((args.host, args.port), ObjectStore(Path(args.root)), options)
+    print(f"S3 stand-in: {server.url}（root={args.root}）  Ctrl+C で終了")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print_server_stats(server.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+被写体・顔の領域（切り抜き用のボックス）の事前計算
+
+クイズの画像は元の写真のまま表示されているので、被写体の位置をあらかじめ求めておき、
+クライアントが必要な部分だけをデコード・表示できるようにする。
+
+- 顔        OpenCV（opencv-python）が入っていれば、同梱の Haar カスケードで検出する
+            （オフラインで動く。入っていなければ顔の検出は省略）
+- 被写体    勾配エネルギー（NumPy でベクトル化）に中央寄りの重みを掛け、エネルギーの
+            大部分を含む範囲をボックスにする。顔が見つかった画像は顔を含む範囲にする
+
+結果はフォルダごとの .boxes.json に保存する:
+  {"001.jpg": {"sha256": "...", "size": 52311, "mtime_ns": ..., "width": 500, "height": 375,
+               "subject": [x, y, w, h], "faces": [[x, y, w, h], ...]}}
+座標は元画像のピクセル。ファイルが変わった画像（サイズ・更新日時が違う）だけを計算し直す。
+manifest.json の画像エントリには、ハッシュが一致する場合に subject_box / faces として入る。
+
+画像ごとの計算はプロセスプールで並列に行う。
+
+使い方（フォルダを直接指定する場合。image_downloader.py の人物画像など）:
+  python tools/subject_boxes.py downloaded_images/twins downloaded_images/similar_people --faces
+"""
+
+import os
+import sys
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image, ImageOps
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from dir_index import IMAGE_EXTENSIONS
+from manifest_writer import BOXES_FILENAME, load_boxes, write_json_atomic
+
+
+BOX_WORKERS = os.cpu_count() or 1  # プロセス数
+ANALYSIS_SIZE = 256        # 長辺をこのサイズに縮小して計算する
+ENERGY_TRIM = 0.05         # 両端から除くエネルギーの割合（縦・横それぞれ）
+CENTER_SIGMA = 0.35        # 中央寄りの重み（ガウス）の幅（画像サイズに対する割合）
+BLUR_RADIUS = 4            # 勾配エネルギーをならす範囲（縮小後のピクセル）
+BOX_MARGIN = 0.04          # ボックスに足す余白（画像サイズに対する割合）
+FACE_MIN_FRACTION = 0.06   # 検出する顔の最小サイズ（短辺に対する割合）
+FACE_BOX_EXPAND = 0.5      # 顔から被写体ボックスを作るときに広げる割合（髪・肩を含める）
+FACE_CASCADE = "haarcascade_frontalface_default.xml"
+ORIENTATION_TAG = 0x0112   # EXIF の Orientation
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)  # 90°回転する向き（幅と高さが入れ替わる）
+
+_face_detector = None
+
+
+# =============================================================================
+# ボックスの計算（プロセスプールで実行される）
+# =============================================================================
+
+def _box_blur(values: np.ndarray, radius: int) -> np.ndarray:
+    """積分画像による平均化（半径 radius の正方形）"""
+    if radius <= 0:
+        return values
+    padded = np.pad(values, radius + 1, mode="edge")
+    integral = padded.cumsum(0).cumsum(1)
+    k = 2 * radius + 1
+    total = (integral[k:, k:] - integral[:-k, k:] - integral[k:, :-k] + integral[:-k, :-k])
+    return total[:values.shape[0], :values.shape[1]] / (k * k)
+
+
+def gradient_energy(gray: np.ndarray) -> np.ndarray:
+    """勾配エネルギー（|dI/dx| + |dI/dy|）をならしたもの"""
+    g = gray.astype(np.float32)
+    energy = np.zeros_like(g)
+    energy[:, 1:] += np.abs(np.diff(g, axis=1))
+    energy[1:, :] += np.abs(np.diff(g, axis=0))
+    return _box_blur(energy, BLUR_RADIUS)
+
+
+def saliency_box(gray: np.ndarray, trim: float = ENERGY_TRIM) -> List[float]:
+    """被写体のボックス（x, y, w, h を画像サイズに対する割合で）"""
+    h, w = gray.shape
+    energy = gradient_energy(gray)
+    # 背景の一様なテクスチャ（芝生・砂など）を差し引き、中央寄りの重みを掛ける
+    energy = np.maximum(energy - np.median(energy), 0)
+    ys = (np.arange(h) - (h - 1) / 2) / (CENTER_SIGMA * h)
+    xs = (np.arange(w) - (w - 1) / 2) / (CENTER_SIGMA * w)
+    energy *= np.exp(-0.5 * ys ** 2)[:, None] * np.exp(-0.5 * xs ** 2)[None, :]
+    if energy.sum() <= 0:
+        return [0.0, 0.0, 1.0, 1.0]
+
+    def span(marginal: np.ndarray):
+        cumulative = np.cumsum(marginal) / marginal.sum()
+        lo = int(np.searchsorted(cumulative, trim))
+        hi = int(np.searchsorted(cumulative, 1 - trim)) + 1
+        return lo / len(marginal), min(hi, len(marginal)) / len(marginal)
+
+    x0, x1 = span(energy.sum(axis=0))
+    y0, y1 = span(energy.sum(axis=1))
+    return [x0, y0, x1 - x0, y1 - y0]
+
+
+def _get_face_detector():
+    global _face_detector
+    if _face_detector is None and cv2 is not None:
+        _face_detector = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, FACE_CASCADE))
+    return _face_detector
+
+
+def detect_faces(gray: np.ndarray) -> List[List[float]]:
+    """顔のボックス（x, y, w, h を画像サイズに対する割合で）。OpenCV が無ければ空"""
+    detector = _get_face_detector()
+    if detector is None:
+        return []
+    h, w = gray.shape
+    min_size = max(12, int(min(h, w) * FACE_MIN_FRACTION))
+    faces = detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_size, min_size))
+    return [[fx / w, fy / h, fw / w, fh / h] for fx, fy, fw, fh in faces]
+
+
+def _union(boxes: List[List[float]], expand: float) -> List[float]:
+    """ボックスをすべて含む範囲（各ボックスを expand の割合だけ広げる）"""
+    x0 = min(b[0] - b[2] * expand for b in boxes)
+    y0 = min(b[1] - b[3] * expand for b in boxes)
+    x1 = max(b[0] + b[2] * (1 + expand) for b in boxes)
+    y1 = max(b[1] + b[3] * (1 + expand) for b in boxes)
+    return [x0, y0, x1 - x0, y1 - y0]
+
+
+def _to_pixels(box: List[float], width: int, height: int, margin: float = 0.0) -> List[int]:
+    """割合のボックスを元画像のピクセルに変換（余白を足し、画像内に収める）"""
+    x0 = max(0.0, box[0] - margin)
+    y0 = max(0.0, box[1] - margin)
+    x1 = min(1.0, box[0] + box[2] + margin)
+    y1 = min(1.0, box[1] + box[3] + margin)
+    left, top = int(x0 * width), int(y0 * height)
+    return [left, top, max(1, round(x1 * width) - left), max(1, round(y1 * height) - top)]
+
+
+def compute_boxes(path: str, faces: bool = False) -> dict:
+    """画像1枚分のボックスを計算（プロセスプールのワーカーで実行）"""
+    entry = {"file": Path(path).name}
+    try:
+        data = Path(path).read_bytes()
+        st = os.stat(path)
+        entry.update(sha256=hashlib.sha256(data).hexdigest(), size=st.st_size, mtime_ns=st.st_mtime_ns)
+        with Image.open(path) as img:
+            # draft（縮小デコード）は exif_transpose の前に呼ぶ（後だと元の大きさでデコードされる）
+            width, height = img.size
+            if img.getexif().get(ORIENTATION_TAG) in ROTATED_ORIENTATIONS:
+                width, height = height, width
+            img.draft("L", (ANALYSIS_SIZE, ANALYSIS_SIZE))
+            img = ImageOps.exif_transpose(img)
+            small = img.convert("L")
+            small.thumbnail((ANALYSIS_SIZE, ANALYSIS_SIZE))
+        gray = np.asarray(small)
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__}: {e}"
+        return entry
+
+    entry.update(width=width, height=height)
+    face_boxes = detect_faces(gray) if faces else []
+    if faces:
+        entry["faces"] = [_to_pixels(b, width, height) for b in face_boxes]
+    subject = _union(face_boxes, FACE_BOX_EXPAND) if face_boxes else saliency_box(gray)
+    entry["subject"] = _to_pixels(subject, width, height, BOX_MARGIN)
+    return entry
+
+
+# =============================================================================
+# フォルダ単位の計算
+# =============================================================================
+
+def _is_current(entry: Optional[dict], path: Path, faces: bool) -> bool:
+    """記録済みのボックスが今のファイルのものか（読めなかった画像も、変わっていなければ計算し直さない）"""
+    if not entry or (faces and "faces" not in entry and "error" not in entry):
+        return False
+    try:
+        st = path.stat()
+    except OSError:
+        return False
+    return entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns
+
+
+class SubjectBoxer:
+    """フォルダ内の画像のボックスをプロセスプールで計算し、.boxes.json に保存する"""
+
+    def __init__(self, workers: int = BOX_WORKERS):
+        self.workers = max(1, workers)
+        self.computed = 0
+        self.errors = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # 呼び出し側ではダウンロードのスレッドが動いているので fork ではなく spawn を使う
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def update_dir(self, directory: Path, faces: bool = False,
+                   files: Optional[List[Path]] = None) -> int:
+        """フォルダの画像のうち、変わったものだけ計算し直す。戻り値は計算した枚数"""
+        directory = Path(directory)
+        if files is None:
+            files = sorted(p for p in directory.iterdir()
+                           if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+        boxes = load_boxes(directory)
+        names = {p.name for p in files}
+        stale = [p for p in files if not _is_current(boxes.get(p.name), p, faces)]
+        removed = [name for name in boxes if name not in names]
+        if not stale and not removed:
+            return 0
+
+        results = list(self._get_pool().map(compute_boxes, [str(p) for p in stale],
+                                            [faces] * len(stale), chunksize=4))
+        for name in removed:
+            del boxes[name]
+        errors = 0
+        for entry in results:
+            name = entry.pop("file")
+            boxes[name] = entry
+            errors += int("error" in entry)
+        write_json_atomic(directory / BOXES_FILENAME, boxes)
+
+        with self._lock:
+            self.computed += len(results) - errors
+            self.errors += errors
+        return len(results)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="画像フォルダの被写体・顔のボックスを計算して .boxes.json に保存")
+    parser.add_argument("dirs", nargs="+", help="画像フォルダ")
+    parser.add_argument("--faces", action="store_true", help="顔を検出する（opencv-python が必要）")
+    parser.add_argument("--workers", type=int, default=BOX_WORKERS, help="プロセス数")
+    args = parser.parse_args(argv)
+
+    if args.faces and cv2 is None:
+        print("opencv-python が無いため、顔の検出は省略します（被写体のボックスのみ）", file=sys.stderr)
+    boxer = SubjectBoxer(args.workers)
+    try:
+        for directory in args.dirs:
+            count = boxer.update_dir(Path(directory), faces=args.faces)
+            print(f"{directory}: {count}枚を計算")
+    finally:
+        boxer.close()
+    if boxer.errors:
+        print(f"読み込めなかった画像: {boxer.errors}枚", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+テストセットの整合性チェック
+
+公開前に以下を確認する:
+- 画像ファイルがすべてデコードできるか
+- 画像のSHA-256が manifest.json（version 2）の値と一致するか
+- manifest.json と実際のファイルに過不足がないか
+- ZIPの各エントリのCRCが正しく、中の manifest.json と一致するか（展開せずに確認）
+
+ハッシュ計算はスレッドプールで並列に行う（ファイル読み込み中と hashlib の計算中は
+GILが解放されるため、スレッドで十分に並列化できる）。
+結果は JSON にそのまま書き出せる dict で返す。
+"""
+
+import io
+import json
+import time
+import zlib
+import hashlib
+import zipfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from dir_index import get_index
+from manifest_writer import MANIFEST_FILENAME, load_manifest
+
+
+VERIFY_WORKERS = 8
+
+
+def _manifest_hashes(manifest: Optional[dict]) -> Dict[str, str]:
+    """manifest から {"タイプ/ファイル名": sha256} を作る"""
+    hashes = {}
+    for type_id, info in (manifest or {}).get("types", {}).items():
+        for image in info.get("images", []):
+            hashes[f"{type_id}/{image['file']}"] = image.get("sha256")
+    return hashes
+
+
+def check_image_bytes(name: str, data: bytes, expected_sha256: Optional[str]) -> Optional[dict]:
+    """画像1枚分のチェック（問題があればエラー情報を返す）"""
+    digest = hashlib.sha256(data).hexdigest()
+    if expected_sha256 and digest != expected_sha256:
+        return {"file": name, "error": "hash_mismatch", "expected": expected_sha256, "actual": digest}
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # JPEGは縮小デコードで十分（データ末尾まで読むので破損は検出できる）
+            img.draft("RGB", (max(1, img.width // 8), max(1, img.height // 8)))
+            img.load()
+    except Exception as e:
+        return {"file": name, "error": "undecodable", "detail": str(e)}
+    return None
+
+
+def _compare_names(actual: List[str], expected: Dict[str, str]) -> List[dict]:
+    """manifest とファイル一覧の過不足"""
+    errors = []
+    actual_set = set(actual)
+    for name in sorted(actual_set - expected.keys()):
+        errors.append({"file": name, "error": "not_in_manifest"})
+    for name in sorted(expected.keys() - actual_set):
+        errors.append({"file": name, "error": "missing"})
+    return errors
+
+
+def verify_genre_dir(genre_dir: Path, max_workers: int = VERIFY_WORKERS) -> dict:
+    """ジャンルフォルダの画像を manifest.json と照合"""
+    started = time.perf_counter()
+    manifest = load_manifest(genre_dir)
+    expected = _manifest_hashes(manifest)
+    index = get_index(genre_dir.parent)
+
+    files = {}
+    for item_dir in index.list_subdirs(genre_dir):
+        for path in index.list_images(item_dir):
+            files[f"{item_dir.name}/{path.name}"] = path
+    index.save()
+
+    def check(name: str) -> Optional[dict]:
+        try:
+            data = files[name].read_bytes()
+        except OSError as e:
+            return {"file": name, "error": "unreadable", "detail": str(e)}
+        return check_image_bytes(name, data, expected.get(name))
+
+    errors = []
+    if manifest is None:
+        errors.append({"file": MANIFEST_FILENAME, "error": "missing"})
+    elif not expected:
+        errors.append({"file": MANIFEST_FILENAME, "error": "no_image_hashes"})
+    else:
+        errors.extend(_compare_names(list(files), expected))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors.extend(e for e in executor.map(check, sorted(files)) if e)
+
+    return {
+        "path": str(genre_dir),
+        "ok": not errors,
+        "images_checked": len(files),
+        "bytes_checked": sum(p.stat().st_size for p in files.values()),
+        "errors": errors,
+        "elapsed_sec": round(time.perf_counter() - started, 3),
+    }
+
+
+def verify_zip(zip_path: Path, max_workers: int = VERIFY_WORKERS) -> dict:
+    """ZIPのCRCと中身を、ZIP内の manifest.json と照合（展開しない）"""
+    started = time.perf_counter()
+    errors = []
+
+    try:
+        with zipfile.ZipFile(zip_path) as zf:
+            infos = [i for i in zf.infolist() if not i.is_dir()]
+            manifest = None
+            manifest_error = "missing"
+            if MANIFEST_FILENAME in zf.namelist():
+                try:
+                    manifest = json.loads(zf.read(MANIFEST_FILENAME).decode("utf-8"))
+                except (zipfile.BadZipFile, ValueError, zlib.error, EOFError):
+                    # CRCエラーは下のエントリごとのチェックで報告される
+                    manifest_error = "unreadable"
+    except (OSError, zipfile.BadZipFile) as e:
+        return {"path": str(zip_path), "ok": False, "images_checked": 0, "bytes_checked": 0,
+                "errors": [{"file": str(zip_path), "error": "bad_zip", "detail": str(e)}],
+                "elapsed_sec": round(time.perf_counter() - started, 3)}
+
+    expected = _manifest_hashes(manifest)
+    image_names = [i.filename for i in infos
+                   if Path(i.filename).suffix.lower() in (".jpg", ".jpeg", ".png")]
+    image_name_set = set(image_names)  # check() で1エントリごとに引くので set にしておく
+
+    if manifest is None:
+        errors.append({"file": MANIFEST_FILENAME, "error": manifest_error})
+    elif not expected:
+        errors.append({"file": MANIFEST_FILENAME, "error": "no_image_hashes"})
+    else:
+        errors.extend(_compare_names(image_names, expected))
+
+    # ZipFile はスレッド間で共有できないので、スレッドごとに開く
+    local = threading.local()
+    handles = []
+
+    def check(info: zipfile.ZipInfo) -> Optional[dict]:
+        if not hasattr(local, "zf"):
+            local.zf = zipfile.ZipFile(zip_path)
+            handles.append(local.zf)
+        try:
+            # 最後まで読むと CRC が検査され、不一致なら BadZipFile になる
+            data = local.zf.read(info.filename)
+        except (zipfile.BadZipFile, OSError) as e:
+            return {"file": info.filename, "error": "bad_crc", "detail": str(e)}
+        except (zlib.error, EOFError) as e:
+            # 圧縮データ自体が壊れていると CRC 検査の前に展開で失敗する
+            return {"file": info.filename, "error": "corrupt", "detail": str(e)}
+        if info.filename not in image_name_set:
+            return None
+        return check_image_bytes(info.filename, data, expected.get(info.filename))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            errors.extend(e for e in executor.map(check, infos) if e)
+    finally:
+        for handle in handles:
+            handle.close()
+
+    return {
+        "path": str(zip_path),
+        "ok": not errors,
+        "images_checked": len(image_names),
+        "bytes_checked": sum(i.file_size for i in infos),
+        "errors": errors,
+        "elapsed_sec": round(time.perf_counter() - started, 3),
+    }
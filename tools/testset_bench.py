@@ -0,0 +1,314 @@
+"""
+テストセット配信の負荷試験（testset_server.py、または同じ URL 構成の配信元に対して）
+
+多数のクライアントが keep-alive の接続で同時にリクエストを送り、操作ごとの応答時間と転送量を測る。
+クライアントも asyncio で動かすので、数百の同時接続でも1プロセスで足りる。
+
+操作（--mix で割合を指定）:
+  zip         ジャンルの ZIP 全体（アプリの ZipTestSetService と同じ）。--verify で SHA-256 を確認
+  resume      ZIP の途中から Range で取得（中断したダウンロードの再開）
+  manifest    manifest.json を gzip で取得して JSON として読む
+  revalidate  manifest.json を If-None-Match 付きで取得（304 を期待）
+  image       manifest に載っている画像を1枚（バイト数を確認）
+
+--url を省略すると testset_server をこのプロセス内（別スレッド）で起動する。
+
+使い方:
+  python tools/testset_bench.py --root test_sets --clients 64 --requests 5000
+  python tools/testset_bench.py --url http://127.0.0.1:8765 --mix zip=1,image=10 --no-keep-alive
+"""
+
+import sys
+import gzip
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from host_health import percentile
+from testset_server import print_server_stats, start_server
+
+
+DEFAULT_CLIENTS = 32
+DEFAULT_REQUESTS = 2000
+DEFAULT_MIX = "zip=1,resume=1,manifest=4,revalidate=4,image=40"
+READ_CHUNK = 256 * 1024
+REQUEST_TIMEOUT_SEC = 120
+
+
+@dataclass
+class OpStats:
+    """操作ごとの応答時間と転送量"""
+    latencies_ms: List[float] = field(default_factory=list)
+    errors: int = 0
+    bytes: int = 0
+
+
+class BenchError(Exception):
+    pass
+
+
+class HttpConnection:
+    """1つの keep-alive 接続で GET を順に送るクライアント"""
+
+    def __init__(self, host: str, port: int, keep_alive: bool = True):
+        self.host = host
+        self.port = port
+        self.keep_alive = keep_alive
+        self.connects = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._reader = self._writer = None
+
+    async def get(self, path: str, headers: Optional[Dict[str, str]] = None,
+                  digest=None, keep_body: bool = True) -> Tuple[int, Dict[str, str], bytes, int]:
+        """戻り値: (ステータス, ヘッダ, 本体（keep_body のとき）, 本体のバイト数)"""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=READ_CHUNK)
+            self.connects += 1
+        lines = [f"GET {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        if not self.keep_alive:
+            lines.append("Connection: close")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        try:
+            head = await self._reader.readuntil(b"\r\n\r\n")
+            status_line, *header_lines = head.decode("latin-1").split("\r\n")
+            status = int(status_line.split(" ")[1])
+            response_headers = {}
+            for line in header_lines:
+                name, sep, value = line.partition(":")
+                if sep:
+                    response_headers[name.strip().lower()] = value.strip()
+            remaining = 0 if status in (204, 304) else int(response_headers.get("content-length", 0))
+            received, parts = 0, []
+            while remaining > 0:
+                chunk = await self._reader.read(min(remaining, READ_CHUNK))
+                if not chunk:
+                    raise BenchError("connection closed mid-body")
+                remaining -= len(chunk)
+                received += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                if keep_body:
+                    parts.append(chunk)
+        except BaseException:
+            await self.close()
+            raise
+        if not self.keep_alive or response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, response_headers, b"".join(parts), received
+
+
+# =============================================================================
+# シナリオ
+# =============================================================================
+
+@dataclass
+class Catalog:
+    """index.json と manifest から集めた、リクエストに使う URL"""
+    zips: List[dict] = field(default_factory=list)           # {"zip", "bytes", "sha256"}
+    manifests: List[Tuple[str, str]] = field(default_factory=list)  # (パス, gzip の ETag)
+    images: List[Tuple[str, int]] = field(default_factory=list)     # (パス, バイト数)
+
+
+async def load_catalog(conn: HttpConnection) -> Catalog:
+    status, _, body, _ = await conn.get("/index.json")
+    if status != 200:
+        raise BenchError(f"/index.json: HTTP {status}")
+    catalog = Catalog()
+    for genre in json.loads(body)["genres"]:
+        if "zip" in genre:
+            catalog.zips.append(genre)
+        path = "/" + genre["manifest"]
+        status, headers, body, _ = await conn.get(path, {"Accept-Encoding": "gzip"})
+        if status != 200:
+            raise BenchError(f"{path}: HTTP {status}")
+        if headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        catalog.manifests.append((path, headers.get("etag", "")))
+        for type_id, info in json.loads(body).get("types", {}).items():
+            for image in info.get("images", []):
+                catalog.images.append((f"/{genre['id']}/{type_id}/{image['file']}", image["bytes"]))
+    return catalog
+
+
+async def run_op(op: str, conn: HttpConnection, catalog: Catalog, rng: random.Random, verify: bool) -> int:
+    """操作を1回実行し、受け取ったバイト数を返す（期待と違えば BenchError）"""
+    if op in ("zip", "resume"):
+        entry = rng.choice(catalog.zips)
+        path = "/" + entry["zip"]
+        if op == "zip":
+            digest = hashlib.sha256() if verify else None
+            status, _, _, received = await conn.get(path, digest=digest, keep_body=False)
+            if status != 200 or received != entry["bytes"]:
+                raise BenchError(f"{path}: HTTP {status} {received}/{entry['bytes']} bytes")
+            if digest is not None and digest.hexdigest() != entry["sha256"]:
+                raise BenchError(f"{path}: SHA-256 mismatch")
+            return received
+        offset = rng.randrange(entry["bytes"])
+        status, headers, _, received = await conn.get(
+            path, {"Range": f"bytes={offset}-", "If-Range": f'"{entry["sha256"]}"'}, keep_body=False)
+        if status != 206 or received != entry["bytes"] - offset:
+            raise BenchError(f"{path} (Range {offset}-): HTTP {status} {received} bytes")
+        return received
+    if op in ("manifest", "revalidate"):
+        path, etag = rng.choice(catalog.manifests)
+        headers = {"Accept-Encoding": "gzip"}
+        if op == "revalidate":
+            headers["If-None-Match"] = etag
+        status, response_headers, body, received = await conn.get(path, headers)
+        if op == "revalidate":
+            if status != 304:
+                raise BenchError(f"{path} (If-None-Match): HTTP {status}")
+            return 0
+        if status != 200:
+            raise BenchError(f"{path}: HTTP {status}")
+        if response_headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        json.loads(body)
+        return received
+    path, size = rng.choice(catalog.images)
+    status, _, _, received = await conn.get(path, keep_body=False)
+    if status != 200 or received != size:
+        raise BenchError(f"{path}: HTTP {status} {received}/{size} bytes")
+    return received
+
+
+def parse_mix(text: str, catalog: Catalog) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"zip", "resume", "manifest", "revalidate", "image"}
+    if unknown:
+        raise ValueError(f"unknown operation: {', '.join(sorted(unknown))}")
+    # 対象の無い操作は除く（ZIP をまだ作っていない場合など）
+    if not catalog.zips:
+        mix.pop("zip", None)
+        mix.pop("resume", None)
+    if not catalog.images:
+        mix.pop("image", None)
+    if not catalog.manifests:
+        mix.pop("manifest", None)
+        mix.pop("revalidate", None)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+async def run_bench(url: str, clients: int, requests: int, mix_text: str, keep_alive: bool,
+                    verify: bool, seed: int) -> Tuple[Dict[str, OpStats], float, int]:
+    """戻り値: (操作ごとの統計, 経過秒数, 接続の数)"""
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    setup = HttpConnection(host, port)
+    try:
+        catalog = await load_catalog(setup)
+    finally:
+        await setup.close()
+    mix = parse_mix(mix_text, catalog)
+    if not mix:
+        raise BenchError("nothing to request (no manifests / ZIPs under the root?)")
+    print(f"  ZIP {len(catalog.zips)}個 / manifest {len(catalog.manifests)}個 / 画像 {len(catalog.images)}枚"
+          f"  割合: {', '.join(f'{k}={v:g}' for k, v in mix.items())}")
+
+    names, weights = list(mix), list(mix.values())
+    stats = {name: OpStats() for name in names}
+    remaining = [requests]
+    connections = []
+
+    async def client(index: int):
+        rng = random.Random(seed * 1000 + index)
+        conn = HttpConnection(host, port, keep_alive)
+        connections.append(conn)
+        try:
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                op = rng.choices(names, weights)[0]
+                started = time.perf_counter()
+                try:
+                    received = await asyncio.wait_for(run_op(op, conn, catalog, rng, verify), REQUEST_TIMEOUT_SEC)
+                except (BenchError, OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                    stats[op].errors += 1
+                    if stats[op].errors <= 3:
+                        print(f"  [error] {op}: {type(e).__name__}: {e}", file=sys.stderr)
+                    await conn.close()
+                    continue
+                stats[op].latencies_ms.append((time.perf_counter() - started) * 1000)
+                stats[op].bytes += received
+        finally:
+            await conn.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(clients)))
+    return stats, time.perf_counter() - started, sum(c.connects for c in connections)
+
+
+def print_bench_report(stats: Dict[str, OpStats], elapsed: float, connects: int):
+    print(f"\n{'操作':<12}{'req':>8}{'req/秒':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'エラー':>7}{'MB':>9}{'MB/秒':>9}")
+    total_requests = total_bytes = 0
+    for op, s in stats.items():
+        if not s.latencies_ms and not s.errors:
+            continue
+        total_requests += len(s.latencies_ms)
+        total_bytes += s.bytes
+        p50, p95, p99 = (percentile(s.latencies_ms, q) or 0.0 for q in (50, 95, 99))
+        print(f"{op:<12}{len(s.latencies_ms):>8}{len(s.latencies_ms) / elapsed:>10.0f}"
+              f"{p50:>8.1f}ms{p95:>8.1f}ms{p99:>8.1f}ms{s.errors:>7}"
+              f"{s.bytes / 2**20:>9.1f}{s.bytes / 2**20 / elapsed:>9.1f}")
+    print(f"合計: {total_requests}リクエスト / {elapsed:.1f}秒（{total_requests / elapsed:.0f} req/秒、"
+          f"{total_bytes / 2**20 / elapsed:.1f} MB/秒）接続 {connects}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="テストセット配信の負荷試験")
+    parser.add_argument("--url", help="配信元の URL（省略時は testset_server をプロセス内で起動）")
+    parser.add_argument("--root", default="test_sets", help="内蔵サーバーで配信するフォルダ")
+    parser.add_argument("--clients", type=int, default=DEFAULT_CLIENTS, help="同時に接続するクライアント数")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="リクエストの総数")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="操作の割合（例: zip=1,image=10）")
+    parser.add_argument("--no-keep-alive", action="store_true", help="リクエストごとに接続し直す")
+    parser.add_argument("--verify", action="store_true", help="ZIP の SHA-256 を確認")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = None
+    url = args.url
+    if url is None:
+        if not Path(args.root).is_dir():
+            print(f"フォルダがありません: {args.root}", file=sys.stderr)
+            return 2
+        server = start_server(Path(args.root))
+        url = server.url
+    print(f"負荷試験: 同時 {args.clients} / {args.requests}リクエスト"
+          f"{'（keep-alive なし）' if args.no_keep_alive else ''} → {url}")
+    try:
+        stats, elapsed, connects = asyncio.run(run_bench(
+            url, max(1, args.clients), args.requests, args.mix, not args.no_keep_alive, args.verify, args.seed))
+    except (BenchError, ValueError, OSError) as e:
+        print(f"[error] {e}", file=sys.stderr)
+        return 2
+    finally:
+        if server is not None:
+            server.stop()
+    print_bench_report(stats, elapsed, connects)
+    if server is not None:
+        print_server_stats(server.server.stats)
+    return 1 if any(s.errors for s in stats.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
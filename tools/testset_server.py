@@ -0,0 +1,527 @@
+"""
+テストセットの配信サーバー（開発・負荷試験用、asyncio）
+
+アプリの ZipTestSetService は固定のベースURLから {ジャンル}.zip を、engine-test はセットIDで
+ZIP をダウンロードする。ベースURLをこのサーバーに向ければ、test_sets/ をそのまま配信できる。
+
+URL:
+  /index.json                 ジャンルごとの最新の ZIP（名前・バイト数・SHA-256）の一覧
+  /{ジャンル}.zip             ジャンルの最新の ZIP（create_genre_zip の {ジャンル}_{日時}.zip）
+  /{ジャンル}_{日時}.zip      その ZIP
+  /{ジャンル}/manifest.json   manifest（.bin も同じ）
+  /{ジャンル}/{タイプ}/{画像} 画像
+
+- ETag は内容の SHA-256（強い ETag）。If-None-Match が一致すれば 304
+- Range（bytes=a-b / a- / -n のどれか1つ）には 206 で応える。If-Range が ETag と違えば全体を返す
+- JSON は gzip で圧縮したものをメモリに持っておき（ファイルが変わるまで）、リクエストごとには圧縮しない
+- ファイルの本体は loop.sendfile（Linux では sendfile(2)）で、ユーザー空間にコピーせずにソケットへ送る
+- HTTP/1.1 の keep-alive。1つのイベントループで多数の接続を扱い、ハッシュの計算だけスレッドで行う
+  （ファイルのサイズ・更新日時が変わるまで再計算しない）
+
+使い方:
+  python tools/testset_server.py --root test_sets --port 8765
+  # Android エミュレータからは http://10.0.2.2:8765、engine-test は lib/test_sets.dart の _baseUrl を変更
+"""
+
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import mimetypes
+import threading
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from dir_index import IMAGE_EXTENSIONS
+from manifest_writer import BINARY_MANIFEST_FILENAME, MANIFEST_FILENAME
+
+
+DEFAULT_PORT = 8765
+KEEP_ALIVE_SEC = 15         # 次のリクエストを待つ時間
+MAX_HEADER_BYTES = 16 * 1024
+HASH_CHUNK = 1024 * 1024
+GZIP_MIN_BYTES = 1024       # これより小さい JSON は圧縮しない
+GZIP_LEVEL = 9              # 圧縮はファイルごとに一度だけなので最大にする
+CACHE_CONTROL = "no-cache"  # 毎回 ETag で確認させる（ファイル名が同じまま内容が変わるため）
+
+STATUS_TEXT = {
+    200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request",
+    404: "Not Found", 405: "Method Not Allowed", 416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large", 500: "Internal Server Error",
+}
+
+
+class HttpError(Exception):
+    """ステータスコード付きのエラー（そのまま応答にする）"""
+
+    def __init__(self, status: int, message: str = "", headers: Optional[Dict[str, str]] = None):
+        super().__init__(message or STATUS_TEXT.get(status, ""))
+        self.status = status
+        self.message = message or STATUS_TEXT.get(status, "")
+        self.headers = headers or {}
+
+
+# =============================================================================
+# 配信するもの（ETag・gzip のキャッシュ）
+# =============================================================================
+
+@dataclass
+class Resource:
+    """配信する内容1つ分。path があれば sendfile で送り、無ければ body を送る"""
+    sha256: str
+    size: int
+    mtime: float
+    content_type: str
+    path: Optional[Path] = None
+    body: Optional[bytes] = None
+    gzip_body: Optional[bytes] = None
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.sha256}"'
+
+    @property
+    def gzip_etag(self) -> str:
+        return f'"{self.sha256}-gz"'
+
+
+def content_type(path: Path) -> str:
+    if path.suffix == ".json":
+        return "application/json; charset=utf-8"
+    if path.suffix == ".bin":
+        return "application/octet-stream"
+    return mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+
+
+def _compress(data: bytes) -> Optional[bytes]:
+    return gzip.compress(data, GZIP_LEVEL, mtime=0) if len(data) >= GZIP_MIN_BYTES else None
+
+
+def load_resource(path: Path, st: os.stat_result) -> Resource:
+    """ファイルのハッシュを計算し、JSON なら圧縮しておく（スレッドで実行）"""
+    is_json = path.suffix == ".json"
+    digest = hashlib.sha256()
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if is_json:
+                chunks.append(chunk)
+    return Resource(digest.hexdigest(), st.st_size, st.st_mtime, content_type(path), path=path,
+                    gzip_body=_compress(b"".join(chunks)) if is_json else None)
+
+
+def memory_resource(data: bytes, ctype: str) -> Resource:
+    return Resource(hashlib.sha256(data).hexdigest(), len(data), time.time(), ctype,
+                    body=data, gzip_body=_compress(data))
+
+
+class ResourceCache:
+    """パス → Resource。サイズ・更新日時が変わったファイルだけ読み直す（同時の読み直しは1回にまとめる）"""
+
+    def __init__(self):
+        self._entries: Dict[Path, Tuple[int, int, Resource]] = {}
+        self._loading: Dict[Path, asyncio.Future] = {}
+        self.loads = 0
+
+    async def get(self, path: Path) -> Resource:
+        try:
+            st = path.stat()
+        except OSError:
+            raise HttpError(404)
+        cached = self._entries.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        future = self._loading.get(path)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, load_resource, path, st)
+            self._loading[path] = future
+            future.add_done_callback(lambda f: self._store(path, st, f))
+            self.loads += 1
+        # 待っているクライアントが切断しても、他のクライアントの分の読み込みは止めない
+        return await asyncio.shield(future)
+
+    def _store(self, path: Path, st: os.stat_result, future: asyncio.Future):
+        self._loading.pop(path, None)
+        if not future.cancelled() and future.exception() is None:
+            self._entries[path] = (st.st_size, st.st_mtime_ns, future.result())
+
+
+def latest_zip(root: Path, genre_id: str) -> Optional[Path]:
+    """ジャンルの最新の ZIP（{ジャンル}_{日時}.zip）"""
+    # genre_id は URL から来るので、* や [ などを glob のパターンとして扱わない
+    zips = sorted(root.glob(f"{glob.escape(genre_id)}_2*.zip"))
+    return zips[-1] if zips else None
+
+
+# =============================================================================
+# HTTP
+# =============================================================================
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """Range ヘッダ → (先頭, 末尾)（末尾を含む）。複数の範囲・解釈できない指定は None（全体を返す）"""
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            if not last:
+                return None
+            length = int(last)
+            if length <= 0:
+                raise HttpError(416, headers={"Content-Range": f"bytes */{size}"})
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if end is not None and start > end:
+        return None
+    if start >= size:
+        raise HttpError(416, headers={"Content-Range": f"bytes */{size}"})
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def accepts_gzip(value: str) -> bool:
+    for part in value.split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            q = params.strip()
+            if q.startswith("q="):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def etag_matches(value: str, etag: str) -> bool:
+    """If-None-Match（弱い比較）"""
+    if value.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in value.split(","))
+
+
+def parse_head(head: bytes) -> Tuple[str, str, str, Dict[str, str]]:
+    """リクエスト行とヘッダ（名前は小文字）"""
+    try:
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise HttpError(400, "malformed request line")
+    if not version.startswith("HTTP/1."):
+        raise HttpError(400, "unsupported HTTP version")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HttpError(400, "malformed header")
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+@dataclass
+class ServerStats:
+    requests: Dict[int, int] = field(default_factory=dict)  # ステータスコード → 件数
+    connections: int = 0
+    active: int = 0
+    max_active: int = 0
+    bytes_out: int = 0
+    sendfile_bytes: int = 0
+    gzip_responses: int = 0
+    range_responses: int = 0
+    not_modified: int = 0
+
+
+class TestSetServer:
+    """test_sets/ を配信する asyncio のサーバー"""
+
+    def __init__(self, root: Path, verbose: bool = False):
+        self.root = Path(root).resolve()
+        self.verbose = verbose
+        self.cache = ResourceCache()
+        self.stats = ServerStats()
+        self._index: Optional[Resource] = None
+
+    # --- 配信するものを探す -------------------------------------------------
+
+    async def index_resource(self) -> Resource:
+        """/index.json（ZIP のハッシュは ResourceCache から。内容が同じなら前回の圧縮結果を使う）"""
+        genres = []
+        for genre_dir in sorted(p for p in self.root.iterdir() if p.is_dir() and not p.name.startswith(".")):
+            if not (genre_dir / MANIFEST_FILENAME).exists():
+                continue
+            entry = {"id": genre_dir.name, "manifest": f"{genre_dir.name}/{MANIFEST_FILENAME}"}
+            zip_path = latest_zip(self.root, genre_dir.name)
+            if zip_path is not None:
+                resource = await self.cache.get(zip_path)
+                entry.update(zip=f"{genre_dir.name}.zip", file=zip_path.name,
+                             bytes=resource.size, sha256=resource.sha256)
+            genres.append(entry)
+        data = json.dumps({"genres": genres}, ensure_ascii=False, indent=2).encode("utf-8")
+        if self._index is None or self._index.body != data:
+            self._index = memory_resource(data, "application/json; charset=utf-8")
+        return self._index
+
+    async def resolve(self, path: str) -> Resource:
+        parts = [unquote(p) for p in path.split("/") if p]
+        if any(p.startswith(".") or "/" in p or "\\" in p or "\0" in p for p in parts):
+            raise HttpError(404)
+        if parts in ([], ["index.json"]):
+            return await self.index_resource()
+        if len(parts) == 1 and parts[0].endswith(".zip"):
+            file_path = self.root / parts[0]
+            if not file_path.is_file():
+                file_path = latest_zip(self.root, parts[0][:-len(".zip")])
+                if file_path is None:
+                    raise HttpError(404)
+            return await self.cache.get(file_path)
+        if len(parts) == 2 and parts[1] in (MANIFEST_FILENAME, BINARY_MANIFEST_FILENAME):
+            return await self.cache.get(self.root.joinpath(*parts))
+        if len(parts) == 3 and Path(parts[2]).suffix.lower() in IMAGE_EXTENSIONS:
+            return await self.cache.get(self.root.joinpath(*parts))
+        raise HttpError(404)
+
+    # --- 応答 ---------------------------------------------------------------
+
+    def _write_head(self, writer: asyncio.StreamWriter, status: int, headers: Dict[str, str]):
+        lines = [f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+                 f"Date: {formatdate(usegmt=True)}", "Server: testset-server"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def _send_error(self, writer: asyncio.StreamWriter, error: HttpError, keep_alive: bool) -> int:
+        body = json.dumps({"error": error.message}).encode("utf-8")
+        self._write_head(writer, error.status, {
+            **error.headers, "Content-Type": "application/json", "Content-Length": str(len(body)),
+            "Connection": "keep-alive" if keep_alive else "close",
+        })
+        writer.write(body)
+        return error.status
+
+    async def _send_resource(self, writer: asyncio.StreamWriter, method: str,
+                             headers: Dict[str, str], resource: Resource, keep_alive: bool) -> int:
+        use_gzip = (resource.gzip_body is not None and "range" not in headers
+                    and accepts_gzip(headers.get("accept-encoding", "")))
+        etag = resource.gzip_etag if use_gzip else resource.etag
+        out = {
+            "ETag": etag,
+            "Last-Modified": formatdate(resource.mtime, usegmt=True),
+            "Cache-Control": CACHE_CONTROL,
+            "Connection": "keep-alive" if keep_alive else "close",
+        }
+        if resource.gzip_body is not None:
+            out["Vary"] = "Accept-Encoding"
+
+        if "if-none-match" in headers and etag_matches(headers["if-none-match"], etag):
+            self._write_head(writer, 304, out)
+            self.stats.not_modified += 1
+            return 304
+
+        status, start, length = 200, 0, resource.size
+        body = resource.body
+        if use_gzip:
+            body, length = resource.gzip_body, len(resource.gzip_body)
+            out["Content-Encoding"] = "gzip"
+            self.stats.gzip_responses += 1
+        else:
+            out["Accept-Ranges"] = "bytes"
+            if_range = headers.get("if-range")
+            if "range" in headers and (if_range is None or if_range == etag):
+                span = parse_range(headers["range"], resource.size)
+                if span is not None:
+                    start, end = span
+                    status, length = 206, end - start + 1
+                    out["Content-Range"] = f"bytes {start}-{end}/{resource.size}"
+                    self.stats.range_responses += 1
+        out["Content-Type"] = resource.content_type
+        out["Content-Length"] = str(length)
+        self._write_head(writer, status, out)
+        if method == "HEAD" or length == 0:
+            return status
+
+        if body is not None:
+            writer.write(body[start:start + length])
+        else:
+            with open(resource.path, "rb") as f:
+                await writer.drain()
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, length)
+            self.stats.sendfile_bytes += length
+        self.stats.bytes_out += length
+        return status
+
+    async def _handle_request(self, writer: asyncio.StreamWriter, method: str, target: str,
+                              headers: Dict[str, str], keep_alive: bool) -> int:
+        try:
+            if method not in ("GET", "HEAD"):
+                raise HttpError(405, headers={"Allow": "GET, HEAD"})
+            resource = await self.resolve(urlsplit(target).path)
+            return await self._send_resource(writer, method, headers, resource, keep_alive)
+        except HttpError as e:
+            return await self._send_error(writer, e, keep_alive)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        stats = self.stats
+        stats.connections += 1
+        stats.active += 1
+        stats.max_active = max(stats.max_active, stats.active)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEP_ALIVE_SEC)
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, HttpError(431), keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                try:
+                    method, target, version, headers = parse_head(head)
+                except HttpError as e:
+                    await self._send_error(writer, e, keep_alive=False)
+                    break
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" and (version == "HTTP/1.1" or connection == "keep-alive")
+                if headers.get("content-length", "0") != "0":
+                    await reader.readexactly(int(headers["content-length"]))
+
+                started = time.perf_counter()
+                try:
+                    status = await self._handle_request(writer, method, target, headers, keep_alive)
+                except Exception as e:
+                    print(f"[error] {method} {target}: {type(e).__name__}: {e}", file=sys.stderr)
+                    status = await self._send_error(writer, HttpError(500), keep_alive=False)
+                    keep_alive = False
+                stats.requests[status] = stats.requests.get(status, 0) + 1
+                await writer.drain()
+                if self.verbose:
+                    print(f"{method} {target} → {status} ({(time.perf_counter() - started) * 1000:.1f}ms)")
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            stats.active -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def serve(self, host: str, port: int, started: Optional[Callable] = None,
+                    stop: Optional[asyncio.Event] = None):
+        server = await asyncio.start_server(self.handle_connection, host, port,
+                                            limit=MAX_HEADER_BYTES, backlog=1024)
+        async with server:
+            if started is not None:
+                started(server.sockets[0].getsockname()[1])
+            if stop is None:
+                await server.serve_forever()
+            else:
+                await stop.wait()
+
+
+# =============================================================================
+# 起動
+# =============================================================================
+
+class ServerThread:
+    """別スレッドのイベントループで動くサーバー（負荷試験から使う）"""
+
+    def __init__(self, server: TestSetServer, host: str, port: int):
+        self.server = server
+        self.host = host
+        self.port = port
+        self._ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="testset-server", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def _run(self):
+        async def main():
+            self._loop = asyncio.get_running_loop()
+            self._stop = asyncio.Event()
+
+            def started(port: int):
+                self.port = port
+                self._ready.set()
+            await self.server.serve(self.host, self.port, started, self._stop)
+        try:
+            asyncio.run(main())
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+
+    def stop(self):
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join(timeout=5)
+
+
+def start_server(root: Path, host: str = "127.0.0.1", port: int = 0, verbose: bool = False) -> ServerThread:
+    """サーバーを別スレッドで起動する（port=0 で空いているポート）"""
+    return ServerThread(TestSetServer(root, verbose), host, port)
+
+
+def print_server_stats(stats: ServerStats):
+    total = sum(stats.requests.values())
+    if not total:
+        return
+    codes = " ".join(f"{code}={count}" for code, count in sorted(stats.requests.items()))
+    print(f"  サーバー: {total}リクエスト（{codes}）接続 {stats.connections}（最大同時 {stats.max_active}）")
+    print(f"  送信 {stats.bytes_out / 2**20:.1f} MB（sendfile {stats.sendfile_bytes / 2**20:.1f} MB）"
+          f" gzip {stats.gzip_responses} / Range {stats.range_responses} / 304 {stats.not_modified}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="test_sets/ の ZIP・manifest・画像を配信するサーバー")
+    parser.add_argument("--root", default="test_sets", help="テストセットのフォルダ")
+    parser.add_argument("--host", default="127.0.0.1", help="0.0.0.0 で他の端末からも接続できる")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--verbose", action="store_true", help="リクエストを1件ずつ表示")
+    args = parser.parse_args(argv)
+
+    root = Path(args.root)
+    if not root.is_dir():
+        print(f"フォルダがありません: {root}", file=sys.stderr)
+        return 2
+    server = TestSetServer(root, args.verbose)
+
+    def started(port: int):
+        print(f"テストセット配信: http://{args.host}:{port}/index.json（{root}）  Ctrl+C で終了")
+    try:
+        asyncio.run(server.serve(args.host, args.port, started))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print_server_stats(server.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+テストセット作成の作業キュー（SQLite、複数プロセス・複数マシンで分担）
+
+作業を（ジャンル, アイテム）単位に分けてキューに入れ、複数のワーカーが
+リース（期限付きの借り受け）で取り出して処理する。
+
+- claim      未処理の単位、またはリースの期限が切れた単位を借りる
+- heartbeat  処理中の単位のリースを延長する（止まったワーカーの単位は期限切れで他が引き継ぐ）
+- complete   単位の処理が終わった
+- ジャンルの全単位が終わったら、コーディネーターが manifest.json と ZIP を作る（finalize）
+
+排他制御は SQLite のファイルロック（BEGIN IMMEDIATE）で行う。共有ストレージ上でも
+使えるよう、ジャーナルは WAL ではなく通常のロールバックジャーナルにしている
+（WAL は共有メモリを使うため、ネットワークファイルシステムでは使えない）。
+
+status:
+  pending  未処理
+  leased   ワーカーが処理中（lease_expires まで）
+  done     完了
+  failed   max_attempts 回失敗した（リースの期限切れも失敗に数える）
+"""
+
+import time
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+LEASE_SEC = 300        # リースの長さ
+MAX_ATTEMPTS = 3       # この回数失敗したら failed にする
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    genre_id      TEXT NOT NULL,
+    item_id       TEXT NOT NULL,
+    target_count  INTEGER NOT NULL,
+    status        TEXT NOT NULL DEFAULT 'pending',
+    owner         TEXT,
+    lease_expires REAL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    images        INTEGER,
+    error         TEXT,
+    updated_at    REAL NOT NULL,
+    PRIMARY KEY (genre_id, item_id)
+);
+CREATE INDEX IF NOT EXISTS idx_units_status ON units (status, lease_expires);
+CREATE TABLE IF NOT EXISTS genres (
+    genre_id     TEXT PRIMARY KEY,
+    finalized_at REAL
+);
+"""
+
+
+class WorkQueue:
+    """（ジャンル, アイテム）単位の作業キュー"""
+
+    def __init__(self, db_path: Path, lease_sec: float = LEASE_SEC, max_attempts: int = MAX_ATTEMPTS):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+        # isolation_level=None: トランザクションは BEGIN IMMEDIATE で明示的に開始する
+        self._conn = sqlite3.connect(str(self.db_path), timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _write(self, func):
+        """書き込みトランザクション（他のプロセスとはファイルロックで排他）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def enqueue(self, units: Iterable[Tuple[str, str]], target_count: int, reset: bool = False) -> int:
+        """単位を追加（登録済みの単位は reset=True のときだけ未処理に戻す）。戻り値は追加・更新した数"""
+        now = time.time()
+
+        def op(conn):
+            changed = 0
+            for genre_id, item_id in units:
+                if reset:
+                    cursor = conn.execute(
+                        "INSERT INTO units (genre_id, item_id, target_count, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (genre_id, item_id) DO UPDATE SET target_count = excluded.target_count, "
+                        "status = 'pending', owner = NULL, lease_expires = NULL, attempts = 0, "
+                        "error = NULL, updated_at = excluded.updated_at",
+                        (genre_id, item_id, target_count, now))
+                else:
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO units (genre_id, item_id, target_count, updated_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (genre_id, item_id, target_count, now))
+                changed += cursor.rowcount
+                conn.execute("INSERT INTO genres (genre_id) VALUES (?) "
+                             "ON CONFLICT (genre_id) DO UPDATE SET finalized_at = NULL", (genre_id,))
+            return changed
+        return self._write(op)
+
+    def claim(self, owner: str, limit: int = 1) -> List[sqlite3.Row]:
+        """未処理（またはリース切れ）の単位を最大 limit 個借りる"""
+        now = time.time()
+
+        def op(conn):
+            # max_attempts 回借りられてもリースが切れた（ワーカーが毎回止まる）単位は failed にする
+            conn.execute(
+                "UPDATE units SET status = 'failed', owner = NULL, lease_expires = NULL, "
+                "error = 'lease expired', updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts))
+            rows = conn.execute(
+                "SELECT genre_id, item_id FROM units "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY attempts, genre_id, item_id LIMIT ?",
+                (now, limit)).fetchall()
+            for row in rows:
+                conn.execute(
+                    "UPDATE units SET status = 'leased', owner = ?, lease_expires = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE genre_id = ? AND item_id = ?",
+                    (owner, now + self.lease_sec, now, row["genre_id"], row["item_id"]))
+            return [conn.execute("SELECT * FROM units WHERE genre_id = ? AND item_id = ?",
+                                 (row["genre_id"], row["item_id"])).fetchone() for row in rows]
+        return self._write(op)
+
+    def heartbeat(self, owner: str, units: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """リースを延長する。戻り値は延長できなかった（他のワーカーに移った）単位"""
+        now = time.time()
+
+        def op(conn):
+            lost = []
+            for genre_id, item_id in units:
+                cursor = conn.execute(
+                    "UPDATE units SET lease_expires = ?, updated_at = ? "
+                    "WHERE genre_id = ? AND item_id = ? AND owner = ? AND status = 'leased'",
+                    (now + self.lease_sec, now, genre_id, item_id, owner))
+                if not cursor.rowcount:
+                    lost.append((genre_id, item_id))
+            return lost
+        return self._write(op)
+
+    def complete(self, owner: str, genre_id: str, item_id: str,
+                 images: Optional[int] = None, error: Optional[str] = None) -> bool:
+        """単位の処理結果を記録（error があれば再試行、max_attempts 回で failed）
+
+        リースが他のワーカーに移っていた場合は記録せず False を返す。
+        """
+        now = time.time()
+
+        def op(conn):
+            row = conn.execute(
+                "SELECT attempts FROM units WHERE genre_id = ? AND item_id = ? AND owner = ? "
+                "AND status = 'leased'", (genre_id, item_id, owner)).fetchone()
+            if row is None:
+                return False
+            if error is None:
+                status = "done"
+            else:
+                status = "failed" if row["attempts"] >= self.max_attempts else "pending"
+            conn.execute(
+                "UPDATE units SET status = ?, owner = NULL, lease_expires = NULL, images = ?, "
+                "error = ?, updated_at = ? WHERE genre_id = ? AND item_id = ?",
+                (status, images, error, now, genre_id, item_id))
+            return True
+        return self._write(op)
+
+    def release(self, owner: str) -> int:
+        """ワーカー終了時: 借りたままの単位を未処理に戻す"""
+        def op(conn):
+            return conn.execute(
+                "UPDATE units SET status = 'pending', owner = NULL, lease_expires = NULL, "
+                "attempts = MAX(attempts - 1, 0), updated_at = ? WHERE owner = ? AND status = 'leased'",
+                (time.time(), owner)).rowcount
+        return self._write(op)
+
+    def progress(self) -> Dict[str, Dict[str, int]]:
+        """ジャンルごとの状態別件数 {genre_id: {status: 件数}}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT genre_id, status, COUNT(*) FROM units GROUP BY genre_id, status").fetchall()
+        result: Dict[str, Dict[str, int]] = {}
+        for genre_id, status, count in rows:
+            result.setdefault(genre_id, {})[status] = count
+        return result
+
+    def has_open_units(self) -> bool:
+        """未処理・処理中の単位が残っているか"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM units WHERE status IN ('pending', 'leased') LIMIT 1").fetchone() is not None
+
+    def genres_ready(self) -> List[str]:
+        """全単位が終わり（done / failed）、まだ finalize していないジャンル"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT g.genre_id FROM genres g WHERE g.finalized_at IS NULL AND NOT EXISTS ("
+                "SELECT 1 FROM units u WHERE u.genre_id = g.genre_id "
+                "AND u.status IN ('pending', 'leased')) ORDER BY g.genre_id").fetchall()
+        return [row[0] for row in rows]
+
+    def unfinalized_genres(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT genre_id FROM genres WHERE finalized_at IS NULL ORDER BY genre_id").fetchall()
+        return [row[0] for row in rows]
+
+    def mark_finalized(self, genre_id: str):
+        self._write(lambda conn: conn.execute(
+            "UPDATE genres SET finalized_at = ? WHERE genre_id = ?", (time.time(), genre_id)))